@@ -1,11 +1,13 @@
 import math
 import random
 import openai
+import tiktoken
 import re
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
-    Application, MessageHandler, filters, CommandHandler, ContextTypes, CallbackQueryHandler
+    Application, MessageHandler, filters, CommandHandler, ContextTypes, CallbackQueryHandler, BaseRateLimiter
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
 import asyncio
 import datetime
 import pytz
@@ -18,6 +20,15 @@ from yookassa import Configuration, Payment
 import uuid
 import asyncpg
 from urllib.parse import urlparse
+from dataclasses import dataclass, field
+from typing import Optional
+from collections import OrderedDict
+import contextvars
+import contextlib
+import functools
+import itertools
+import json
+import time
 
 load_dotenv()
 
@@ -35,7 +46,84 @@ if db_url:
 else:
     raise ValueError("Переменная окружения DATABASE_URL не найдена")
 
+# Пул соединений с базой данных
 db_pool = None
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "10"))
+# Сколько подготовленных запросов asyncpg держит на каждом соединении пула
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+# Учёт лимитов: "sql" — атомарные запросы к базе, "memory" — в памяти процесса с периодической записью в базу
+QUOTA_ENGINE = os.getenv("QUOTA_ENGINE", "sql")
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+QUOTA_STATE_TTL = float(os.getenv("QUOTA_STATE_TTL", "600"))
+
+# Размер пачки user_id при чтении аудитории рассылки
+AUDIENCE_CHUNK_SIZE = int(os.getenv("AUDIENCE_CHUNK_SIZE", "500"))
+
+# Рассылка уведомлений: общий лимит Telegram — около 30 сообщений в секунду на бота
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Как часто обновлять сообщение с ходом рассылки у администратора (секунды)
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "15"))
+# Исходящие запросы к Bot API: общий темп и темп на один чат (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_GLOBAL_BURST = int(os.getenv("OUTBOUND_GLOBAL_BURST", "30"))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "2"))
+# Приоритеты исходящих запросов (меньше — раньше)
+OUTBOUND_INTERACTIVE = 0
+OUTBOUND_PROGRESS = 1
+OUTBOUND_BULK = 2
+# Сколько результатов отправки копить перед записью статусов получателей
+BROADCAST_FLUSH_SIZE = int(os.getenv("BROADCAST_FLUSH_SIZE", "100"))
+
+# Сводная статистика для админ панели
+STATS_REFRESH_INTERVAL = float(os.getenv("STATS_REFRESH_INTERVAL", "300"))
+STATS_BACKFILL_DAYS = int(os.getenv("STATS_BACKFILL_DAYS", "30"))
+
+# Счётчики использования функций (поиск книг, чат с ИИ)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "10"))
+USAGE_COUNTER_SHARDS = int(os.getenv("USAGE_COUNTER_SHARDS", "8"))
+
+# Отложенная пакетная запись счётчиков пользователей (0 — писать сразу)
+WRITE_BEHIND_DELAY = float(os.getenv("WRITE_BEHIND_DELAY", "0.5"))
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", "500"))
+
+# Режим получения обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Сколько обновлений принимать в работу одновременно (обновления одного пользователя — по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))
+# Генерация книг: параллельные запросы к OpenAI на одну книгу
+BOOK_SUBPART_CONCURRENCY = int(os.getenv("BOOK_SUBPART_CONCURRENCY", "4"))
+# Общие лимиты OpenAI: одновременные запросы, запросы и токены в минуту
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "16"))
+# Границы адаптивного окна одновременных запросов (OPENAI_CONCURRENCY — стартовое значение)
+OPENAI_CONCURRENCY_MIN = int(os.getenv("OPENAI_CONCURRENCY_MIN", "2"))
+OPENAI_CONCURRENCY_MAX = int(os.getenv("OPENAI_CONCURRENCY_MAX", "64"))
+# Во сколько раз время на токен может превысить лучшее наблюдаемое, прежде чем окно перестанет расти
+OPENAI_SLOW_FACTOR = float(os.getenv("OPENAI_SLOW_FACTOR", "2"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "3500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "90000"))
+# Приоритеты запросов к OpenAI (меньше — раньше)
+OPENAI_INTERACTIVE = 0
+OPENAI_BACKGROUND = 1
+# Как часто обновлять сообщение с прогрессом генерации книги (секунды)
+BOOK_PROGRESS_INTERVAL = float(os.getenv("BOOK_PROGRESS_INTERVAL", "2"))
+# Кэш разбиения книг на части: записей в памяти и срок хранения (секунды, по умолчанию 30 дней)
+OUTLINE_CACHE_SIZE = int(os.getenv("OUTLINE_CACHE_SIZE", "1024"))
+OUTLINE_CACHE_TTL = int(os.getenv("OUTLINE_CACHE_TTL", str(30 * 24 * 3600)))
+# Сколько обработчиков может выполняться одновременно (0 — без ограничения)
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "32"))
+
 Configuration.account_id = os.getenv("account_id")
 Configuration.secret_key = os.getenv("secret_key")
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -48,10 +136,10 @@ subscription_search_book_is_true = True
 count_limit_chat_with_ai = 10
 count_limit_book_in_subscribe_day = 10
 limit_page_book = 20
+# Сколько книг показывать на одной странице «Моей библиотеки»
+LIBRARY_PAGE_SIZE = int(os.getenv("LIBRARY_PAGE_SIZE", "10"))
 count_limit_book_day = 1
 wait_hour = 1
-count_search_book = 0
-count_chat_ai = 0
 
 # Хранилище подписок (для админов)
 subscriptions = []
@@ -59,242 +147,1291 @@ MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 # Установите API-ключ OpenAI
 openai.api_key = openai_api_key
 
+# Создание пула соединений с базой данных (вызывается при запуске приложения)
+async def init_db_pool():
+    global db_pool
+    if db_pool is None:
+        db_pool = await asyncpg.create_pool(
+            **DB_CONFIG,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        )
+        print(f'пул соединений с базой данных создан ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE})')
+    return db_pool
+
+# Закрытие пула соединений (вызывается при остановке приложения)
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+        print('пул соединений с базой данных закрыт')
+
+# Получение соединения из пула: async with acquire_db() as conn
+def acquire_db():
+    if db_pool is None:
+        raise RuntimeError("Пул соединений с базой данных не инициализирован")
+    return db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+
+# Статистика выполнения одного именованного запроса
+class QueryStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed=False):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        if failed:
+            self.errors += 1
+
+class QueryRegistry:
+    """
+    Реестр именованных запросов для самых частых обращений к базе.
+    Текст каждого запроса задаётся один раз, поэтому asyncpg готовит его
+    (PREPARE) один раз на каждое соединение пула и дальше берёт из своего
+    кэша подготовленных выражений. Для каждого запроса считаются вызовы и время.
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.stats = {}
+
+    def register(self, name, sql):
+        if name in self.queries:
+            raise ValueError(f"Запрос {name} уже зарегистрирован")
+        self.queries[name] = sql
+        self.stats[name] = QueryStats()
+        return name
+
+    # conn — уже взятое соединение (например, внутри транзакции), иначе берётся из пула
+    async def _run(self, method, name, args, conn=None):
+        sql = self.queries[name]
+        started = time.perf_counter()
+        failed = False
+        try:
+            if conn is not None:
+                return await getattr(conn, method)(sql, *args)
+            async with acquire_db() as conn:
+                return await getattr(conn, method)(sql, *args)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.stats[name].record(time.perf_counter() - started, failed)
+
+    async def fetch(self, name, *args, conn=None):
+        return await self._run('fetch', name, args, conn)
+
+    async def fetchrow(self, name, *args, conn=None):
+        return await self._run('fetchrow', name, args, conn)
+
+    async def fetchval(self, name, *args, conn=None):
+        return await self._run('fetchval', name, args, conn)
+
+    async def execute(self, name, *args, conn=None):
+        return await self._run('execute', name, args, conn)
+
+    # Текстовый отчёт для админ панели
+    def report(self):
+        lines = []
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1].calls):
+            average = stats.total_time / stats.calls * 1000 if stats.calls else 0
+            lines.append(
+                f"{name}: {stats.calls} выз., ср. {average:.1f} мс, макс. {stats.max_time * 1000:.1f} мс"
+                + (f", ошибок {stats.errors}" if stats.errors else "")
+            )
+        return "\n".join(lines)
+
+db_queries = QueryRegistry()
+
+# Миграция схемы базы данных
+@dataclass
+class Migration:
+    version: int
+    name: str
+    statements: tuple
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    transactional: bool = True
+
+MIGRATIONS = [
+    Migration(1, "base_tables", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            daily_book_count INTEGER NOT NULL DEFAULT 0,
+            last_book_date TIMESTAMP,
+            is_process_book BOOLEAN NOT NULL DEFAULT FALSE,
+            count_words INTEGER NOT NULL DEFAULT 0,
+            reset_time TIMESTAMP,
+            library TEXT[] NOT NULL DEFAULT '{}'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_subscriptions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            subscription_name TEXT NOT NULL,
+            subscription_price NUMERIC(10, 2) NOT NULL,
+            end_date DATE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS books (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            title TEXT NOT NULL,
+            path TEXT NOT NULL
+        )
+        """,
+    )),
+    Migration(2, "stats_tables", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP",
+        "ALTER TABLE users ALTER COLUMN created_at SET DEFAULT now()",
+        """
+        CREATE TABLE IF NOT EXISTS bot_stats (
+            id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+            total_users BIGINT NOT NULL,
+            active_subscribers BIGINT NOT NULL,
+            refreshed_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_stats_daily (
+            day DATE PRIMARY KEY,
+            new_users BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_counters (
+            metric TEXT NOT NULL,
+            day DATE NOT NULL,
+            shard SMALLINT NOT NULL,
+            count BIGINT NOT NULL,
+            PRIMARY KEY (metric, day, shard)
+        )
+        """,
+    )),
+    Migration(3, "hot_lookup_indexes", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS books_user_id_title_idx ON books (user_id, title)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS user_subscriptions_user_id_end_date_idx ON user_subscriptions (user_id, end_date)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_username_idx ON users (username)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_created_at_idx ON users (created_at)",
+    ), transactional=False),
+    Migration(4, "books_keyset_index", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS books_user_id_id_idx ON books (user_id, id)",
+    ), transactional=False),
+    Migration(5, "users_blocked_at", (
+        # Когда пользователь заблокировал бота (NULL — не блокировал)
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP",
+    )),
+    Migration(6, "broadcast_jobs", (
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            target_group TEXT NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup JSONB,
+            -- running, paused, cancelled, done, failed
+            status TEXT NOT NULL DEFAULT 'running',
+            status_chat_id BIGINT,
+            status_message_id BIGINT,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL REFERENCES broadcast_jobs (id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            -- pending, sent, failed, blocked
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (job_id, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS broadcast_recipients_pending_idx ON broadcast_recipients (job_id, user_id) WHERE status = 'pending'",
+    )),
+    Migration(7, "book_outlines", (
+        """
+        CREATE TABLE IF NOT EXISTS book_outlines (
+            -- нормализованное название, как его ввёл пользователь
+            title_key TEXT NOT NULL,
+            language TEXT NOT NULL,
+            exact_title TEXT NOT NULL,
+            list_parts TEXT[] NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (title_key, language)
+        )
+        """,
+    )),
+]
+
+# Ключ advisory-блокировки, чтобы миграции не запускались одновременно из нескольких процессов
+MIGRATIONS_LOCK_ID = 7_310_001
+# Как часто проверять, освободил ли блокировку миграций другой процесс (секунды)
+MIGRATIONS_LOCK_POLL_INTERVAL = 0.5
+
+# Имя индекса из CREATE INDEX CONCURRENTLY IF NOT EXISTS
+CONCURRENT_INDEX_RE = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+# NULL — индекса нет, FALSE — индекс остался недостроенным (INVALID)
+async def index_is_valid(conn, index_name):
+    return await conn.fetchval("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", index_name)
+
+async def execute_concurrent_statement(conn, statement):
+    """
+    Выполняет оператор миграции вне транзакции. Прерванный CREATE INDEX
+    CONCURRENTLY оставляет INVALID индекс, который IF NOT EXISTS дальше
+    пропускал бы навсегда, поэтому такой остаток сначала удаляется, а после
+    создания индекс проверяется на готовность.
+    """
+    match = CONCURRENT_INDEX_RE.search(statement)
+    if match and await index_is_valid(conn, match.group(1)) is False:
+        print(f'удаляем недостроенный индекс {match.group(1)}')
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+    await conn.execute(statement)
+    if match and not await index_is_valid(conn, match.group(1)):
+        raise RuntimeError(f"Индекс {match.group(1)} не построен")
+
+async def run_migrations():
+    """
+    Применяет ещё не применённые миграции из MIGRATIONS по возрастанию версии.
+    Для каждой миграции печатается и сохраняется в schema_migrations время выполнения.
+    """
+    report = []
+    async with acquire_db() as conn:
+        # Блокировка берётся до создания schema_migrations, чтобы процессы не гонялись и за неё.
+        # Ждём через pg_try_advisory_lock: заблокированный pg_advisory_lock держит снимок,
+        # и CREATE INDEX CONCURRENTLY в другом процессе ждал бы его — взаимная блокировка
+        while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_ID):
+            await asyncio.sleep(MIGRATIONS_LOCK_POLL_INTERVAL)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT now(),
+                    duration_ms DOUBLE PRECISION NOT NULL
+                )
+            """)
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+                started = time.perf_counter()
+                if migration.transactional:
+                    async with conn.transaction():
+                        for statement in migration.statements:
+                            await conn.execute(statement)
+                else:
+                    for statement in migration.statements:
+                        await execute_concurrent_statement(conn, statement)
+                duration_ms = (time.perf_counter() - started) * 1000
+                await conn.execute("""
+                    INSERT INTO schema_migrations (version, name, duration_ms)
+                    VALUES ($1, $2, $3)
+                """, migration.version, migration.name, duration_ms)
+                report.append((migration.version, migration.name, duration_ms))
+                print(f'миграция {migration.version:03d} {migration.name}: {duration_ms:.1f} мс')
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+    if report:
+        print(f'применено миграций: {len(report)}, всего {sum(ms for _, _, ms in report):.1f} мс')
+    else:
+        print('схема базы данных актуальна')
+    return report
+
+# Фоновые задачи приложения (останавливаются при выключении бота)
+background_tasks = []
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.append(task)
+    return task
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+class KeyedLocks:
+    """
+    Блокировки по ключу (например, user_id) с общим лимитом одновременно
+    работающих задач. Блокировка создаётся при первом обращении и удаляется,
+    когда её больше никто не держит и не ждёт, поэтому память не растёт с
+    числом пользователей. Ожидающие получают блокировку в порядке очереди;
+    место в общем лимите занимается только после получения своей блокировки,
+    так что очередь одного пользователя не отнимает места у других.
+    Блокировки действуют в пределах одного процесса.
+    """
+
+    def __init__(self, max_in_flight=0):
+        # ключ -> [asyncio.Lock, сколько задач держат или ждут]
+        self.locks = {}
+        self.max_in_flight = max_in_flight
+        self.slots = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # Сколько раз блокировка оказалась занята
+        self.contended = 0
+        self.lock_wait = QueryStats()
+        self.slot_wait = QueryStats()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.slots is not None:
+            started = time.perf_counter()
+            await self.slots.acquire()
+            self.slot_wait.record(time.perf_counter() - started)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.slots is not None:
+                self.slots.release()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.contended += 1
+            started = time.perf_counter()
+            async with entry[0]:
+                self.lock_wait.record(time.perf_counter() - started)
+                async with self.slot():
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    # Текстовый отчёт для админ панели
+    def report(self):
+        def waits(stats):
+            average = stats.total_time / stats.calls * 1000 if stats.calls else 0
+            return f"ср. {average:.1f} мс, макс. {stats.max_time * 1000:.0f} мс"
+
+        limit = self.max_in_flight or "нет"
+        return (
+            f"Выполняется сейчас: {self.in_flight} (пик {self.peak_in_flight}, лимит {limit})\n"
+            f"Пользователей с очередью: {len(self.locks)}\n"
+            f"Захватов: {self.lock_wait.calls}, из них с ожиданием: {self.contended}\n"
+            f"Ожидание своей очереди: {waits(self.lock_wait)}\n"
+            f"Ожидание общего лимита: {waits(self.slot_wait)}"
+        )
+
+user_update_locks = KeyedLocks(HANDLER_CONCURRENCY)
+
+# Обновления разных пользователей обрабатываются параллельно, одного пользователя — по очереди
+def per_user_ordering(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context)
+        async with user_update_locks.hold(user.id):
+            return await handler(update, context)
+    return wrapper
+
+# Кэш пользователей в рамках обработки одного обновления (update)
+class RequestUserCache:
+    def __init__(self):
+        self.users = {}
+        self.contexts = {}
+        self.active = True
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self.users.clear()
+            self.contexts.clear()
+        else:
+            self.users.pop(user_id, None)
+            self.contexts.pop(user_id, None)
+
+_request_user_cache = contextvars.ContextVar('request_user_cache', default=None)
+# Сколько запросов к базе данных сэкономил кэш
+user_cache_saved_queries = 0
+
+# Кэш текущего обновления (None вне обработчика)
+def current_user_cache():
+    cache = _request_user_cache.get()
+    if cache is None or not cache.active:
+        return None
+    return cache
+
+def count_saved_query():
+    global user_cache_saved_queries
+    user_cache_saved_queries += 1
+
+# Сброс кэша после записи в базу данных (user_id=None — сбросить всё)
+def invalidate_user_cache(user_id=None):
+    cache = current_user_cache()
+    if cache is not None:
+        cache.invalidate(user_id)
+
+# Обёртка обработчика: каждое обновление получает свой кэш пользователей
+def with_user_cache(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        cache = RequestUserCache()
+        token = _request_user_cache.set(cache)
+        try:
+            return await handler(update, context)
+        finally:
+            # Фоновые задачи, запущенные из обработчика, больше не видят этот кэш
+            cache.active = False
+            _request_user_cache.reset(token)
+    return wrapper
+
 # Функция для удаления книги из базы данных
 async def delete_book_from_db(book_id: int):
-    # Устанавливаем соединение с базой данных
-    conn = await connect_db()
-    try:
+    async with acquire_db() as conn:
         # Выполняем запрос на удаление книги по ее id
         await conn.execute('DELETE FROM books WHERE id = $1', book_id)
-    finally:
-        # Закрываем соединение
-        await close_db(conn)
 
-async def get_books_for_user(user_id: int):
-    conn = await connect_db()
-    try:
-        # Получение данных из таблицы
-        user_books = await conn.fetch("""
-            SELECT id, title, path FROM books WHERE user_id = $1
-        """, user_id)
-    finally:
-        await close_db(conn)
-    return user_books
+db_queries.register("get_books_for_user", """
+    SELECT id, title, path FROM books WHERE user_id = $1
+""")
+
+async def get_books_for_user(user_id: int) -> list:
+    # Получение данных из таблицы
+    return await db_queries.fetch("get_books_for_user", user_id)
+
+# Пространство имён advisory-блокировок на книги пользователя
+BOOKS_LOCK_NAMESPACE = 7_310_002
+
+db_queries.register("lock_user_books", """
+    SELECT pg_advisory_xact_lock($1::int, hashtext($2::bigint::text))
+""")
+
+# Свободное название выбирается в самом INSERT: «Название», иначе «Название_N»,
+# где N на единицу больше наибольшего занятого суффикса
+db_queries.register("insert_book_unique_title", """
+    WITH taken AS (
+        SELECT COALESCE(bool_or(title = $2), FALSE) AS exact_taken,
+               COALESCE(MAX(CASE
+                   WHEN title <> $2 AND substring(title FROM char_length($2) + 2) ~ '^[0-9]{1,9}$'
+                   THEN substring(title FROM char_length($2) + 2)::int
+               END), 0) AS max_suffix
+        FROM books
+        WHERE user_id = $1
+          AND (title = $2 OR left(title, char_length($2) + 1) = $2 || '_')
+    ), chosen AS (
+        SELECT CASE WHEN exact_taken THEN $2 || '_' || (max_suffix + 1) ELSE $2 END AS title
+        FROM taken
+    )
+    INSERT INTO books (user_id, title, path)
+    SELECT $1, chosen.title, $3 || '/' || $1 || '_' || chosen.title || '.pdf'
+    FROM chosen
+    RETURNING id, title, path
+""")
+
+# Добавление книги с уникальным для пользователя названием
+async def add_book_with_unique_title(user_id: int, title: str, volume_path: str):
+    async with acquire_db() as conn:
+        async with conn.transaction():
+            # Две книги одного пользователя, готовые одновременно, получат разные названия
+            await db_queries.execute("lock_user_books", BOOKS_LOCK_NAMESPACE, user_id, conn=conn)
+            return await db_queries.fetchrow("insert_book_unique_title", user_id, title, volume_path, conn=conn)
+
+# Страницы библиотеки выбираются по курсору (id книги), а не через OFFSET
+db_queries.register("library_page_after", """
+    SELECT id, title FROM books
+    WHERE user_id = $1 AND id > $2
+    ORDER BY id
+    LIMIT $3
+""")
+
+db_queries.register("library_page_before", """
+    SELECT id, title FROM books
+    WHERE user_id = $1 AND id < $2
+    ORDER BY id DESC
+    LIMIT $3
+""")
+
+db_queries.register("library_counts", """
+    SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE id < $2) AS before
+    FROM books WHERE user_id = $1
+""")
+
+@dataclass
+class LibraryPage:
+    books: list
+    total: int
+    # Сколько книг стоит в библиотеке перед первой книгой страницы
+    offset: int
+
+    @property
+    def has_prev(self) -> bool:
+        return self.offset > 0
+
+    @property
+    def has_next(self) -> bool:
+        return self.offset + len(self.books) < self.total
+
+# Страница библиотеки: после книги after_id или перед книгой before_id (по умолчанию — первая)
+async def get_user_library(user_id, after_id: int = 0, before_id: int = None) -> LibraryPage:
+    if before_id is not None:
+        books = await db_queries.fetch("library_page_before", user_id, before_id, LIBRARY_PAGE_SIZE)
+        books.reverse()
+    else:
+        books = await db_queries.fetch("library_page_after", user_id, after_id, LIBRARY_PAGE_SIZE)
+    if not books and (after_id or before_id is not None):
+        # Курсор устарел (книги удалены) — показываем первую страницу
+        return await get_user_library(user_id)
+    first_id = books[0]['id'] if books else 0
+    counts = await db_queries.fetchrow("library_counts", user_id, first_id)
+    return LibraryPage(books=list(books), total=counts['total'], offset=counts['before'])
+
+# Текст и кнопки страницы «Моей библиотеки»
+def build_library_view(page: LibraryPage):
+    if not page.books:
+        # Если у пользователя нет книг
+        library_text = "📚 Ваша библиотека пуста. Добавьте книги через поиск!"
+        keyboard = [
+            [InlineKeyboardButton("📚 Поиск книг", callback_data="search_books")],
+            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+        ]
+        return library_text, keyboard
 
-async def get_user_library(user_id):
-    conn = await connect_db()
-    try:
-        # Получение данных из таблицы
-        user_subscriptions = await conn.fetch("""
-            SELECT * FROM books WHERE user_id = $1
-        """, user_id)
-    finally:
-        await close_db(conn)
-    return user_subscriptions
+    books_list = "\n".join(
+        [f"{page.offset + idx + 1}. {book['title']}" for idx, book in enumerate(page.books)]
+    )
+    shown_to = page.offset + len(page.books)
+    library_text = (
+        f"📚 Ваши книги ({page.offset + 1}–{shown_to} из {page.total})\n\n{books_list}\n\n"
+        "Выберите книгу, чтобы выполнить действия с ней."
+    )
+    keyboard = [
+        [InlineKeyboardButton(book['title'], callback_data=f"book_options_{book['id']}")]
+        for book in page.books
+    ]
 
-# Получение пользователей без подписок
-async def get_users_without_subscriptions():
-    conn = await connect_db()
-    try:
-        no_subscription_users = await conn.fetch("""
-            SELECT u.user_id
-            FROM users u
-            LEFT JOIN user_subscriptions us ON u.user_id = us.user_id
-            WHERE us.user_id IS NULL OR us.end_date < $1
-        """, datetime.now().date())
-        return no_subscription_users
-    finally:
-        await close_db(conn)
+    # Кнопки перелистывания
+    navigation = []
+    if page.has_prev:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"library_prev_{page.books[0]['id']}"))
+    if page.has_next:
+        navigation.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"library_next_{page.books[-1]['id']}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")])
+    return library_text, keyboard
+
+# Аудитории пользователей (параметр $1, если есть, — сегодняшняя дата)
+AUDIENCE_SQL = {
+    "all": """
+        SELECT u.user_id FROM users u
+    """,
+    "subscribed": """
+        SELECT u.user_id FROM users u
+        WHERE EXISTS (
+            SELECT 1 FROM user_subscriptions us
+            WHERE us.user_id = u.user_id AND us.end_date >= $1
+        )
+    """,
+    "unsubscribed": """
+        SELECT u.user_id FROM users u
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_subscriptions us
+            WHERE us.user_id = u.user_id AND us.end_date >= $1
+        )
+    """,
+}
+
+# Запрос аудитории и его параметры
+def audience_query(target_group, skip_blocked: bool = False):
+    sql = AUDIENCE_SQL[target_group]
+    args = (datetime.now().date(),) if "$1" in sql else ()
+    if skip_blocked:
+        # Пользователи, заблокировавшие бота, всё равно не получат сообщение
+        sql = f"""
+            SELECT audience.user_id FROM ({sql}) AS audience
+            JOIN users b ON b.user_id = audience.user_id
+            WHERE b.blocked_at IS NULL
+        """
+    return sql, args
+
+# Потоковое чтение user_id: строки приходят пачками из курсора на стороне базы,
+# поэтому в памяти держится только одна пачка. Соединение занято, пока идёт перебор.
+async def stream_user_ids(sql, *args, chunk_size: int = None):
+    chunk_size = chunk_size or AUDIENCE_CHUNK_SIZE
+    async with acquire_db() as conn:
+        # Курсоры в PostgreSQL живут только внутри транзакции
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(sql, *args)
+            while True:
+                rows = await cursor.fetch(chunk_size)
+                if not rows:
+                    break
+                yield [row['user_id'] for row in rows]
+
+# Количество пользователей в аудитории (считается на стороне базы данных)
+async def count_audience(target_group):
+    sql, args = audience_query(target_group)
+    async with acquire_db() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM ({sql}) AS audience", *args)
+
+# Пересчёт сводной статистики: итоги и новые пользователи за последние дни
+async def refresh_stats_rollup():
+    today = datetime.now().date()
+    async with acquire_db() as conn:
+        async with conn.transaction():
+            await conn.execute(f"""
+                INSERT INTO bot_stats (id, total_users, active_subscribers, refreshed_at)
+                SELECT 1,
+                       (SELECT COUNT(*) FROM users),
+                       (SELECT COUNT(*) FROM ({AUDIENCE_SQL["subscribed"]}) AS audience),
+                       now()
+                ON CONFLICT (id) DO UPDATE
+                SET total_users = EXCLUDED.total_users,
+                    active_subscribers = EXCLUDED.active_subscribers,
+                    refreshed_at = EXCLUDED.refreshed_at
+            """, today)
+            await conn.execute("""
+                INSERT INTO bot_stats_daily (day, new_users)
+                SELECT created_at::date, COUNT(*)
+                FROM users
+                WHERE created_at >= $1
+                GROUP BY created_at::date
+                ON CONFLICT (day) DO UPDATE SET new_users = EXCLUDED.new_users
+            """, today - timedelta(days=STATS_BACKFILL_DAYS))
+
+# Сводная статистика из таблиц bot_stats и bot_stats_daily (без подсчёта по users)
+async def get_stats_rollup():
+    today = datetime.now().date()
+    async with acquire_db() as conn:
+        totals = await conn.fetchrow("SELECT * FROM bot_stats WHERE id = 1")
+        daily = await conn.fetchrow("""
+            SELECT COALESCE(SUM(new_users) FILTER (WHERE day = $1), 0) AS today,
+                   COALESCE(SUM(new_users) FILTER (WHERE day > $1 - 7), 0) AS week,
+                   COALESCE(SUM(new_users), 0) AS month
+            FROM bot_stats_daily
+            WHERE day > $1 - 30
+        """, today)
+    return totals, daily
+
+class UsageCounters:
+    """
+    Счётчики использования функций бота. Увеличение — просто запись в словарь
+    в памяти; раз в flush_interval секунд накопленное добавляется в таблицу
+    usage_counters по дням. Каждая запись попадает в случайный шард, чтобы
+    несколько процессов не упирались в одну строку.
+    """
 
-# Получение пользователей с активными подписками
-async def get_users_with_active_subscriptions():
-    conn = await connect_db()
-    try:
-        active_users = await conn.fetch("""
-            SELECT u.user_id
-            FROM users u
-            JOIN user_subscriptions us ON u.user_id = us.user_id
-            WHERE us.end_date > $1
-        """, datetime.now().date())
-        return active_users
-    finally:
-        await close_db(conn)
+    def __init__(self, flush_interval=USAGE_FLUSH_INTERVAL, shards=USAGE_COUNTER_SHARDS):
+        self.flush_interval = flush_interval
+        self.shards = shards
+        self.pending = {}
 
-# Получение всех пользователей
-async def get_all_users():
-    conn = await connect_db()
-    try:
-        users = await conn.fetch("SELECT user_id FROM users")  # Здесь предполагается, что таблица users имеет поле user_id
-        return users
-    finally:
-        await close_db(conn)
+    def increment(self, metric, amount=1):
+        key = (metric, datetime.now().date())
+        self.pending[key] = self.pending.get(key, 0) + amount
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        keys = list(batch)
+        try:
+            async with acquire_db() as conn:
+                await conn.execute("""
+                    INSERT INTO usage_counters (metric, day, shard, count)
+                    SELECT metric, day, $3::smallint, count
+                    FROM unnest($1::text[], $2::date[], $4::bigint[]) AS v(metric, day, count)
+                    ON CONFLICT (metric, day, shard) DO UPDATE
+                    SET count = usage_counters.count + EXCLUDED.count
+                """,
+                    [metric for metric, _ in keys],
+                    [day for _, day in keys],
+                    random.randrange(self.shards),
+                    [batch[key] for key in keys],
+                )
+        except BaseException:
+            # Возвращаем несохранённое обратно (в том числе если запись отменили при остановке)
+            for key, amount in batch.items():
+                self.pending[key] = self.pending.get(key, 0) + amount
+            raise
+
+    # Использование за сегодня, за 7 дней и за всё время (включая ещё не записанное)
+    async def totals(self, metric):
+        today = datetime.now().date()
+        async with acquire_db() as conn:
+            row = await conn.fetchrow("""
+                SELECT COALESCE(SUM(count) FILTER (WHERE day = $2), 0) AS today,
+                       COALESCE(SUM(count) FILTER (WHERE day > $2 - 7), 0) AS week,
+                       COALESCE(SUM(count), 0) AS total
+                FROM usage_counters
+                WHERE metric = $1
+            """, metric, today)
+        totals = dict(row)
+        for (pending_metric, day), amount in self.pending.items():
+            if pending_metric != metric:
+                continue
+            totals['total'] += amount
+            if day > today - timedelta(days=7):
+                totals['week'] += amount
+            if day == today:
+                totals['today'] += amount
+        return totals
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи счётчиков использования: {e}")
+
+usage_counters = UsageCounters()
+
+async def run_stats_refresh():
+    while True:
+        try:
+            await refresh_stats_rollup()
+        except Exception as e:
+            print(f"Ошибка обновления статистики: {e}")
+        await asyncio.sleep(STATS_REFRESH_INTERVAL)
 
 # Добавление новой подписки
 async def add_subscription_db(user_id, subscription_name, subscription_price, end_date):
-    conn = await connect_db()
-    await conn.execute("""
-        INSERT INTO user_subscriptions (user_id, subscription_name, subscription_price, end_date)
-        VALUES ($1, $2, $3, $4)
-    """, user_id, subscription_name, subscription_price, end_date)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute("""
+            INSERT INTO user_subscriptions (user_id, subscription_name, subscription_price, end_date)
+            VALUES ($1, $2, $3, $4)
+        """, user_id, subscription_name, subscription_price, end_date)
 
 async def delete_subscription(subscription_id):
-    conn = await connect_db()
-    await conn.execute("""
-        DELETE FROM user_subscriptions
-        WHERE id = $1
-    """, subscription_id)
-    await close_db(conn)
-
-async def get_user_subscriptions(user_id):
-    conn = await connect_db()
-    try:
-        # Получение данных из таблицы
-        user_subscriptions = await conn.fetch("""
-            SELECT * FROM user_subscriptions WHERE user_id = $1
-        """, user_id)
-    finally:
-        await close_db(conn)
-    return user_subscriptions
+    invalidate_user_cache()
+    async with acquire_db() as conn:
+        await conn.execute("""
+            DELETE FROM user_subscriptions
+            WHERE id = $1
+        """, subscription_id)
+
+db_queries.register("get_user_subscriptions", """
+    SELECT * FROM user_subscriptions WHERE user_id = $1
+""")
+
+async def get_user_subscriptions(user_id: int) -> list:
+    # Получение данных из таблицы
+    return await db_queries.fetch("get_user_subscriptions", user_id)
 
 async def update_reset_time(user_id, reset_time):
-    conn = await connect_db()
-    await conn.execute("""
-        UPDATE users
-        SET reset_time = $1
-        WHERE user_id = $2
-    """, reset_time, user_id)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute("""
+            UPDATE users
+            SET reset_time = $1
+            WHERE user_id = $2
+        """, reset_time, user_id)
 
 async def update_count_words(user_id, new_count):
     """
     Обновляет count_words для пользователя до указанного значения.
     """
-    conn = await connect_db()
-    await conn.execute("""
-        UPDATE users
-        SET count_words = $1
-        WHERE user_id = $2
-    """, new_count, user_id)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute("""
+            UPDATE users
+            SET count_words = $1
+            WHERE user_id = $2
+        """, new_count, user_id)
 
 async def increment_count_words(user_id):
     """
     Увеличивает count_words на 1 для пользователя.
     """
-    conn = await connect_db()
-    await conn.execute("""
-        UPDATE users
-        SET count_words = count_words + 1
-        WHERE user_id = $1
-    """, user_id)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute("""
+            UPDATE users
+            SET count_words = count_words + 1
+            WHERE user_id = $1
+        """, user_id)
 
 async def update_user_library_dict(user_id: int, library_json: str):
-    conn = await connect_db()
-    await conn.execute(
-        "UPDATE users SET library = $1 WHERE user_id = $2", 
-        library_json,  # Передаем сериализованный JSON
-        user_id
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute(
+            "UPDATE users SET library = $1 WHERE user_id = $2", 
+            library_json,  # Передаем сериализованный JSON
+            user_id
+        )
+
+# Результат проверки лимита сообщений в чате с ИИ
+@dataclass
+class QuotaVerdict:
+    allowed: bool
+    used: int
+    limit: int
+    reset_time: Optional[datetime] = None
+
+    # Сколько часов и минут осталось до сброса лимита
+    def time_left(self):
+        if self.reset_time is None:
+            return 0, 0
+        now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+        seconds = max(int((self.reset_time - now).total_seconds()), 0)
+        hours_left, remainder = divmod(seconds, 3600)
+        return hours_left, remainder // 60
+
+async def consume_chat_quota(user_id, limit, window_hours) -> Optional[QuotaVerdict]:
+    """
+    Атомарно проверяет и списывает одно сообщение из лимита чата с ИИ.
+    Сброс окна, увеличение счётчика и установка reset_time выполняются
+    одним UPDATE ... RETURNING, поэтому параллельные сообщения не гоняются.
+    """
+    now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)  # reset_time хранится без временной зоны
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        row = await conn.fetchrow("""
+            UPDATE users
+            SET count_words = CASE
+                    WHEN reset_time IS NOT NULL AND reset_time <= $2::timestamp THEN 1
+                    ELSE LEAST(COALESCE(count_words, 0) + 1, $3 + 1)
+                END,
+                reset_time = CASE
+                    WHEN reset_time IS NOT NULL AND reset_time <= $2::timestamp THEN NULL
+                    WHEN reset_time IS NULL AND COALESCE(count_words, 0) + 1 > $3
+                        THEN $2::timestamp + make_interval(hours => $4)
+                    ELSE reset_time
+                END
+            WHERE user_id = $1
+            RETURNING count_words, reset_time
+        """, user_id, now, limit, window_hours)
+    if row is None:
+        return None
+    return QuotaVerdict(
+        allowed=row['count_words'] <= limit,
+        used=row['count_words'],
+        limit=limit,
+        reset_time=row['reset_time'],
     )
-    await close_db(conn)
 
-# Обновление is_process_book пользователя в базе данных
+# Состояние лимитов одного пользователя в памяти (зеркало колонок таблицы users)
+class UserQuotaState:
+    def __init__(self, user):
+        self.count_words = user.get('count_words') or 0
+        self.reset_time = user.get('reset_time')
+        self.daily_book_count = user.get('daily_book_count') or 0
+        self.last_book_date = user.get('last_book_date')
+        self.last_seen = time.monotonic()
+
+class QuotaEngine:
+    """
+    Учёт лимитов чата с ИИ и книг в день в памяти процесса.
+    Каждый пользователь — «ведро» на limit сообщений, которое целиком
+    наполняется в reset_time. Решение принимается без обращения к базе,
+    а изменённые счётчики раз в flush_interval секунд записываются одним
+    пакетным UPDATE в колонки count_words, reset_time, daily_book_count
+    и last_book_date. Рассчитан на один процесс бота.
+    """
+
+    def __init__(self, flush_interval=QUOTA_FLUSH_INTERVAL, state_ttl=QUOTA_STATE_TTL):
+        self.flush_interval = flush_interval
+        self.state_ttl = state_ttl
+        self.states = {}
+        self.dirty = set()
+
+    def _state(self, user_id, user):
+        state = self.states.get(user_id)
+        if state is None:
+            state = self.states[user_id] = UserQuotaState(user)
+        state.last_seen = time.monotonic()
+        return state
+
+    # Подставляет в строку пользователя ещё не записанные в базу значения
+    def overlay(self, user):
+        state = self.states.get(user['user_id']) if user else None
+        if state is None:
+            return user
+        user = dict(user)
+        user['count_words'] = state.count_words
+        user['reset_time'] = state.reset_time
+        user['daily_book_count'] = state.daily_book_count
+        user['last_book_date'] = state.last_book_date
+        return user
+
+    def consume_chat(self, user_id, user, limit, window_hours) -> QuotaVerdict:
+        state = self._state(user_id, user)
+        now = datetime.now(MOSCOW_TZ).replace(tzinfo=None)
+        if state.reset_time is not None and state.reset_time <= now:
+            # Окно истекло — ведро снова полное, текущее сообщение первое
+            state.count_words = 1
+            state.reset_time = None
+        else:
+            used = state.count_words + 1
+            if state.reset_time is None and used > limit:
+                state.reset_time = now + timedelta(hours=window_hours)
+            state.count_words = min(used, limit + 1)
+        self.dirty.add(user_id)
+        return QuotaVerdict(
+            allowed=state.count_words <= limit,
+            used=state.count_words,
+            limit=limit,
+            reset_time=state.reset_time,
+        )
+
+    # Сколько книг пользователь создал сегодня (со сбросом счётчика в новый день)
+    def books_today(self, user_id, user):
+        state = self._state(user_id, user)
+        today = datetime.now().date()
+        last_book_date = state.last_book_date
+        if last_book_date is None or last_book_date.date() != today:
+            state.daily_book_count = 0
+            state.last_book_date = datetime.combine(today, datetime.min.time())
+            self.dirty.add(user_id)
+        return state.daily_book_count
+
+    def record_book(self, user_id, user):
+        self.books_today(user_id, user)
+        state = self.states[user_id]
+        state.daily_book_count += 1
+        self.dirty.add(user_id)
+        return state.daily_book_count
+
+    async def flush(self):
+        if not self.dirty:
+            self._evict_idle()
+            return 0
+        user_ids = list(self.dirty)
+        self.dirty.clear()
+        states = [self.states[user_id] for user_id in user_ids]
+        try:
+            async with acquire_db() as conn:
+                await conn.execute("""
+                    UPDATE users AS u
+                    SET count_words = v.count_words,
+                        reset_time = v.reset_time,
+                        daily_book_count = v.daily_book_count,
+                        last_book_date = v.last_book_date
+                    FROM unnest($1::bigint[], $2::int[], $3::timestamp[], $4::int[], $5::timestamp[])
+                        AS v(user_id, count_words, reset_time, daily_book_count, last_book_date)
+                    WHERE u.user_id = v.user_id
+                """,
+                    user_ids,
+                    [state.count_words for state in states],
+                    [state.reset_time for state in states],
+                    [state.daily_book_count for state in states],
+                    [state.last_book_date for state in states],
+                )
+        except BaseException:
+            # Не удалось записать или запись отменили при остановке — повторим при следующей записи
+            self.dirty.update(user_ids)
+            raise
+        self._evict_idle()
+        return len(user_ids)
+
+    # Убираем из памяти давно неактивных пользователей без несохранённых изменений
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.state_ttl
+        for user_id in [uid for uid, state in self.states.items() if state.last_seen < deadline and uid not in self.dirty]:
+            del self.states[user_id]
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи лимитов в базу данных: {e}")
+
+quota_engine = QuotaEngine() if QUOTA_ENGINE == "memory" else None
+
+class UserWriteBuffer:
+    """
+    Буфер мелких обновлений счётчиков таблицы users (daily_book_count,
+    last_book_date). Обновления одного пользователя склеиваются, а весь буфер
+    записывается одним UPDATE ... FROM unnest(...) не позже чем через delay
+    секунд после первой записи или сразу, если накопилось max_batch
+    пользователей. Запись всегда идёт одной задачей _flush_task. Если во время
+    записи пришли новые значения или запись не удалась, следующая запись
+    планируется сразу после неё. is_process_book сюда не попадает: по нему
+    проверяется повторный запуск книги, и он пишется в базу сразу.
+    """
+
+    COLUMNS = ('daily_book_count', 'last_book_date')
+
+    def __init__(self, delay=WRITE_BEHIND_DELAY, max_batch=WRITE_BEHIND_MAX_BATCH):
+        self.delay = delay
+        self.max_batch = max_batch
+        self.pending = {}
+        self.in_flight = {}
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        # Буфер заполнился — ждущая задача записывает не дожидаясь delay
+        self._full = asyncio.Event()
+        self.closing = False
+
+    def set(self, user_id, column, value):
+        self.pending.setdefault(user_id, {})[column] = value
+        self._schedule()
+
+    def _schedule(self):
+        if len(self.pending) >= self.max_batch:
+            self._full.set()
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.delay)
+        except asyncio.TimeoutError:
+            pass
+        self._full.clear()
+        await self._flush_logged()
+
+    async def _flush_logged(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"Ошибка отложенной записи пользователей: {e}")
+        # Значения, пришедшие во время записи или возвращённые после ошибки, ждут следующей записи
+        if self.pending and not self.closing:
+            task = self._flush_task
+            if task is None or task.done() or task is asyncio.current_task():
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    # Подставляет в строку пользователя ещё не записанные значения
+    def overlay(self, user):
+        if not user:
+            return user
+        entries = [entry for entry in (self.in_flight.get(user['user_id']), self.pending.get(user['user_id'])) if entry]
+        if not entries:
+            return user
+        user = dict(user)
+        for entry in entries:
+            for column in self.COLUMNS:
+                if column in entry:
+                    user[column] = entry[column]
+        return user
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            self.in_flight = batch
+            user_ids = list(batch)
+            try:
+                async with acquire_db() as conn:
+                    await conn.execute("""
+                        UPDATE users AS u
+                        SET daily_book_count = COALESCE(v.daily_book_count, u.daily_book_count),
+                            last_book_date = COALESCE(v.last_book_date, u.last_book_date)
+                        FROM unnest($1::bigint[], $2::int[], $3::timestamp[])
+                            AS v(user_id, daily_book_count, last_book_date)
+                        WHERE u.user_id = v.user_id
+                    """,
+                        user_ids,
+                        [batch[user_id].get('daily_book_count') for user_id in user_ids],
+                        [batch[user_id].get('last_book_date') for user_id in user_ids],
+                    )
+            except BaseException:
+                # Возвращаем пакет в буфер (в том числе при отмене), более новые значения важнее
+                for user_id, entry in batch.items():
+                    self.pending[user_id] = {**entry, **self.pending.get(user_id, {})}
+                raise
+            finally:
+                self.in_flight = {}
+            return len(user_ids)
+
+    async def close(self):
+        # Не отменяем идущую запись, а дожидаемся её: пакет в полёте не должен потеряться
+        self.closing = True
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+user_write_buffer = UserWriteBuffer() if WRITE_BEHIND_DELAY > 0 else None
+
+# Строка пользователя с учётом ещё не записанных в базу изменений
+def apply_pending_writes(user):
+    if user_write_buffer is not None:
+        user = user_write_buffer.overlay(user)
+    if quota_engine is not None:
+        user = quota_engine.overlay(user)
+    return user
+
+# Обновление is_process_book пользователя в базе данных (всегда сразу, без буфера:
+# по флагу проверяется повторный запуск книги, в том числе из других процессов)
 async def update_user_process_book(user_id, is_processing):
-    conn = await connect_db()
-    # Выполняем обновление в таблице users
-    await conn.execute("""
-        UPDATE users
-        SET is_process_book = $1
-        WHERE user_id = $2
-    """, is_processing, user_id)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        # Выполняем обновление в таблице users
+        await conn.execute("""
+            UPDATE users
+            SET is_process_book = $1
+            WHERE user_id = $2
+        """, is_processing, user_id)
 
 async def update_user_library(user_id: int):
-    conn = await connect_db()
-    await conn.execute(
-        "UPDATE users SET library = $1 WHERE user_id = $2", 
-        [],  # Пустой список (можно использовать JSON формат или другое представление)
-        user_id
-    )
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute(
+            "UPDATE users SET library = $1 WHERE user_id = $2", 
+            [],  # Пустой список (можно использовать JSON формат или другое представление)
+            user_id
+        )
 
 async def update_user_daily_book_count(user_id, new_count):
-    conn = await connect_db()
-    # Выполняем обновление в таблице users
-    await conn.execute("""
-        UPDATE users
-        SET daily_book_count = $1
-        WHERE user_id = $2
-    """, new_count, user_id)
-    await close_db(conn)
-
-# Создаем асинхронное подключение
-async def connect_db():
-    conn = await asyncpg.connect(**DB_CONFIG)
-    return conn
+    invalidate_user_cache(user_id)
+    if user_write_buffer is not None:
+        user_write_buffer.set(user_id, 'daily_book_count', new_count)
+        return
+    async with acquire_db() as conn:
+        # Выполняем обновление в таблице users
+        await conn.execute("""
+            UPDATE users
+            SET daily_book_count = $1
+            WHERE user_id = $2
+        """, new_count, user_id)
 
 # Обновление данных пользователя
 async def update_user_last_book_date(user_id, today_date):
-    conn = await connect_db()
-    # Выполняем обновление в таблице users
-    await conn.execute("""
-        UPDATE users
-        SET last_book_date = $1
-        WHERE user_id = $2
-    """, today_date, user_id)
-    await close_db(conn)
-
-# Закрытие соединения с базой данных
-async def close_db(conn):
-    await conn.close()
+    invalidate_user_cache(user_id)
+    if user_write_buffer is not None:
+        # Колонка last_book_date хранит дату со временем
+        if not isinstance(today_date, datetime):
+            today_date = datetime.combine(today_date, datetime.min.time())
+        user_write_buffer.set(user_id, 'last_book_date', today_date)
+        return
+    async with acquire_db() as conn:
+        # Выполняем обновление в таблице users
+        await conn.execute("""
+            UPDATE users
+            SET last_book_date = $1
+            WHERE user_id = $2
+        """, today_date, user_id)
 
 # Добавление нового пользователя в базу данных
 async def add_user(user_id, username):
-    conn = await connect_db()
-    await conn.execute("""
-        INSERT INTO users (user_id, username, daily_book_count, last_book_date, is_process_book, count_words, reset_time)
-        VALUES ($1, $2, 0, NULL, FALSE, 0, NULL)
-        ON CONFLICT (user_id) DO NOTHING
-    """, user_id, username)
-    await close_db(conn)
-
-async def update_user_daily_book_count(user_id, new_count):
-    conn = await connect_db()
-    # Выполняем обновление в таблице users
-    await conn.execute("""
-        UPDATE users
-        SET daily_book_count = $1
-        WHERE user_id = $2
-    """, new_count, user_id)
-    await close_db(conn)
+    invalidate_user_cache(user_id)
+    async with acquire_db() as conn:
+        await conn.execute("""
+            INSERT INTO users (user_id, username, daily_book_count, last_book_date, is_process_book, count_words, reset_time)
+            VALUES ($1, $2, 0, NULL, FALSE, 0, NULL)
+            ON CONFLICT (user_id) DO NOTHING
+        """, user_id, username)
+
+db_queries.register("user_exists", """
+    SELECT 1 FROM users WHERE user_id = $1
+""")
 
 # Проверка существования пользователя в базе данных
-async def user_exists(user_id):
-    conn = await connect_db()
-    row = await conn.fetchrow("""
-        SELECT 1 FROM users WHERE user_id = $1
-    """, user_id)
-    await close_db(conn)
+async def user_exists(user_id: int) -> bool:
+    cache = current_user_cache()
+    if cache is not None and cache.users.get(user_id) is not None:
+        count_saved_query()
+        return True
+    row = await db_queries.fetchrow("user_exists", user_id)
     return row is not None
 
+db_queries.register("get_user", """
+    SELECT * FROM users WHERE user_id = $1
+""")
+
 # Функция для получения пользователя из базы данных
-async def get_user(user_id):
-    conn = await connect_db()
-    user = await conn.fetchrow("""
-        SELECT * FROM users WHERE user_id = $1
-    """, user_id)
-    await close_db(conn)
+async def get_user(user_id: int):
+    cache = current_user_cache()
+    if cache is not None and user_id in cache.users:
+        count_saved_query()
+        return cache.users[user_id]
+    user = await db_queries.fetchrow("get_user", user_id)
+    user = apply_pending_writes(user)
+    if cache is not None:
+        cache.users[user_id] = user
     return user
 
 async def get_user_for_username(username):
-    conn = await connect_db()
-    user = await conn.fetchrow("""
-        SELECT * FROM users WHERE username = $1
-    """, username)
-    await close_db(conn)
+    async with acquire_db() as conn:
+        user = await conn.fetchrow("""
+            SELECT * FROM users WHERE username = $1
+        """, username)
     return user
 
+# Пользователь вместе с его подпиской: активной или, если её нет, последней истекшей
+@dataclass
+class UserContext:
+    user: dict
+    subscription: Optional[dict] = None
+    subscription_is_active: bool = False
+
+    @property
+    def user_id(self):
+        return self.user['user_id']
+
+    @property
+    def active_subscription(self):
+        return self.subscription if self.subscription_is_active else None
+
+    @property
+    def expired_subscription(self):
+        return self.subscription if not self.subscription_is_active else None
+
+db_queries.register("load_user_context", """
+    SELECT u.*,
+           s.id AS sub_id,
+           s.subscription_name AS sub_subscription_name,
+           s.subscription_price AS sub_subscription_price,
+           s.end_date AS sub_end_date,
+           s.end_date >= $2 AS sub_is_active
+    FROM users u
+    LEFT JOIN LATERAL (
+        SELECT id, subscription_name, subscription_price, end_date
+        FROM user_subscriptions
+        WHERE user_id = u.user_id
+        ORDER BY end_date >= $2 DESC, end_date DESC
+        LIMIT 1
+    ) s ON TRUE
+    WHERE u.user_id = $1
+""")
+
+# Загрузка пользователя и его подписки за один запрос к базе данных
+async def load_user_context(user_id) -> Optional[UserContext]:
+    cache = current_user_cache()
+    if cache is not None and user_id in cache.contexts:
+        count_saved_query()
+        return cache.contexts[user_id]
+    row = await db_queries.fetchrow("load_user_context", user_id, datetime.now().date())
+    if row is None:
+        if cache is not None:
+            cache.contexts[user_id] = None
+        return None
+
+    user = apply_pending_writes({key: value for key, value in row.items() if not key.startswith('sub_')})
+    subscription = None
+    if row['sub_id'] is not None:
+        subscription = {
+            "id": row['sub_id'],
+            "user_id": row['user_id'],
+            "subscription_name": row['sub_subscription_name'],
+            "subscription_price": row['sub_subscription_price'],
+            "end_date": row['sub_end_date'],
+        }
+    user_context = UserContext(user, subscription, bool(row['sub_is_active']))
+    if cache is not None:
+        cache.contexts[user_id] = user_context
+        cache.users[user_id] = user
+    return user_context
+
 async def generate_random_date_question_with_options_async():
     prompt = (
         "Напиши только один вопрос, который касается конкретной даты важного исторического события "
@@ -306,7 +1443,7 @@ async def generate_random_date_question_with_options_async():
         "Неправильные ответы: [Дата 1], [Дата 2]"
     )
 
-    response = await openai.ChatCompletion.acreate(
+    response = await openai_scheduler.create(
         model="gpt-3.5-turbo",
         messages=[{"role": "system", "content": "Ты помощник для создания вопросов викторин на русском языке."},
             {"role": "user", "content": prompt}],
@@ -338,7 +1475,7 @@ async def generate_random_quote_question_with_options_async():
         "Неправильные ответы: [Имя автора 1], [Имя автора 2]"
     )
 
-    response = await openai.ChatCompletion.acreate(
+    response = await openai_scheduler.create(
         model="gpt-4",
         messages=[
             {"role": "system", "content": "Ты помощник для создания вопросов викторин на русском языке."},
@@ -376,6 +1513,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Если пользователя нет в базе данных, добавляем его
         print(f'создаем нового пользователя в базе даных {user_id}')
         await add_user(user_id, username)
+    else:
+        # Пользователь мог разблокировать бота — снова включаем его в рассылки
+        await db_queries.execute("unblock_user", user_id)
 
     # Создаем меню
     await handle_menu(update, context)
@@ -526,1590 +1666,1981 @@ async def generate_options_menu(options, context):
 
     return InlineKeyboardMarkup(buttons)
 
+# Маршрутизация нажатий на inline-кнопки
+class CallbackRouter:
+    """
+    Маршрутизатор нажатий на inline-кнопки. callback_data ищется сначала
+    среди точных ключей (словарь), затем по самому длинному префиксу в
+    префиксном дереве, так что стоимость поиска не зависит от числа кнопок.
+    Для каждого маршрута считаются вызовы и время обработки.
+    """
+
+    # Ключ узла дерева, под которым хранится маршрут
+    ROUTE = object()
+
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.stats = {}
+
+    def route(self, *keys, prefixes=()):
+        def decorator(handler):
+            name = handler.__name__
+            self.stats[name] = QueryStats()
+            for key in keys:
+                if key in self.exact:
+                    raise ValueError(f"Кнопка {key} уже зарегистрирована")
+                self.exact[key] = handler
+            for prefix in prefixes:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                if self.ROUTE in node:
+                    raise ValueError(f"Префикс {prefix} уже зарегистрирован")
+                node[self.ROUTE] = handler
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        handler = self.exact.get(data)
+        if handler is not None:
+            return handler
+        node = self.trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            handler = node.get(self.ROUTE, handler)
+        return handler
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        data = update.callback_query.data or ""
+        handler = self.resolve(data)
+        if handler is None:
+            print(f"Нет обработчика для кнопки {data}")
+            return
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.stats[handler.__name__].record(time.perf_counter() - started, failed)
+
+    # Текстовый отчёт для админ панели
+    def report(self, limit=30):
+        lines = []
+        used = [item for item in self.stats.items() if item[1].calls]
+        for name, stats in sorted(used, key=lambda item: -item[1].total_time)[:limit]:
+            average = stats.total_time / stats.calls * 1000
+            lines.append(
+                f"{name.replace('callback_', '', 1)}: {stats.calls} выз., ср. {average:.0f} мс, макс. {stats.max_time * 1000:.0f} мс"
+                + (f", ошибок {stats.errors}" if stats.errors else "")
+            )
+        return "\n".join(lines)
+
+callback_router = CallbackRouter()
+
+@dataclass
+class TextMode:
+    handler: object
+    # Режим доступен только администраторам (проверяется до вызова обработчика)
+    admin_only: bool = False
+
+# Режимы ввода текста: context.user_data['current_mode'] -> обработчик
+class TextModeRegistry:
+    def __init__(self):
+        self.modes = {}
+
+    def mode(self, name, admin_only=False):
+        def decorator(handler):
+            if name in self.modes:
+                raise ValueError(f"Режим {name} уже зарегистрирован")
+            self.modes[name] = TextMode(handler, admin_only)
+            return handler
+        return decorator
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        mode = self.modes.get(context.user_data.get('current_mode'))
+        if mode is None:
+            await update.message.reply_text("Используйте /start для выбора режима.")
+            return
+        if mode.admin_only and update.message.from_user.id not in ADMINS:
+            await update.message.reply_text("У вас нет прав для доступа к админ панели.")
+            context.user_data['current_mode'] = None
+            return
+        await mode.handler(update, context)
+
+text_modes = TextModeRegistry()
+
 # Обработка кнопок внутри меню
 async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    await callback_router.dispatch(update, context)
 
-    if query.data == "my_library":
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("my_library", prefixes=("library_next_", "library_prev_"))
+async def callback_my_library(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Получаем список книг пользователя из базы данных
-        user_library = await get_user_library(user_id)
-        if user_library:
-            # Если у пользователя есть книги
-            books_list = "\n".join(
-                [f"{idx + 1}. {book['title']}" for idx, book in enumerate(user_library)]
-            )
-            library_text = f"📚 Ваши книги\n\n{books_list}\n\nВыберите книгу, чтобы выполнить действия с ней."
-            keyboard = [
-                [InlineKeyboardButton(book['title'], callback_data=f"book_options_{book['id']}")]
-                for book in user_library
-            ]
-        else:
-            # Если у пользователя нет книг
-            library_text = "📚 Ваша библиотека пуста. Добавьте книги через поиск!"
-            keyboard = [
-                [InlineKeyboardButton("📚 Поиск книг", callback_data="search_books")],
-            ]
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        # Добавляем кнопку "Назад"
-        keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")])
+    # Получаем страницу книг пользователя из базы данных
+    if query.data.startswith("library_next_"):
+        page = await get_user_library(user_id, after_id=int(query.data.split("_")[2]))
+    elif query.data.startswith("library_prev_"):
+        page = await get_user_library(user_id, before_id=int(query.data.split("_")[2]))
+    else:
+        page = await get_user_library(user_id)
+    library_text, keyboard = build_library_view(page)
 
-        # Формируем разметку и отправляем сообщение
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(library_text, reply_markup=reply_markup)
+    # Формируем разметку и отправляем сообщение
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(library_text, reply_markup=reply_markup)
 
-    elif query.data.startswith("book_options_"):
-        book_id = int(query.data.split("_")[2])  # Получаем id книги
-        user_id = query.from_user.id
-        user_books = await get_books_for_user(user_id)
+@callback_router.route(prefixes=("book_options_",))
+async def callback_book_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    book_id = int(query.data.split("_")[2])  # Получаем id книги
+    user_id = query.from_user.id
+    user_books = await get_books_for_user(user_id)
 
-        # Находим книгу по её id
-        selected_book = next((book for book in user_books if book['id'] == book_id), None)
+    # Находим книгу по её id
+    selected_book = next((book for book in user_books if book['id'] == book_id), None)
 
-        if not selected_book:
-            await query.edit_message_text("⚠️ Книга не найдена или удалена.")
-            return
+    if not selected_book:
+        await query.edit_message_text("⚠️ Книга не найдена или удалена.")
+        return
 
-        book_title = selected_book['title']
+    book_title = selected_book['title']
 
-        # Текст и кнопки для выбранной книги
-        options_text = f"📘 Вы выбрали книгу: {book_title}\n\nВыберите действие"
-        keyboard = [
-            [InlineKeyboardButton("📤 Прислать книгу в чат", callback_data=f"send_book_{book_id}")],
-            [InlineKeyboardButton("🗑 Удалить книгу", callback_data=f"delete_book_{book_id}")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="my_library")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Текст и кнопки для выбранной книги
+    options_text = f"📘 Вы выбрали книгу: {book_title}\n\nВыберите действие"
+    keyboard = [
+        [InlineKeyboardButton("📤 Прислать книгу в чат", callback_data=f"send_book_{book_id}")],
+        [InlineKeyboardButton("🗑 Удалить книгу", callback_data=f"delete_book_{book_id}")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="my_library")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await query.edit_message_text(options_text, reply_markup=reply_markup)
+    await query.edit_message_text(options_text, reply_markup=reply_markup)
 
-    elif query.data.startswith("delete_book_"):
-        user_id = query.from_user.id
-        book_id = int(query.data.split("_")[2])  # Получаем ID книги из callback_data
-        user = await get_user(user_id)
+@callback_router.route(prefixes=("delete_book_",))
+async def callback_delete_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    book_id = int(query.data.split("_")[2])  # Получаем ID книги из callback_data
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        # Получаем книги пользователя из базы данных
-        books = await get_books_for_user(user_id)
+    # Получаем книги пользователя из базы данных
+    books = await get_books_for_user(user_id)
 
-        # Ищем книгу по ее ID
-        selected_book = next((book for book in books if book['id'] == book_id), None)
+    # Ищем книгу по ее ID
+    selected_book = next((book for book in books if book['id'] == book_id), None)
 
-        if not selected_book:
-            await query.edit_message_text("⚠️ Книга не найдена.")
-            return
+    if not selected_book:
+        await query.edit_message_text("⚠️ Книга не найдена.")
+        return
 
-        file_path = selected_book['path']  # Путь к файлу
-        book_title = selected_book['title']
+    file_path = selected_book['path']  # Путь к файлу
+    book_title = selected_book['title']
 
-        # Удаляем файл книги, если он существует
-        try:
-            os.remove(file_path)  # Удаляем файл из папки media
-        except FileNotFoundError:
-            pass  # Если файл уже отсутствует, продолжаем
+    # Удаляем файл книги, если он существует
+    try:
+        os.remove(file_path)  # Удаляем файл из папки media
+    except FileNotFoundError:
+        pass  # Если файл уже отсутствует, продолжаем
 
-        # Удаляем книгу из базы данных
-        await delete_book_from_db(book_id)
+    # Удаляем книгу из базы данных
+    await delete_book_from_db(book_id)
 
-        # Обновляем список книг пользователя
-        books = await get_books_for_user(user_id)
-        
-        # Формируем текст и кнопки для обновленного списка книг
-        if books:
-            books_list = "\n".join([f"{idx + 1}. {book['title']}" for idx, book in enumerate(books)])
-            library_text = f"📚 Ваши книги\n\n{books_list}\n\nВыберите книгу, чтобы выполнить действия с ней"
-            keyboard = [
-                [InlineKeyboardButton(book['title'], callback_data=f"book_options_{book['id']}")]
-                for book in books
-            ]
-            keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")])
-        else:
-            library_text = "📚 Ваша библиотека пуста. Добавьте книги через поиск!"
-            keyboard = [
-                [InlineKeyboardButton("📚 Поиск книг", callback_data="search_books")],
-                [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-            ]
+    # Обновляем список книг пользователя (первая страница)
+    page = await get_user_library(user_id)
+    _, keyboard = build_library_view(page)
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        # Отправляем сообщение об успешном удалении книги
-        await query.edit_message_text(
-            f"🗑 Книга '{book_title}' была успешно удалена из вашей библиотеки.",
-            reply_markup=reply_markup
-        )
+    # Отправляем сообщение об успешном удалении книги
+    await query.edit_message_text(
+        f"🗑 Книга '{book_title}' была успешно удалена из вашей библиотеки.",
+        reply_markup=reply_markup
+    )
 
-    elif query.data.startswith("send_book_"):
-        user_id = query.from_user.id
-        book_id = int(query.data.split("_")[2])  # Получаем ID книги из callback_data
-        user = await get_user(user_id)
+@callback_router.route(prefixes=("send_book_",))
+async def callback_send_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    book_id = int(query.data.split("_")[2])  # Получаем ID книги из callback_data
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        # Получаем книги пользователя из базы данных
-        books = await get_books_for_user(user_id)
+    # Получаем книги пользователя из базы данных
+    books = await get_books_for_user(user_id)
 
-        # Ищем книгу по ее ID
-        selected_book = next((book for book in books if book['id'] == book_id), None)
+    # Ищем книгу по ее ID
+    selected_book = next((book for book in books if book['id'] == book_id), None)
 
-        if not selected_book:
-            await query.edit_message_text("⚠️ Книга не найдена.")
-            return
+    if not selected_book:
+        await query.edit_message_text("⚠️ Книга не найдена.")
+        return
 
-        file_path = selected_book['path']  # Путь к файлу
-        book_title = selected_book['title']
+    file_path = selected_book['path']  # Путь к файлу
+    book_title = selected_book['title']
 
-        # Проверяем, существует ли файл по пути
-        try:
-            # Отправляем книгу пользователю
-            with open(file_path, 'rb') as file:
-                await query.message.reply_document(document=file, filename=f"{book_title}.pdf")
-        except FileNotFoundError:
-            await query.edit_message_text("⚠️ Файл книги не найден. Обратитесь к администратору.")
-            return
+    # Проверяем, существует ли файл по пути
+    try:
+        # Отправляем книгу пользователю
+        with open(file_path, 'rb') as file:
+            await query.message.reply_document(document=file, filename=f"{book_title}.pdf")
+    except FileNotFoundError:
+        await query.edit_message_text("⚠️ Файл книги не найден. Обратитесь к администратору.")
+        return
 
-        # Сообщение об успешной отправке
-        await query.edit_message_text(
-            f"📤 Книга {book_title} успешно отправлена в чат!\n\n",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="my_library")]])
-        )
+    # Сообщение об успешной отправке
+    await query.edit_message_text(
+        f"📤 Книга {book_title} успешно отправлена в чат!\n\n",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="my_library")]])
+    )
+
+@callback_router.route("menu")
+async def callback_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-    elif query.data == "menu":
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Возврат в меню
+    await handle_menu(update, context)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Возврат в меню
-        await handle_menu(update, context)
-    
-    elif query.data == "subscriptions_menu":
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+@callback_router.route("subscriptions_menu")
+async def callback_subscriptions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
+    if not user_context:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    if not user_context.subscription:
+        # Если подписок нет
+        subscription_status = "⚪️ Нет подписки"
+        subscription_text = "❌ У вас нет подписки.\n💸 Оформите подписку, чтобы получить доступ к функциям."
+    else:
+        # Проверяем активные и истекшие подписки
+        active_subscription = user_context.active_subscription
+        expired_subscription = user_context.expired_subscription
 
-        # Получаем подписки пользователя
-        user_subscriptions = await get_user_subscriptions(user_id)
-        if not user_subscriptions:
+        if active_subscription:
+            # Если есть активная подписка
+            subscription_status = "🟢 Подписка активна"
+            subscription_text = f"✅ Ваша подписка '{active_subscription['subscription_name']}' активна до {active_subscription['end_date'].strftime('%d.%m.%Y')}."
+        elif expired_subscription:
+            # Если есть истекшая подписка
+            subscription_status = "🔴 Подписка истекла"
+            subscription_text = f"❌ Ваша подписка '{expired_subscription['subscription_name']}' истекла {expired_subscription['end_date'].strftime('%d.%m.%Y')}.\n💸 Оформите новую подписку."
+        else:
             # Если подписок нет
             subscription_status = "⚪️ Нет подписки"
             subscription_text = "❌ У вас нет подписки.\n💸 Оформите подписку, чтобы получить доступ к функциям."
-        else:
-            # Проверяем активные и истекшие подписки
-            active_subscription = next(
-                (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-                None
-            )
-            expired_subscription = next(
-                (sub for sub in user_subscriptions if sub["end_date"] < datetime.now().date()), 
-                None
-            )
-
-            if active_subscription:
-                # Если есть активная подписка
-                subscription_status = "🟢 Подписка активна"
-                subscription_text = f"✅ Ваша подписка '{active_subscription['subscription_name']}' активна до {active_subscription['end_date'].strftime('%d.%m.%Y')}."
-            elif expired_subscription:
-                # Если есть истекшая подписка
-                subscription_status = "🔴 Подписка истекла"
-                subscription_text = f"❌ Ваша подписка '{expired_subscription['subscription_name']}' истекла {expired_subscription['end_date'].strftime('%d.%m.%Y')}.\n💸 Оформите новую подписку."
-            else:
-                # Если подписок нет
-                subscription_status = "⚪️ Нет подписки"
-                subscription_text = "❌ У вас нет подписки.\n💸 Оформите подписку, чтобы получить доступ к функциям."
 
-        # Генерация клавиатуры с обновленным текстом
-        subscriptions_keyboard = [
-            [InlineKeyboardButton(subscription_status, callback_data="active_subscription")],
-            [InlineKeyboardButton("📚 Все подписки", callback_data="subscriptions")],
-            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(subscriptions_keyboard)
+    # Генерация клавиатуры с обновленным текстом
+    subscriptions_keyboard = [
+        [InlineKeyboardButton(subscription_status, callback_data="active_subscription")],
+        [InlineKeyboardButton("📚 Все подписки", callback_data="subscriptions")],
+        [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(subscriptions_keyboard)
 
-        # Отображение сообщения с выбором
-        await query.edit_message_text(
-            f"{subscription_text}\n\n✨ Выберите действие:",
-            reply_markup=reply_markup
-        )
+    # Отображение сообщения с выбором
+    await query.edit_message_text(
+        f"{subscription_text}\n\n✨ Выберите действие:",
+        reply_markup=reply_markup
+    )
 
-    elif query.data == "active_subscription":
-        # Идентификатор пользователя
-        user_id = query.from_user.id
+@callback_router.route("active_subscription")
+async def callback_active_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Идентификатор пользователя
+    user_id = query.from_user.id
 
-        # Получаем данные пользователя
-        user = await get_user(user_id)
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Получаем данные пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
+    if not user_context:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        # Получаем подписки пользователя из базы данных
-        user_subscriptions = await get_user_subscriptions(user_id)
+    if not user_context.subscription:
+        # Если подписок нет
+        message = "⚠️ У вас пока нет подписки."
+    else:
+        # Ищем активную подписку
+        active_subscription = user_context.active_subscription
 
-        if not user_subscriptions:
-            # Если подписок нет
-            message = "⚠️ У вас пока нет подписки."
+        if active_subscription:
+            # Если подписка активна
+            end_date_str = active_subscription["end_date"].strftime('%d.%m.%Y')
+            message = (
+                f"🟢 У вас активная подписка: {active_subscription['subscription_name']}\n"
+                f"💰 Цена: {active_subscription['subscription_price']} руб.\n"
+                f"📅 Действует до: {end_date_str}"
+            )
         else:
-            # Ищем активную подписку
-            active_subscription = next(
-                (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-                None
+            # Если активной подписки нет (все истекли)
+            expired_subscription = user_context.expired_subscription  # Последняя истекшая подписка
+            message = (
+                f"❌ Ваша подписка '{expired_subscription['subscription_name']}' истекла.\n"
+                f"💰 Цена была: {expired_subscription['subscription_price']} руб.\n"
+                f"📅 Срок действия истек: {expired_subscription['end_date'].strftime('%d.%m.%Y')}\n"
+                "💸 Оформите новую подписку, чтобы продолжить пользоваться сервисом."
             )
 
-            if active_subscription:
-                # Если подписка активна
-                end_date_str = active_subscription["end_date"].strftime('%d.%m.%Y')
-                message = (
-                    f"🟢 У вас активная подписка: {active_subscription['subscription_name']}\n"
-                    f"💰 Цена: {active_subscription['subscription_price']} руб.\n"
-                    f"📅 Действует до: {end_date_str}"
-                )
-            else:
-                # Если активной подписки нет (все истекли)
-                expired_subscription = max(
-                    user_subscriptions, 
-                    key=lambda sub: sub["end_date"]
-                )  # Берем последнюю истекшую подписку
-                message = (
-                    f"❌ Ваша подписка '{expired_subscription['subscription_name']}' истекла.\n"
-                    f"💰 Цена была: {expired_subscription['subscription_price']} руб.\n"
-                    f"📅 Срок действия истек: {expired_subscription['end_date'].strftime('%d.%m.%Y')}\n"
-                    "💸 Оформите новую подписку, чтобы продолжить пользоваться сервисом."
-                )
-
-        # Кнопка "Назад"
-        back_button = [[InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")]]
-        reply_markup = InlineKeyboardMarkup(back_button)
-
-        # Отправляем сообщение
-        await query.edit_message_text(message, reply_markup=reply_markup)
+    # Кнопка "Назад"
+    back_button = [[InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")]]
+    reply_markup = InlineKeyboardMarkup(back_button)
 
-    elif query.data == "subscriptions":
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение
+    await query.edit_message_text(message, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверяем, есть ли подписки
-        if not subscriptions:
-            # Если подписок нет
-            no_subscriptions_keyboard = [
-                [InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")]
-            ]
-            reply_markup = InlineKeyboardMarkup(no_subscriptions_keyboard)
-            await query.edit_message_text("⚠️ Подписок пока нет", reply_markup=reply_markup)
-        else:
-            # Генерация клавиатуры с подписками
-            subscriptions_keyboard = [
-                [InlineKeyboardButton(sub["name"], callback_data=f"view_{sub['name']}")] for sub in subscriptions
-            ]
-            # Добавляем кнопку "Обратно"
-            subscriptions_keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")])
-            reply_markup = InlineKeyboardMarkup(subscriptions_keyboard)
-            await query.edit_message_text("✨ Выберите подписку", reply_markup=reply_markup)
-    
-    elif query.data.startswith("view_"):
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Просмотр информации о выбранной подписке
-        subscription_name = query.data[5:]  # Получаем название подписки
-        
-        # Поиск подписки в списке
-        selected_subscription = next(
-            (sub for sub in subscriptions if sub["name"] == subscription_name), None
-        )
-        
-        if selected_subscription:
-            price = selected_subscription["price"]
-            duration_days = 30  # Срок подписки в днях
-            end_date = datetime.now() + timedelta(days=duration_days)
-            # Формирование красивого сообщения
-            message = (
-                f"📝 Оформление Подписки\n\n"
-                f"✨ Подписка: {subscription_name}\n"
-                f"⏳ Срок действия: {duration_days} дней\n"
-                f"💰 Цена: {price} руб.\n"
-                f"📅 Закончится: {end_date.strftime('%d.%m.%Y')}\n\n"
-                "🔑 Оформите подписку, чтобы получить доступ ко всем возможностям!"
-            )
-            
-            # Клавиатура
-            keyboard = [
-                [InlineKeyboardButton("💸 Оформить подписку", callback_data=f"buy_{subscription_name}")],
-                [InlineKeyboardButton("🔙 Назад к подпискам", callback_data="subscriptions")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            # Отправляем сообщение
-            await query.edit_message_text(message, parse_mode="Markdown", reply_markup=reply_markup)
-        else:
-            await query.edit_message_text("❌ Подписка не найдена.")
-    
-    # Покупка подписки
-    elif query.data.startswith("buy_"):
-        user_id = query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Извлекаем название подписки
-        subscription_name = query.data.replace("buy_", "")
-        
-        # Проверяем, есть ли активная подписка
-        user_subscriptions = await get_user_subscriptions(user_id)
-        # Проверяем активные и истекшие подписки
-        active_subscription = next(
-            (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-            None
-        )
-        if active_subscription:
-            # Если есть активная подписка, выводим сообщение и выходим
-            await query.edit_message_text(
-                f"⚠️ У вас уже есть активная подписка: {active_subscription['subscription_name']}.\n"
-                f"📅 Действующая до {active_subscription['end_date'].strftime('%d.%m.%Y')}.\n\n"
-                "Вы не можете купить новую подписку, пока не истечёт текущая.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-                ])
-            )
-            return
-        else:
-            # Удаляем подписку, если она истекла
-            expired_subscription = next(
-                (sub for sub in user_subscriptions if sub["end_date"] < datetime.now().date()), 
-                None
-            )
-            if expired_subscription:
-                # Удаляем подписку из списка
-                await delete_subscription(user_id)
-                print('удаляем истекшую подписку чтоб добавить новую')
-
-        # Поиск подписки в списке
-        selected_subscription = next(
-            (sub for sub in subscriptions if sub["name"] == subscription_name), None
-        )
-        
-        if selected_subscription:
-            subscription_price = selected_subscription["price"]
-
-            # Генерация ссылки на оплату через Юкассу
-            payment = Payment.create({
-                "amount": {
-                    "value": f"{subscription_price:.2f}",
-                    "currency": "RUB"
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": "https://t.me/FastPage_Bot"  # Укажите реальный URL возврата
-                },
-                "capture": True,
-                "description": f"Оплата подписки: {subscription_name}"
-            }, uuid.uuid4())
-
-            # Ссылка на оплату
-            payment_url = payment.confirmation.confirmation_url
-
-            await query.edit_message_text(
-                f"💡 **Для активации подписки '{subscription_name}' выполните следующие шаги:**\n\n"
-                f"1️⃣ Нажмите на кнопку 💳 **Оплатить** ниже и перейдите на сайт оплаты.\n"
-                f"3️⃣ После успешной оплаты подписка будет активна!\n\n"
-                f"⏳ *Ожидается подтверждение оплаты...*\n"
-                f"Если вы передумали, **🔙 Назад в меню**.",
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💳 Оплатить", url=payment_url)],  # Кнопка для перехода на оплату
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]  # Кнопка возврата в меню
-                ])
-            )
-            # Асинхронная проверка статуса платежа
-            payment_id = payment.id
-            asyncio.create_task(check_payment_status(payment_id, user_id, subscription_name, subscription_price, query))
-    
-        else:
-            await query.edit_message_text("Подписка не найдена")
-
-    elif query.data == "admin_panel":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("subscriptions")
+async def callback_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
-            return
-        # Админ панель
-        # Проверка на админа
-        user_id = update.callback_query.from_user.id  # Получаем ID пользователя
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели")
-            return
-        admin_keyboard = [
-            [InlineKeyboardButton("👥 Управление пользователями", callback_data="users_admin")],
-            [InlineKeyboardButton("💳 Управление подписками", callback_data="manage_subscriptions")],
-            [InlineKeyboardButton("🔔 Уведомления", callback_data="notifications")],
-            [InlineKeyboardButton("📈 Cтатистика ", callback_data="statistic")],
-            [InlineKeyboardButton("⚙️ Режимы", callback_data="modes_admin")],
-            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверяем, есть ли подписки
+    if not subscriptions:
+        # Если подписок нет
+        no_subscriptions_keyboard = [
+            [InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")]
         ]
-        reply_markup = InlineKeyboardMarkup(admin_keyboard)
-        await query.edit_message_text("Админ панель", reply_markup=reply_markup)
-
-    elif query.data == "statistic":
-        user_id = update.callback_query.from_user.id
-        context.user_data['current_mode'] = None
-        # Ищем пользователя
-        user = await get_user(user_id)
+        reply_markup = InlineKeyboardMarkup(no_subscriptions_keyboard)
+        await query.edit_message_text("⚠️ Подписок пока нет", reply_markup=reply_markup)
+    else:
+        # Генерация клавиатуры с подписками
+        subscriptions_keyboard = [
+            [InlineKeyboardButton(sub["name"], callback_data=f"view_{sub['name']}")] for sub in subscriptions
+        ]
+        # Добавляем кнопку "Обратно"
+        subscriptions_keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="subscriptions_menu")])
+        reply_markup = InlineKeyboardMarkup(subscriptions_keyboard)
+        await query.edit_message_text("✨ Выберите подписку", reply_markup=reply_markup)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
-            return
+@callback_router.route(prefixes=("view_",))
+async def callback_view(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        # Проверка на админа
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для доступа к админ панели")
-            return
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Просмотр информации о выбранной подписке
+    subscription_name = query.data[5:]  # Получаем название подписки
 
-        # Клавиатура для управления пользователями
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("👥 Пользователей всего", callback_data="all_users")],
-            [InlineKeyboardButton("🔑 Пользователи с подписками", callback_data="subscribed_users")],
-            [InlineKeyboardButton("🚫 Пользователи без подписками", callback_data="unsubscribed_users")],
-            [InlineKeyboardButton("🤖 Сколько раз использовали: Чат с ИИ", callback_data="static_chat_ai")],
-            [InlineKeyboardButton("📚 Сколько раз использовали: Поиск книг", callback_data="static_search_book")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        await query.edit_message_text("Выберите действие", reply_markup=reply_markup)
-
-    elif query.data == "static_search_book":
-        # Получаем количество раз, когда использовался поиск книг
-       
-        # Формируем сообщение с количеством использований поиска книг
-        text = f"📚 Поиск книг использовался {count_search_book} раз(а)."
-
-        # Клавиатура с кнопкой "Назад"
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        
-        # Отправляем сообщение
-        await query.edit_message_text(text, reply_markup=reply_markup)
+    # Поиск подписки в списке
+    selected_subscription = next(
+        (sub for sub in subscriptions if sub["name"] == subscription_name), None
+    )
 
-    elif query.data == "static_chat_ai":
-        # Получаем количество раз, когда использовался чат с ИИ
-        
-        # Формируем сообщение с количеством использований чата с ИИ
-        text = f"🤖 Чат с ИИ использовался {count_chat_ai} раз(а)."
+    if selected_subscription:
+        price = selected_subscription["price"]
+        duration_days = 30  # Срок подписки в днях
+        end_date = datetime.now() + timedelta(days=duration_days)
+        # Формирование красивого сообщения
+        message = (
+            f"📝 Оформление Подписки\n\n"
+            f"✨ Подписка: {subscription_name}\n"
+            f"⏳ Срок действия: {duration_days} дней\n"
+            f"💰 Цена: {price} руб.\n"
+            f"📅 Закончится: {end_date.strftime('%d.%m.%Y')}\n\n"
+            "🔑 Оформите подписку, чтобы получить доступ ко всем возможностям!"
+        )
 
-        # Клавиатура с кнопкой "Назад"
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+        # Клавиатура
+        keyboard = [
+            [InlineKeyboardButton("💸 Оформить подписку", callback_data=f"buy_{subscription_name}")],
+            [InlineKeyboardButton("🔙 Назад к подпискам", callback_data="subscriptions")]
         ]
-        
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
         # Отправляем сообщение
-        await query.edit_message_text(text, reply_markup=reply_markup)
+        await query.edit_message_text(message, parse_mode="Markdown", reply_markup=reply_markup)
+    else:
+        await query.edit_message_text("❌ Подписка не найдена.")
 
-    elif query.data == "all_users":
-        # Получаем общее количество пользователей
-        total_users = len(await get_all_users())
+# Покупка подписки
+@callback_router.route(prefixes=("buy_",))
+async def callback_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+    # Ищем пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
 
-        # Формируем сообщение и клавиатуру с кнопками
-        text = f"👥 Всего пользователей в боте: {total_users}"
-        
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        
-        # Отправляем сообщение с количеством пользователей и клавиатурой
-        await query.edit_message_text(text, reply_markup=reply_markup)
+    if not user_context:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Извлекаем название подписки
+    subscription_name = query.data.replace("buy_", "")
 
-    elif query.data == "subscribed_users":
-        # Получаем общее количество пользователей с подписками
-        total_subscribed_users = len(await get_users_with_active_subscriptions())
+    # Проверяем, есть ли активная подписка
+    active_subscription = user_context.active_subscription
+    if active_subscription:
+        # Если есть активная подписка, выводим сообщение и выходим
+        await query.edit_message_text(
+            f"⚠️ У вас уже есть активная подписка: {active_subscription['subscription_name']}.\n"
+            f"📅 Действующая до {active_subscription['end_date'].strftime('%d.%m.%Y')}.\n\n"
+            "Вы не можете купить новую подписку, пока не истечёт текущая.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+            ])
+        )
+        return
+    else:
+        # Удаляем подписку, если она истекла
+        expired_subscription = user_context.expired_subscription
+        if expired_subscription:
+            # Удаляем подписку из списка
+            await delete_subscription(expired_subscription['id'])
+            print('удаляем истекшую подписку чтоб добавить новую')
+
+    # Поиск подписки в списке
+    selected_subscription = next(
+        (sub for sub in subscriptions if sub["name"] == subscription_name), None
+    )
 
-        # Формируем сообщение и клавиатуру с кнопками
-        text = f"🔑 Пользователи с подписками: {total_subscribed_users}"
-        
-        # Клавиатура с кнопкой "Назад"
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        
-        # Отправляем сообщение с количеством пользователей и клавиатурой
-        await query.edit_message_text(text, reply_markup=reply_markup)
+    if selected_subscription:
+        subscription_price = selected_subscription["price"]
+
+        # Генерация ссылки на оплату через Юкассу
+        payment = Payment.create({
+            "amount": {
+                "value": f"{subscription_price:.2f}",
+                "currency": "RUB"
+            },
+            "confirmation": {
+                "type": "redirect",
+                "return_url": "https://t.me/FastPage_Bot"  # Укажите реальный URL возврата
+            },
+            "capture": True,
+            "description": f"Оплата подписки: {subscription_name}"
+        }, uuid.uuid4())
+
+        # Ссылка на оплату
+        payment_url = payment.confirmation.confirmation_url
 
-    elif query.data == "unsubscribed_users":
-        # Находим пользователей без подписки (вычитаем из списка всех пользователей тех, кто есть в user_subscriptions)
-        unsubscribed_users = await get_users_without_subscriptions()
+        await query.edit_message_text(
+            f"💡 **Для активации подписки '{subscription_name}' выполните следующие шаги:**\n\n"
+            f"1️⃣ Нажмите на кнопку 💳 **Оплатить** ниже и перейдите на сайт оплаты.\n"
+            f"3️⃣ После успешной оплаты подписка будет активна!\n\n"
+            f"⏳ *Ожидается подтверждение оплаты...*\n"
+            f"Если вы передумали, **🔙 Назад в меню**.",
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 Оплатить", url=payment_url)],  # Кнопка для перехода на оплату
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]  # Кнопка возврата в меню
+            ])
+        )
+        # Асинхронная проверка статуса платежа
+        payment_id = payment.id
+        asyncio.create_task(check_payment_status(payment_id, user_id, subscription_name, subscription_price, query))
 
-        # Получаем общее количество пользователей без подписок
-        total_unsubscribed_users = len(unsubscribed_users)
+    else:
+        await query.edit_message_text("Подписка не найдена")
 
-        # Формируем сообщение и клавиатуру с кнопками
-        text = f"🚫 Пользователи без подписок: {total_unsubscribed_users}"
+@callback_router.route("admin_panel")
+async def callback_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        # Клавиатура с кнопкой "Назад"
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        
-        # Отправляем сообщение с количеством пользователей и клавиатурой
-        await query.edit_message_text(text, reply_markup=reply_markup)
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
+        return
+    # Админ панель
+    # Проверка на админа
+    user_id = update.callback_query.from_user.id  # Получаем ID пользователя
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
+    admin_keyboard = [
+        [InlineKeyboardButton("👥 Управление пользователями", callback_data="users_admin")],
+        [InlineKeyboardButton("💳 Управление подписками", callback_data="manage_subscriptions")],
+        [InlineKeyboardButton("🔔 Уведомления", callback_data="notifications")],
+        [InlineKeyboardButton("📈 Cтатистика ", callback_data="statistic")],
+        [InlineKeyboardButton("⚙️ Режимы", callback_data="modes_admin")],
+        [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_keyboard)
+    await query.edit_message_text("Админ панель", reply_markup=reply_markup)
 
-    elif query.data == "users_admin":
-        user_id = update.callback_query.from_user.id
-        context.user_data['current_mode'] = None
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("statistic")
+async def callback_statistic(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    context.user_data['current_mode'] = None
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
-            return
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
+        return
 
-        # Проверка на админа
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для доступа к админ панели")
-            return
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        # Клавиатура для управления пользователями
-        admin_user_management_keyboard = [
-            [InlineKeyboardButton("🔍 Найти пользователя", callback_data="search_user")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
-        await query.edit_message_text("Выберите действие с пользователями", reply_markup=reply_markup)
+    # Клавиатура для управления пользователями
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("👥 Пользователей всего", callback_data="all_users")],
+        [InlineKeyboardButton("🔑 Пользователи с подписками", callback_data="subscribed_users")],
+        [InlineKeyboardButton("🚫 Пользователи без подписками", callback_data="unsubscribed_users")],
+        [InlineKeyboardButton("🤖 Сколько раз использовали: Чат с ИИ", callback_data="static_chat_ai")],
+        [InlineKeyboardButton("📚 Сколько раз использовали: Поиск книг", callback_data="static_search_book")],
+        [InlineKeyboardButton("🗄 Кэш пользователей", callback_data="static_user_cache")],
+        [InlineKeyboardButton("⏱ Запросы к базе данных", callback_data="static_db_queries")],
+        [InlineKeyboardButton("🧭 Обработчики кнопок", callback_data="static_callback_routes")],
+        [InlineKeyboardButton("🔐 Очереди пользователей", callback_data="static_user_locks")],
+        [InlineKeyboardButton("🧠 Запросы к OpenAI", callback_data="static_openai")],
+        [InlineKeyboardButton("🔄 Пересчитать статистику", callback_data="refresh_statistic")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
+
+    # Сводка из заранее посчитанной статистики
+    totals, daily = await get_stats_rollup()
+    if totals:
+        text = (
+            "📈 Статистика\n\n"
+            f"👥 Пользователей всего: {totals['total_users']}\n"
+            f"🔑 С активной подпиской: {totals['active_subscribers']}\n"
+            f"🚫 Без подписки: {totals['total_users'] - totals['active_subscribers']}\n"
+            f"🆕 Новых сегодня: {daily['today']}, за 7 дней: {daily['week']}, за 30 дней: {daily['month']}\n\n"
+            f"🕒 Обновлено: {totals['refreshed_at'].strftime('%d.%m.%Y %H:%M')}\n\n"
+            "Выберите действие"
+        )
+    else:
+        text = "📈 Статистика ещё собирается.\n\nВыберите действие"
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-    elif query.data == "search_user":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("refresh_statistic")
+async def callback_refresh_statistic(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
-            return
-        # Управление подписками (для админа)
-        # Проверка на админа
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для доступа к админ панели")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="users_admin")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        context.user_data['current_mode'] = 'search_user'
-        await query.edit_message_text(
-            "🔍 Пожалуйста, укажите **user_id** или **username** пользователя, которого хотите найти.\n"
-            "Пример: \n"
-            "- Для поиска по **user_id**: просто введите его число.\n"
-            "- Для поиска по **username**: введите имя_пользователя.\n"
-            "🔎 Мы постараемся найти этого пользователя для вас.",
-            reply_markup=reply_markup
-        )
+    await refresh_stats_rollup()
+    await query.edit_message_text(
+        "✅ Статистика пересчитана.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="statistic")]])
+    )
 
-    elif query.data == "notifications":
-        user_id = update.callback_query.from_user.id
-        context.user_data['current_mode'] = None
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("static_search_book")
+async def callback_static_search_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Получаем количество раз, когда использовался поиск книг
+
+    # Формируем сообщение с количеством использований поиска книг
+    usage = await usage_counters.totals("search_book")
+    text = (
+        f"📚 Поиск книг использовался {usage['total']} раз(а).\n\n"
+        f"📅 Сегодня: {usage['today']}\n"
+        f"🗓 За 7 дней: {usage['week']}"
+    )
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
-            return
-        # Управление подписками (для админа)
-        # Проверка на админа
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для доступа к админ панели")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("📢 Для всех", callback_data="notify_all")],
-            [InlineKeyboardButton("📢 Для тех кто подписан", callback_data="notify_subscribed")],
-            [InlineKeyboardButton("📢 для не подписан", callback_data="notify_unsubscribed")],
-            [InlineKeyboardButton("📢 для отдельного пользователя", callback_data="notify_single_user")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        await query.edit_message_text("Выберите аудиторию для уведомления", reply_markup=reply_markup)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-    elif query.data == "notify_single_user":
-        user_id = update.callback_query.from_user.id
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        user = await get_user(user_id)
+@callback_router.route("static_chat_ai")
+async def callback_static_chat_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Получаем количество раз, когда использовался чат с ИИ
+
+    # Формируем сообщение с количеством использований чата с ИИ
+    usage = await usage_counters.totals("chat_ai")
+    text = (
+        f"🤖 Чат с ИИ использовался {usage['total']} раз(а).\n\n"
+        f"📅 Сегодня: {usage['today']}\n"
+        f"🗓 За 7 дней: {usage['week']}"
+    )
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        # Проверка на админа
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для отправки уведомлений.")
-            return
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        # Переход в режим отправки уведомления для конкретного пользователя
-        context.user_data['current_mode'] = 'notify_single_user'
-        
-        # Запросить ID пользователя для отправки уведомления
-        await query.edit_message_text("🔍 Пожалуйста, введите ID пользователя, которому хотите отправить уведомление:")
-        keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="notifications")]  # Добавляем кнопку "Назад"
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        await query.edit_message_text("🔍 Пожалуйста, введите ID пользователя, которому хотите отправить уведомление:", reply_markup=reply_markup)
-        # Переход в async функцию для обработки уведомления
+@callback_router.route("static_user_cache")
+async def callback_static_user_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
         return
 
-    elif query.data.startswith("notify_"):
-        user_id = update.callback_query.from_user.id
-        
-        user = await get_user(user_id)
+    # Формируем сообщение с количеством запросов, сэкономленных кэшем пользователей
+    text = f"🗄 Кэш пользователей сэкономил {user_cache_saved_queries} запрос(ов) к базе данных."
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        # Проверка, что пользователь администратор
-        if user_id not in ADMINS:
-            await query.edit_message_text("У вас нет прав для отправки уведомлений.")
-            return
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        # Определяем аудиторию из callback_data
-        target_group = query.data.split("_")[1]  # "all", "subscribed" или "unsubscribed"
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        # Проверяем корректность данных
-        if target_group not in ["all", "subscribed", "unsubscribed"]:
-            await query.edit_message_text("⚠️ Неверный выбор аудитории. Попробуйте снова.")
-            return
+@callback_router.route("static_db_queries")
+async def callback_static_db_queries(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        # Сохраняем выбор аудитории в user_data
-        context.user_data['target_group'] = target_group
-        context.user_data['current_mode'] = 'process_notification'
-
-        # Отправляем инструкцию для создания уведомления
-        instructions = (
-            "✏️ Напишите текст уведомления, который будет отправлен вашим пользователям.\n\n"
-            "Вы можете добавить кнопки в уведомление. Для этого используйте следующий формат:\n"
-            "`Текст кнопки|Ссылка`\n\n"
-            "Пример:\n"
-            "🎉 Новое обновление! 🎉\n"
-            "Подробнее|https://example.com\n\n"
-            "🌟 Для того, чтобы ваше уведомление было красивым и привлекательным, не забудьте добавить смайлики! 🌈😊\n"
-            "Они помогут сделать ваше сообщение более ярким и выразительным. Например, используйте смайлики для подчеркивания важной информации или для создания нужной атмосферы.\n\n"
-            "Если хотите добавить дополнительные кнопки, укажите их по аналогии с примером выше.\n\n"
-            "📌 Не забывайте, что кнопки могут вести на страницы, ссылки или команды бота.\n\n"
-            "🔙 Для отмены вернитесь назад, выбрав кнопку ниже."
-        )
-        keyboard = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="notifications")],
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Формируем сообщение со статистикой именованных запросов
+    text = "⏱ Запросы к базе данных\n\n" + (db_queries.report() or "Запросов ещё не было.")
 
-        await query.edit_message_text(instructions, reply_markup=reply_markup, parse_mode="Markdown")
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-    elif query.data == "modes_admin":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Управление подписками (для админа)
-        # Проверка на админа
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("📚 Поиск книг", callback_data="search_books_admin")],
-            [InlineKeyboardButton("🤖 Чат с ИИ", callback_data="chat_with_ai_admin")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+@callback_router.route("static_callback_routes")
+async def callback_static_callback_routes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-    elif query.data == "search_books_admin":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Формируем сообщение со временем обработки кнопок (самые затратные сверху)
+    text = "🧭 Обработчики кнопок\n\n" + (callback_router.report() or "Нажатий ещё не было.")
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Управление подписками (для админа)
-        # Проверка на админа
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("✏️ Ограничение на макс. кол-во стрн. (без подписки)", callback_data="limit_page_book")],
-            [InlineKeyboardButton("✏️ Лимит книг в день (без подписки):", callback_data="Limit_books_day")],
-            [InlineKeyboardButton("✏️ Лимит книг в день (с подпиской)", callback_data="Limit_books_day_subscribe")],
-            [InlineKeyboardButton("🔒 Проверка подписки: Вкл/Выкл", callback_data="off_on_subscription_search_books")],
-            [InlineKeyboardButton("📜 Информация о режиме", callback_data="info_search_books")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="modes_admin")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-    elif query.data == "off_on_subscription_search_books":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("static_user_locks")
+async def callback_static_user_locks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
+    # Формируем сообщение с загрузкой обработчиков и ожиданием блокировок
+    text = "🔐 Очереди пользователей\n\n" + user_update_locks.report()
 
-        # Работа с глобальной переменной
-        global subscription_search_book_is_true
-        if subscription_search_book_is_true:
-            subscription_search_book_is_true = False
-            status_text = "❌ Проверка подписки выключена."
-        else:
-            subscription_search_book_is_true = True
-            status_text = "✅ Проверка подписки включена."
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        # Кнопки меню
-        menu_buttons = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="search_books_admin")]
-        ]
-        reply_markup = InlineKeyboardMarkup(menu_buttons)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        # Обновление текста с меню
-        await query.edit_message_text(
-            text=status_text,
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == "limit_page_book":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("static_openai")
+async def callback_static_openai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        context.user_data['current_mode'] = 'limit_page_book'
-        await query.edit_message_text("Укажите макс. кол-во стрн. (без подписки)")
+    # Формируем сообщение с очередью и бюджетом запросов к OpenAI
+    text = "🧠 Запросы к OpenAI\n\n" + openai_scheduler.report()
 
-    elif query.data == "Limit_books_day_subscribe":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        context.user_data['current_mode'] = 'Limit_books_day_subscribe'
-        await query.edit_message_text("Укажите лимит книг в день")
-    
-    elif query.data == "Limit_books_day":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("all_users")
+async def callback_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Получаем общее количество пользователей
+    total_users = await count_audience("all")
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        context.user_data['current_mode'] = 'Limit_books_day'
-        await query.edit_message_text("Укажите лимит книг в день")
-    
-    elif query.data == "info_search_books":
-        # Проверка на админа
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Формируем сообщение и клавиатуру с кнопками
+    text = f"👥 Всего пользователей в боте: {total_users}"
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        # Формирование информации
-        subscription_status = "✅ Включена" if subscription_search_book_is_true else "❌ Выключена"
-        info_text = (
-            "ℹ️ <b>Информация о режиме \"Поиск книг\"</b>\n\n"
-            f"💬 <b>Проверка подписки:</b> {subscription_status}\n"
-            f"💬 <b>Лимит книг в день (без подписки):</b> {count_limit_book_day}\n"
-            f"💬 <b>Лимит книг в день (с подпиской):</b> {count_limit_book_in_subscribe_day}\n"
-            f"💬 <b>Ограничение на макс. кол-во стрн. (без подписки):</b> {limit_page_book}\n"
-        )
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        # Кнопка назад
-        back_button = InlineKeyboardButton("🔙 Назад", callback_data="search_books_admin")
-        reply_markup = InlineKeyboardMarkup([[back_button]])
+    # Отправляем сообщение с количеством пользователей и клавиатурой
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        # Отправка сообщения
-        await query.edit_message_text(
-            text=info_text,
-            reply_markup=reply_markup,
-            parse_mode="HTML"
-        )
+@callback_router.route("subscribed_users")
+async def callback_subscribed_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Получаем общее количество пользователей с подписками
+    total_subscribed_users = await count_audience("subscribed")
 
-    elif query.data == "chat_with_ai_admin":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Формируем сообщение и клавиатуру с кнопками
+    text = f"🔑 Пользователи с подписками: {total_subscribed_users}"
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("⏳ Изменить лимит часов", callback_data="edit_hour_in_chat_with_ai")],
-            [InlineKeyboardButton("✏️ Лимит сообщений (без подписки)", callback_data="edit_count_in_chat_with_ai")],
-            [InlineKeyboardButton("🔒 Проверка подписки: Вкл/Выкл", callback_data="off_on_subscription_verification_chat_with")],
-            [InlineKeyboardButton("📜 Информация о режиме", callback_data="Info_chat_with_ai")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="modes_admin")]
-        ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-    elif query.data == "off_on_subscription_verification_chat_with":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение с количеством пользователей и клавиатурой
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("unsubscribed_users")
+async def callback_unsubscribed_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Получаем общее количество пользователей без активной подписки
+    total_unsubscribed_users = await count_audience("unsubscribed")
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
+    # Формируем сообщение и клавиатуру с кнопками
+    text = f"🚫 Пользователи без подписок: {total_unsubscribed_users}"
 
-        # Работа с глобальной переменной
-        global subscription_chat_with_ai_is_true
-        if subscription_chat_with_ai_is_true:
-            subscription_chat_with_ai_is_true = False
-            status_text = "❌ Проверка подписки выключена."
-        else:
-            subscription_chat_with_ai_is_true = True
-            status_text = "✅ Проверка подписки включена."
+    # Клавиатура с кнопкой "Назад"
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="statistic")]
+    ]
 
-        # Кнопки меню
-        menu_buttons = [
-            [InlineKeyboardButton("🔙 Назад", callback_data="chat_with_ai_admin")]
-        ]
-        reply_markup = InlineKeyboardMarkup(menu_buttons)
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
 
-        # Обновление текста с меню
-        await query.edit_message_text(
-            text=status_text,
-            reply_markup=reply_markup
-        )
-    
-    elif query.data == "Info_chat_with_ai":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Отправляем сообщение с количеством пользователей и клавиатурой
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("users_admin")
+async def callback_users_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    context.user_data['current_mode'] = None
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
+        return
 
-        # Формирование информации
-        subscription_status = "✅ Включена" if subscription_chat_with_ai_is_true else "❌ Выключена"
-        info_text = (
-            "ℹ️ <b>Информация о режиме \"Чат с ИИ\"</b>\n\n"
-            f"📜 <b>Проверка подписки:</b> {subscription_status}\n"
-            f"💬 <b>Лимит сообщений без подписки:</b> {count_limit_chat_with_ai}\n"
-            f"⏳ <b>Время ожидания после исчерпания лимита:</b> {wait_hour} часов\n"
-        )
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        # Кнопка назад
-        back_button = InlineKeyboardButton("🔙 Назад", callback_data="chat_with_ai_admin")
-        reply_markup = InlineKeyboardMarkup([[back_button]])
+    # Клавиатура для управления пользователями
+    admin_user_management_keyboard = [
+        [InlineKeyboardButton("🔍 Найти пользователя", callback_data="search_user")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_user_management_keyboard)
+    await query.edit_message_text("Выберите действие с пользователями", reply_markup=reply_markup)
 
-        # Отправка сообщения
-        await query.edit_message_text(
-            text=info_text,
-            reply_markup=reply_markup,
-            parse_mode="HTML"
-        )
-
-    elif query.data == "edit_count_in_chat_with_ai":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("search_user")
+async def callback_search_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
+        return
+    # Управление подписками (для админа)
+    # Проверка на админа
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        context.user_data['current_mode'] = 'edit_count_in_chat_with_ai'
-        await query.edit_message_text("Укажите лимит сообщений (без подписки)")
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="users_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    context.user_data['current_mode'] = 'search_user'
+    await query.edit_message_text(
+        "🔍 Пожалуйста, укажите **user_id** или **username** пользователя, которого хотите найти.\n"
+        "Пример: \n"
+        "- Для поиска по **user_id**: просто введите его число.\n"
+        "- Для поиска по **username**: введите имя_пользователя.\n"
+        "🔎 Мы постараемся найти этого пользователя для вас.",
+        reply_markup=reply_markup
+    )
 
-    elif query.data == "edit_hour_in_chat_with_ai":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("notifications")
+async def callback_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    context.user_data['current_mode'] = None
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору")
+        return
+    # Управление подписками (для админа)
+    # Проверка на админа
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        context.user_data['current_mode'] = 'edit_hour_in_chat_with_ai'
-        await query.edit_message_text("Укажите кол-во часов для лимита")
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("📢 Для всех", callback_data="notify_all")],
+        [InlineKeyboardButton("📢 Для тех кто подписан", callback_data="notify_subscribed")],
+        [InlineKeyboardButton("📢 для не подписан", callback_data="notify_unsubscribed")],
+        [InlineKeyboardButton("📢 для отдельного пользователя", callback_data="notify_single_user")],
+        [InlineKeyboardButton("📊 Ход рассылок", callback_data="broadcast_jobs")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    await query.edit_message_text("Выберите аудиторию для уведомления", reply_markup=reply_markup)
 
-    elif query.data == "manage_subscriptions":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("broadcast_jobs", prefixes=("broadcast_",))
+async def callback_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Управление подписками (для админа)
-        # Проверка на админа
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели")
+        return
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        admin_subscriptions_keyboard = [
-            [InlineKeyboardButton("➕ Добавить подписку", callback_data="add_subscription")],
-            [InlineKeyboardButton("❌ Удалить подписку", callback_data="remove_subscription")],
-            [InlineKeyboardButton("🎁 Подарить подписку", callback_data="gift_subscription")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    if query.data == "broadcast_jobs":
+        # Последние рассылки
+        jobs = await broadcast_jobs.recent()
+        keyboard = [
+            [InlineKeyboardButton(
+                f"#{job['id']} {job['target_group']} — {BROADCAST_STATUS_LABELS.get(job['status'], job['status'])}",
+                callback_data=f"broadcast_job_{job['id']}"
+            )]
+            for job in jobs
         ]
-        reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
-        await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="notifications")])
+        text = "📊 Последние рассылки" if jobs else "📊 Рассылок ещё не было"
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
 
-    elif query.data == "gift_subscription":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # broadcast_<действие>_<id>
+    _, action, job_id = query.data.split("_")
+    job_id = int(job_id)
+    new_status = {"pause": "paused", "resume": "running", "cancel": "cancelled"}.get(action)
+    changed = True
+    if new_status:
+        changed = await broadcast_jobs.set_status(context.bot, job_id, new_status)
+
+    text, reply_markup = await broadcast_jobs.render(job_id)
+    if text is None:
+        await query.edit_message_text("⚠️ Рассылка не найдена.")
+        return
+    if not changed:
+        text = f"⚠️ Состояние рассылки уже изменилось\n\n{text}"
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest:
+        # Ничего не изменилось с прошлого обновления
+        pass
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+@callback_router.route("notify_single_user")
+async def callback_notify_single_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
+    user = await get_user(user_id)
 
-        # Если нет доступных подписок для подарка
-        if not subscriptions:
-            keyboard = [
-                [InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Нет доступных подписок для подарка. 😞", reply_markup=reply_markup)
-            return
-        
-        # Список подписок для подарка
-        gift_subscription_keyboard = [
-            [InlineKeyboardButton(sub['name'], callback_data=f"gift_{sub['name']}") for sub in subscriptions]
-        ]
-        gift_subscription_keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")])
-        reply_markup = InlineKeyboardMarkup(gift_subscription_keyboard)
-        await query.edit_message_text("Выберите подписку, которую хотите подарить:", reply_markup=reply_markup)
-    
-    elif query.data.startswith("gift_"):
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для отправки уведомлений.")
+        return
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        # Подарить подписку
-        selected_subscription = query.data.replace("gift_", "")
-        context.user_data['current_mode'] = 'gift_subscription'
-        context.user_data['selected_subscription'] = selected_subscription  # Сохраняем выбранную подписку
-        await query.edit_message_text("Введите ID пользователя, которому хотите подарить подписку:")
-
-    elif query.data == "add_subscription":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    # Переход в режим отправки уведомления для конкретного пользователя
+    context.user_data['current_mode'] = 'notify_single_user'
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        # Добавление подписки
-        context.user_data['current_mode'] = 'add_subscription'
-        await query.edit_message_text("Введите название подписки 📛✨.\nУкажите его с подходящим смайликом, который будет характеризовать эту подписку! 🌟\nПример: 📚 Подписка_книги")
-
-    # Обработчик для удаления подписок
-    elif query.data == "remove_subscription":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        # Проверка на админа
+    # Запросить ID пользователя для отправки уведомления
+    await query.edit_message_text("🔍 Пожалуйста, введите ID пользователя, которому хотите отправить уведомление:")
+    keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="notifications")]  # Добавляем кнопку "Назад"
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        if user_id not in ADMINS:
-            await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
-            await query.edit_message_text("У вас нет прав для доступа к админ панели.")
-            return
-        
-        # Если нет подписок для удаления
-        if not subscriptions:
-            keyboard = [
-                [InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Нет доступных подписок для удаления.", reply_markup=reply_markup)
-            return
-        
-        # Генерация кнопок для подписок
+    await query.edit_message_text("🔍 Пожалуйста, введите ID пользователя, которому хотите отправить уведомление:", reply_markup=reply_markup)
+    # Переход в async функцию для обработки уведомления
+    return
+
+@callback_router.route(prefixes=("notify_",))
+async def callback_notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    # Проверка, что пользователь администратор
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для отправки уведомлений.")
+        return
+
+    # Определяем аудиторию из callback_data
+    target_group = query.data.split("_")[1]  # "all", "subscribed" или "unsubscribed"
+
+    # Проверяем корректность данных
+    if target_group not in ["all", "subscribed", "unsubscribed"]:
+        await query.edit_message_text("⚠️ Неверный выбор аудитории. Попробуйте снова.")
+        return
+
+    # Сохраняем выбор аудитории в user_data
+    context.user_data['target_group'] = target_group
+    context.user_data['current_mode'] = 'process_notification'
+
+    # Отправляем инструкцию для создания уведомления
+    instructions = (
+        "✏️ Напишите текст уведомления, который будет отправлен вашим пользователям.\n\n"
+        "Вы можете добавить кнопки в уведомление. Для этого используйте следующий формат:\n"
+        "`Текст кнопки|Ссылка`\n\n"
+        "Пример:\n"
+        "🎉 Новое обновление! 🎉\n"
+        "Подробнее|https://example.com\n\n"
+        "🌟 Для того, чтобы ваше уведомление было красивым и привлекательным, не забудьте добавить смайлики! 🌈😊\n"
+        "Они помогут сделать ваше сообщение более ярким и выразительным. Например, используйте смайлики для подчеркивания важной информации или для создания нужной атмосферы.\n\n"
+        "Если хотите добавить дополнительные кнопки, укажите их по аналогии с примером выше.\n\n"
+        "📌 Не забывайте, что кнопки могут вести на страницы, ссылки или команды бота.\n\n"
+        "🔙 Для отмены вернитесь назад, выбрав кнопку ниже."
+    )
+    keyboard = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="notifications")],
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(instructions, reply_markup=reply_markup, parse_mode="Markdown")
+
+@callback_router.route("modes_admin")
+async def callback_modes_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Управление подписками (для админа)
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("📚 Поиск книг", callback_data="search_books_admin")],
+        [InlineKeyboardButton("🤖 Чат с ИИ", callback_data="chat_with_ai_admin")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+
+@callback_router.route("search_books_admin")
+async def callback_search_books_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Управление подписками (для админа)
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("✏️ Ограничение на макс. кол-во стрн. (без подписки)", callback_data="limit_page_book")],
+        [InlineKeyboardButton("✏️ Лимит книг в день (без подписки):", callback_data="Limit_books_day")],
+        [InlineKeyboardButton("✏️ Лимит книг в день (с подпиской)", callback_data="Limit_books_day_subscribe")],
+        [InlineKeyboardButton("🔒 Проверка подписки: Вкл/Выкл", callback_data="off_on_subscription_search_books")],
+        [InlineKeyboardButton("📜 Информация о режиме", callback_data="info_search_books")],
+        [InlineKeyboardButton("🗂 Кэш оглавлений книг", callback_data="outline_cache")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="modes_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+
+@callback_router.route("off_on_subscription_search_books")
+async def callback_off_on_subscription_search_books(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Работа с глобальной переменной
+    global subscription_search_book_is_true
+    if subscription_search_book_is_true:
+        subscription_search_book_is_true = False
+        status_text = "❌ Проверка подписки выключена."
+    else:
+        subscription_search_book_is_true = True
+        status_text = "✅ Проверка подписки включена."
+
+    # Кнопки меню
+    menu_buttons = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="search_books_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(menu_buttons)
+
+    # Обновление текста с меню
+    await query.edit_message_text(
+        text=status_text,
+        reply_markup=reply_markup
+    )
+
+@callback_router.route("outline_cache")
+async def callback_outline_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Формируем сообщение со статистикой кэша оглавлений
+    text = "🗂 Кэш оглавлений книг\n\n" + await outline_cache.report()
+
+    keyboard = [
+        [InlineKeyboardButton("✏️ Удалить книгу из кэша", callback_data="outline_cache_invalidate")],
+        [InlineKeyboardButton("🧹 Очистить весь кэш", callback_data="outline_cache_clear")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="search_books_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+@callback_router.route("outline_cache_clear")
+async def callback_outline_cache_clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    removed = await outline_cache.clear()
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="outline_cache")]])
+    await query.edit_message_text(f"🧹 Кэш оглавлений очищен, удалено записей: {removed}", reply_markup=reply_markup)
+
+@callback_router.route("outline_cache_invalidate")
+async def callback_outline_cache_invalidate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Проверка на админа
+    if user_id not in ADMINS:
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    context.user_data['current_mode'] = 'outline_cache_invalidate'
+    await query.edit_message_text("Введите название книги, как его ищут пользователи, чтобы удалить её из кэша")
+
+@callback_router.route("limit_page_book")
+async def callback_limit_page_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    context.user_data['current_mode'] = 'limit_page_book'
+    await query.edit_message_text("Укажите макс. кол-во стрн. (без подписки)")
+
+@callback_router.route("Limit_books_day_subscribe")
+async def callback_limit_books_day_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    context.user_data['current_mode'] = 'Limit_books_day_subscribe'
+    await query.edit_message_text("Укажите лимит книг в день")
+
+@callback_router.route("Limit_books_day")
+async def callback_limit_books_day(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    context.user_data['current_mode'] = 'Limit_books_day'
+    await query.edit_message_text("Укажите лимит книг в день")
+
+@callback_router.route("info_search_books")
+async def callback_info_search_books(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Проверка на админа
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Формирование информации
+    subscription_status = "✅ Включена" if subscription_search_book_is_true else "❌ Выключена"
+    info_text = (
+        "ℹ️ <b>Информация о режиме \"Поиск книг\"</b>\n\n"
+        f"💬 <b>Проверка подписки:</b> {subscription_status}\n"
+        f"💬 <b>Лимит книг в день (без подписки):</b> {count_limit_book_day}\n"
+        f"💬 <b>Лимит книг в день (с подпиской):</b> {count_limit_book_in_subscribe_day}\n"
+        f"💬 <b>Ограничение на макс. кол-во стрн. (без подписки):</b> {limit_page_book}\n"
+    )
+
+    # Кнопка назад
+    back_button = InlineKeyboardButton("🔙 Назад", callback_data="search_books_admin")
+    reply_markup = InlineKeyboardMarkup([[back_button]])
+
+    # Отправка сообщения
+    await query.edit_message_text(
+        text=info_text,
+        reply_markup=reply_markup,
+        parse_mode="HTML"
+    )
+
+@callback_router.route("chat_with_ai_admin")
+async def callback_chat_with_ai_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("⏳ Изменить лимит часов", callback_data="edit_hour_in_chat_with_ai")],
+        [InlineKeyboardButton("✏️ Лимит сообщений (без подписки)", callback_data="edit_count_in_chat_with_ai")],
+        [InlineKeyboardButton("🔒 Проверка подписки: Вкл/Выкл", callback_data="off_on_subscription_verification_chat_with")],
+        [InlineKeyboardButton("📜 Информация о режиме", callback_data="Info_chat_with_ai")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="modes_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+
+@callback_router.route("off_on_subscription_verification_chat_with")
+async def callback_off_on_subscription_verification_chat_with(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Работа с глобальной переменной
+    global subscription_chat_with_ai_is_true
+    if subscription_chat_with_ai_is_true:
+        subscription_chat_with_ai_is_true = False
+        status_text = "❌ Проверка подписки выключена."
+    else:
+        subscription_chat_with_ai_is_true = True
+        status_text = "✅ Проверка подписки включена."
+
+    # Кнопки меню
+    menu_buttons = [
+        [InlineKeyboardButton("🔙 Назад", callback_data="chat_with_ai_admin")]
+    ]
+    reply_markup = InlineKeyboardMarkup(menu_buttons)
+
+    # Обновление текста с меню
+    await query.edit_message_text(
+        text=status_text,
+        reply_markup=reply_markup
+    )
+
+@callback_router.route("Info_chat_with_ai")
+async def callback_info_chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Формирование информации
+    subscription_status = "✅ Включена" if subscription_chat_with_ai_is_true else "❌ Выключена"
+    info_text = (
+        "ℹ️ <b>Информация о режиме \"Чат с ИИ\"</b>\n\n"
+        f"📜 <b>Проверка подписки:</b> {subscription_status}\n"
+        f"💬 <b>Лимит сообщений без подписки:</b> {count_limit_chat_with_ai}\n"
+        f"⏳ <b>Время ожидания после исчерпания лимита:</b> {wait_hour} часов\n"
+    )
+
+    # Кнопка назад
+    back_button = InlineKeyboardButton("🔙 Назад", callback_data="chat_with_ai_admin")
+    reply_markup = InlineKeyboardMarkup([[back_button]])
+
+    # Отправка сообщения
+    await query.edit_message_text(
+        text=info_text,
+        reply_markup=reply_markup,
+        parse_mode="HTML"
+    )
+
+@callback_router.route("edit_count_in_chat_with_ai")
+async def callback_edit_count_in_chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    context.user_data['current_mode'] = 'edit_count_in_chat_with_ai'
+    await query.edit_message_text("Укажите лимит сообщений (без подписки)")
+
+@callback_router.route("edit_hour_in_chat_with_ai")
+async def callback_edit_hour_in_chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    context.user_data['current_mode'] = 'edit_hour_in_chat_with_ai'
+    await query.edit_message_text("Укажите кол-во часов для лимита")
+
+@callback_router.route("manage_subscriptions")
+async def callback_manage_subscriptions(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Управление подписками (для админа)
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    admin_subscriptions_keyboard = [
+        [InlineKeyboardButton("➕ Добавить подписку", callback_data="add_subscription")],
+        [InlineKeyboardButton("❌ Удалить подписку", callback_data="remove_subscription")],
+        [InlineKeyboardButton("🎁 Подарить подписку", callback_data="gift_subscription")],
+        [InlineKeyboardButton("🔙 Назад", callback_data="admin_panel")]
+    ]
+    reply_markup = InlineKeyboardMarkup(admin_subscriptions_keyboard)
+    await query.edit_message_text("Выберите действие:", reply_markup=reply_markup)
+
+@callback_router.route("gift_subscription")
+async def callback_gift_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Если нет доступных подписок для подарка
+    if not subscriptions:
         keyboard = [
-            [InlineKeyboardButton(sub['name'], callback_data=f"delete_{sub['name']}") for sub in subscriptions]  # Используем 'name' из словаря
+            [InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")]
         ]
-        keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")])
-        
         reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправка сообщения с кнопками
-        await query.edit_message_text("Выберите подписку для удаления:", reply_markup=reply_markup)
-    
-    # Обработчик для удаления конкретной подписки
-    elif query.data.startswith("delete_"):
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
-
-        if not user:####################################################################################################################################
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+        await query.edit_message_text("Нет доступных подписок для подарка. 😞", reply_markup=reply_markup)
+        return
 
-        subscription_name = query.data.replace("delete_", "")
-        
-        # Поиск подписки по имени в списке
-        subscription = next((sub for sub in subscriptions if sub['name'] == subscription_name), None)
-        
-        if subscription:
-            subscriptions.remove(subscription)  # Удаляем подписку из списка
-
-            # Создаем кнопку "Назад"
-            back_button = InlineKeyboardButton("🔙 Назад", callback_data="manage_subscriptions")
-
-            if subscriptions:
-                # Если остались подписки, обновляем список кнопок для удаления
-                keyboard = [
-                    [InlineKeyboardButton(sub['name'], callback_data=f"delete_{sub['name']}") for sub in subscriptions]
-                ]
-                keyboard.append([back_button])  # Добавляем кнопку "Назад"
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Отправляем сообщение о том, что подписка удалена и показываем оставшиеся
-                await query.edit_message_text(
-                    f"Подписка '{subscription_name}' была удалена.\nВыберите следующую для удаления:",
-                    reply_markup=reply_markup,
-                )
-            else:
-                # Если подписки больше нет
-                await query.edit_message_text(
-                    f"Подписка '{subscription_name}' была удалена.\nВсе подписки удалены.",
-                    reply_markup=InlineKeyboardMarkup([[back_button]])  # Только кнопка "Назад"
-                )
-        else:
-            # Если подписка не найдена
-            await query.edit_message_text(f"Подписка '{subscription_name}' не найдена.")
-    
-    # Обработка кнопки "Игры"
-    elif query.data == "game":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Список подписок для подарка
+    gift_subscription_keyboard = [
+        [InlineKeyboardButton(sub['name'], callback_data=f"gift_{sub['name']}") for sub in subscriptions]
+    ]
+    gift_subscription_keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")])
+    reply_markup = InlineKeyboardMarkup(gift_subscription_keyboard)
+    await query.edit_message_text("Выберите подписку, которую хотите подарить:", reply_markup=reply_markup)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+@callback_router.route(prefixes=("gift_",))
+async def callback_gift(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        game_text = (
-            "🎮 Выберите игру из списка ниже или Назад в меню. 🚀"
-        )
-        context.user_data['correct_answer'] = None
-        # Клавиатура с кнопками для игр и кнопкой "Назад в меню"
-        game_keyboard = [
-            [InlineKeyboardButton("🎲 Угадай автора", callback_data="Guess_the_author")],
-            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    # Подарить подписку
+    selected_subscription = query.data.replace("gift_", "")
+    context.user_data['current_mode'] = 'gift_subscription'
+    context.user_data['selected_subscription'] = selected_subscription  # Сохраняем выбранную подписку
+    await query.edit_message_text("Введите ID пользователя, которому хотите подарить подписку:")
+
+@callback_router.route("add_subscription")
+async def callback_add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+    # Добавление подписки
+    context.user_data['current_mode'] = 'add_subscription'
+    await query.edit_message_text("Введите название подписки 📛✨.\nУкажите его с подходящим смайликом, который будет характеризовать эту подписку! 🌟\nПример: 📚 Подписка_книги")
+
+# Обработчик для удаления подписок
+@callback_router.route("remove_subscription")
+async def callback_remove_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+    # Проверка на админа
+
+    if user_id not in ADMINS:
+        await query.answer()  # Отвечаем на запрос, чтобы пользователь не ждал
+        await query.edit_message_text("У вас нет прав для доступа к админ панели.")
+        return
+
+    # Если нет подписок для удаления
+    if not subscriptions:
+        keyboard = [
+            [InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")]
         ]
-        reply_markup = InlineKeyboardMarkup(game_keyboard)
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("Нет доступных подписок для удаления.", reply_markup=reply_markup)
+        return
 
-        # Отправка сообщения с кнопками
-        await query.edit_message_text(game_text, reply_markup=reply_markup)
+    # Генерация кнопок для подписок
+    keyboard = [
+        [InlineKeyboardButton(sub['name'], callback_data=f"delete_{sub['name']}") for sub in subscriptions]  # Используем 'name' из словаря
+    ]
+    keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="manage_subscriptions")])
 
-    elif query.data == "Guess_the_author":
-        context.user_data['correct_answer'] = None
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Отправка сообщения с кнопками
+    await query.edit_message_text("Выберите подписку для удаления:", reply_markup=reply_markup)
 
-        instructions_text = (
-            "🔍 Выберите правильный ответ из предложенных вариантов ниже. 📝\n"
-            "💡 Удачи! 🎉"
-        )
+# Обработчик для удаления конкретной подписки
+@callback_router.route(prefixes=("delete_",))
+async def callback_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        try:
-            # Генерация вопроса и вариантов ответов
-            question_text, correct_answer, wrong_answers = await generate_random_quote_question_with_options_async()
+    if not user:####################################################################################################################################
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-            # Сохраняем правильный ответ в пользовательских данных
-            context.user_data['correct_answer'] = correct_answer
+    subscription_name = query.data.replace("delete_", "")
 
-            # Создаём кнопки с вариантами ответов
-            options = wrong_answers + [correct_answer]
-            random.shuffle(options)  # Перемешиваем варианты
+    # Поиск подписки по имени в списке
+    subscription = next((sub for sub in subscriptions if sub['name'] == subscription_name), None)
 
-            # Добавляем нумерацию к вариантам
-            numbered_options = [
-                f"{i + 1}. {option}" for i, option in enumerate(options)
-            ]
+    if subscription:
+        subscriptions.remove(subscription)  # Удаляем подписку из списка
 
-            # Создаём кнопки
-            options_keyboard = [
-                [InlineKeyboardButton(text, callback_data=f"answer:{option}")]
-                for text, option in zip(numbered_options, options)
-            ]
-            options_keyboard.append([InlineKeyboardButton("🔄 Другую книгу", callback_data="Guess_the_author")])
-            options_keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="game")])
-            reply_markup = InlineKeyboardMarkup(options_keyboard)
-
-            # Отправляем условия и сам вопрос с кнопками
-            await query.edit_message_text(instructions_text + "\n\n" + question_text, reply_markup=reply_markup)
-        except ValueError as e:
-            await query.edit_message_text(f"❌ Ошибка: {str(e)}")
-
-    elif query.data.startswith("answer:"):
-        selected_option = query.data.split("answer:")[1]  # Извлекаем выбранный ответ
-        correct_answer = context.user_data.get("correct_answer", "")
-
-        if selected_option == correct_answer:
-            # Сообщение о правильном ответе
-            await query.edit_message_text("✅ Правильно! 🎉 Идем дальше?")
-
-            # Клавиатура для следующего вопроса или выхода
-            next_keyboard = [
-                [InlineKeyboardButton("➡️ Дальше", callback_data="Guess_the_author")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="game")]
+        # Создаем кнопку "Назад"
+        back_button = InlineKeyboardButton("🔙 Назад", callback_data="manage_subscriptions")
+
+        if subscriptions:
+            # Если остались подписки, обновляем список кнопок для удаления
+            keyboard = [
+                [InlineKeyboardButton(sub['name'], callback_data=f"delete_{sub['name']}") for sub in subscriptions]
             ]
-            reply_markup = InlineKeyboardMarkup(next_keyboard)
+            keyboard.append([back_button])  # Добавляем кнопку "Назад"
+            reply_markup = InlineKeyboardMarkup(keyboard)
+
+            # Отправляем сообщение о том, что подписка удалена и показываем оставшиеся
+            await query.edit_message_text(
+                f"Подписка '{subscription_name}' была удалена.\nВыберите следующую для удаления:",
+                reply_markup=reply_markup,
+            )
         else:
-            # Сообщение о неправильном ответе
+            # Если подписки больше нет
             await query.edit_message_text(
-                f"❌ Неправильно. Правильный ответ: **{correct_answer}**.\nПопробуйте ещё раз!"
+                f"Подписка '{subscription_name}' была удалена.\nВсе подписки удалены.",
+                reply_markup=InlineKeyboardMarkup([[back_button]])  # Только кнопка "Назад"
             )
+    else:
+        # Если подписка не найдена
+        await query.edit_message_text(f"Подписка '{subscription_name}' не найдена.")
 
-            # Клавиатура для повторной попытки
-            retry_keyboard = [
-                [InlineKeyboardButton("🔄 Попробовать снова", callback_data="Guess_the_author")],
-                [InlineKeyboardButton("🔙 Назад", callback_data="game")]
-            ]
-            reply_markup = InlineKeyboardMarkup(retry_keyboard)
+# Обработка кнопки "Игры"
+@callback_router.route("game")
+async def callback_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        # Отправляем обновлённые кнопки
-        await query.edit_message_reply_markup(reply_markup=reply_markup)
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-    elif query.data == "search_books":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    game_text = (
+        "🎮 Выберите игру из списка ниже или Назад в меню. 🚀"
+    )
+    context.user_data['correct_answer'] = None
+    # Клавиатура с кнопками для игр и кнопкой "Назад в меню"
+    game_keyboard = [
+        [InlineKeyboardButton("🎲 Угадай автора", callback_data="Guess_the_author")],
+        [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(game_keyboard)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    # Отправка сообщения с кнопками
+    await query.edit_message_text(game_text, reply_markup=reply_markup)
 
-        # Проверяем, есть ли активная подписка
-        user_subscriptions = await get_user_subscriptions(user_id)
-        # Проверяем активные и истекшие подписки
-        active_subscription = next(
-            (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-            None
+@callback_router.route("Guess_the_author")
+async def callback_guess_the_author(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    context.user_data['correct_answer'] = None
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    instructions_text = (
+        "🔍 Выберите правильный ответ из предложенных вариантов ниже. 📝\n"
+        "💡 Удачи! 🎉"
+    )
+
+    try:
+        # Генерация вопроса и вариантов ответов
+        question_text, correct_answer, wrong_answers = await generate_random_quote_question_with_options_async()
+
+        # Сохраняем правильный ответ в пользовательских данных
+        context.user_data['correct_answer'] = correct_answer
+
+        # Создаём кнопки с вариантами ответов
+        options = wrong_answers + [correct_answer]
+        random.shuffle(options)  # Перемешиваем варианты
+
+        # Добавляем нумерацию к вариантам
+        numbered_options = [
+            f"{i + 1}. {option}" for i, option in enumerate(options)
+        ]
+
+        # Создаём кнопки
+        options_keyboard = [
+            [InlineKeyboardButton(text, callback_data=f"answer:{option}")]
+            for text, option in zip(numbered_options, options)
+        ]
+        options_keyboard.append([InlineKeyboardButton("🔄 Другую книгу", callback_data="Guess_the_author")])
+        options_keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="game")])
+        reply_markup = InlineKeyboardMarkup(options_keyboard)
+
+        # Отправляем условия и сам вопрос с кнопками
+        await query.edit_message_text(instructions_text + "\n\n" + question_text, reply_markup=reply_markup)
+    except ValueError as e:
+        await query.edit_message_text(f"❌ Ошибка: {str(e)}")
+
+@callback_router.route(prefixes=("answer:",))
+async def callback_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    selected_option = query.data.split("answer:")[1]  # Извлекаем выбранный ответ
+    correct_answer = context.user_data.get("correct_answer", "")
+
+    if selected_option == correct_answer:
+        # Сообщение о правильном ответе
+        await query.edit_message_text("✅ Правильно! 🎉 Идем дальше?")
+
+        # Клавиатура для следующего вопроса или выхода
+        next_keyboard = [
+            [InlineKeyboardButton("➡️ Дальше", callback_data="Guess_the_author")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="game")]
+        ]
+        reply_markup = InlineKeyboardMarkup(next_keyboard)
+    else:
+        # Сообщение о неправильном ответе
+        await query.edit_message_text(
+            f"❌ Неправильно. Правильный ответ: **{correct_answer}**.\nПопробуйте ещё раз!"
         )
-        if subscription_search_book_is_true:
-            # Сообщение об ограничениях для пользователей без подписки
-            if not active_subscription:
-                await query.edit_message_text(
-                    "🔒 У вас нет активной подписки, поэтому функции поиска книг будут ограничены:\n\n"
-                    f"1️⃣ Максимальное количество страниц: от 5 до {limit_page_book}.\n"
-                    f"2️⃣ Кол-во книг в день ограничено до {count_limit_book_day}\n"
-                    "🌐 Выберите язык книги, чтобы продолжить поиск:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🇷🇺 Русский", callback_data="language_russian")],
-                        [InlineKeyboardButton("🇬🇧 Английский", callback_data="language_english")],
-                        [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-                    ])
-                )
-                return
 
-        # Клавиатура для выбора языка
-        keyboard = [
-            [InlineKeyboardButton("🇷🇺 Русский", callback_data="language_russian")],
-            [InlineKeyboardButton("🇬🇧 Английский", callback_data="language_english")],
-            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+        # Клавиатура для повторной попытки
+        retry_keyboard = [
+            [InlineKeyboardButton("🔄 Попробовать снова", callback_data="Guess_the_author")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="game")]
         ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = InlineKeyboardMarkup(retry_keyboard)
+
+    # Отправляем обновлённые кнопки
+    await query.edit_message_reply_markup(reply_markup=reply_markup)
+
+@callback_router.route("search_books")
+async def callback_search_books(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
+
+    if not user_context:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    # Проверяем, есть ли активная подписка
+    active_subscription = user_context.active_subscription
+    if subscription_search_book_is_true:
+        # Сообщение об ограничениях для пользователей без подписки
+        if not active_subscription:
+            await query.edit_message_text(
+                "🔒 У вас нет активной подписки, поэтому функции поиска книг будут ограничены:\n\n"
+                f"1️⃣ Максимальное количество страниц: от 5 до {limit_page_book}.\n"
+                f"2️⃣ Кол-во книг в день ограничено до {count_limit_book_day}\n"
+                "🌐 Выберите язык книги, чтобы продолжить поиск:",
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("🇷🇺 Русский", callback_data="language_russian")],
+                    [InlineKeyboardButton("🇬🇧 Английский", callback_data="language_english")],
+                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+                ])
+            )
+            return
+
+    # Клавиатура для выбора языка
+    keyboard = [
+        [InlineKeyboardButton("🇷🇺 Русский", callback_data="language_russian")],
+        [InlineKeyboardButton("🇬🇧 Английский", callback_data="language_english")],
+        [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
 
+    await query.edit_message_text(
+        "🌐 Выберите язык книги:",
+        reply_markup=reply_markup
+    )
+
+@callback_router.route("language_russian", "language_english")
+async def callback_language(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    # Определяем язык
+    if query.data == "language_russian":
+        context.user_data['book_language'] = "russian"
+        prompt_text = "✅ Вы выбрали язык - 🇷🇺 Русский.\nТеперь выберите опции:"
+    else:
+        context.user_data['book_language'] = "english"
+        prompt_text = "✅ You have selected the language - 🇬🇧 English.\nNow select the options:"
+
+    # Инициализация состояния опций
+    context.user_data['options'] = {
+        "option_1": False,
+        "option_2": False,
+        "option_3": False,
+        "option_4": False,
+    }
+
+    # Отправляем сообщение с кнопками опций
+    await query.edit_message_text(
+        prompt_text,
+        reply_markup=await generate_options_menu(context.user_data['options'], context)
+    )
+
+@callback_router.route("toggle_option_option_1")
+async def callback_toggle_option_option_1(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
+
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
+
+    # Изменяем состояние опции 1
+    current_state = context.user_data['options']['option_1']
+    context.user_data['options']['option_1'] = not current_state
+
+    if context.user_data.get('book_language') == 'russian':
+        # Обновляем сообщение с кнопками
         await query.edit_message_text(
-            "🌐 Выберите язык книги:",
-            reply_markup=reply_markup
+            "✏️ Теперь выберите опции:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
         )
+    else:
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Now select options:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+
+@callback_router.route("toggle_option_option_2")
+async def callback_toggle_option_option_2(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-    elif query.data in ["language_russian", "language_english"]:
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Определяем язык
-        if query.data == "language_russian":
-            context.user_data['book_language'] = "russian"
-            prompt_text = "✅ Вы выбрали язык - 🇷🇺 Русский.\nТеперь выберите опции:"
-        else:
-            context.user_data['book_language'] = "english"
-            prompt_text = "✅ You have selected the language - 🇬🇧 English.\nNow select the options:"
-
-        # Инициализация состояния опций
-        context.user_data['options'] = {
-            "option_1": False,
-            "option_2": False,
-            "option_3": False,
-            "option_4": False,
-        }
+    # Изменяем состояние опции 2
+    current_state = context.user_data['options']['option_2']
+    context.user_data['options']['option_2'] = not current_state
 
-        # Отправляем сообщение с кнопками опций
+    if context.user_data.get('book_language') == 'russian':
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Теперь выберите опции:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+    else:
+        # Обновляем сообщение с кнопками
         await query.edit_message_text(
-            prompt_text,
+            "✏️ Now select options:",
             reply_markup=await generate_options_menu(context.user_data['options'], context)
         )
 
-    elif query.data == "toggle_option_option_1":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("toggle_option_option_3")
+async def callback_toggle_option_option_3(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Изменяем состояние опции 1
-        current_state = context.user_data['options']['option_1']
-        context.user_data['options']['option_1'] = not current_state
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        if context.user_data.get('book_language') == 'russian':
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Теперь выберите опции:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-        else:
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Now select options:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+    # Изменяем состояние опции 3
+    current_state = context.user_data['options']['option_3']
+    context.user_data['options']['option_3'] = not current_state
 
-    elif query.data == "toggle_option_option_2":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    if context.user_data.get('book_language') == 'russian':
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Теперь выберите опции:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+    else:
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Now select options:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Изменяем состояние опции 2
-        current_state = context.user_data['options']['option_2']
-        context.user_data['options']['option_2'] = not current_state
+@callback_router.route("toggle_option_option_4")
+async def callback_toggle_option_option_4(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if context.user_data.get('book_language') == 'russian':
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Теперь выберите опции:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-        else:
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Now select options:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-    elif query.data == "toggle_option_option_3":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    # Изменяем состояние опции 4
+    current_state = context.user_data['options']['option_4']
+    context.user_data['options']['option_4'] = not current_state
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Изменяем состояние опции 3
-        current_state = context.user_data['options']['option_3']
-        context.user_data['options']['option_3'] = not current_state
+    if context.user_data.get('book_language') == 'russian':
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Теперь выберите опции:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+    else:
+        # Обновляем сообщение с кнопками
+        await query.edit_message_text(
+            "✏️ Now select options:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
 
-        if context.user_data.get('book_language') == 'russian':
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Теперь выберите опции:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-        else:
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Now select options:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-    
-    elif query.data == "toggle_option_option_4":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("skip_options")
+async def callback_skip_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Изменяем состояние опции 4
-        current_state = context.user_data['options']['option_4']
-        context.user_data['options']['option_4'] = not current_state
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        if context.user_data.get('book_language') == 'russian':
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Теперь выберите опции:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+    # Если все опции не выбраны, пропускаем
+    if context.user_data.get('book_language') == 'russian':
+        if all(not option for option in context.user_data['options'].values()):
+            context.user_data['current_mode'] = "search_books"
+            await query.edit_message_text("✏️ Какую книгу вы хотите разобрать?\nНапишите название")
         else:
-            # Обновляем сообщение с кнопками
-            await query.edit_message_text(
-                "✏️ Now select options:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+            # Если хоть одна опция выбрана, показываем кнопку "Далее"
+            context.user_data['current_mode'] = "search_books"
+            await query.edit_message_text("✏️ Какую книгу вы хотите разобрать?\nНапишите название")
+    else:
+        if all(not option for option in context.user_data['options'].values()):
+            context.user_data['current_mode'] = "search_books"
+            await query.edit_message_text("✏️ Which book do you want to review?\nWrite the name")
+        else:
+            # Если хоть одна опция выбрана, показываем кнопку "Далее"
+            context.user_data['current_mode'] = "search_books"
+            await query.edit_message_text("✏️ Which book do you want to review?\nWrite the name")
 
-    elif query.data == "skip_options":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("select_all_options")
+async def callback_select_all_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        # Если все опции не выбраны, пропускаем
-        if context.user_data.get('book_language') == 'russian':
-            if all(not option for option in context.user_data['options'].values()):
-                context.user_data['current_mode'] = "search_books"
-                await query.edit_message_text("✏️ Какую книгу вы хотите разобрать?\nНапишите название")
-            else:
-                # Если хоть одна опция выбрана, показываем кнопку "Далее"
-                context.user_data['current_mode'] = "search_books"
-                await query.edit_message_text("✏️ Какую книгу вы хотите разобрать?\nНапишите название")
-        else:
-            if all(not option for option in context.user_data['options'].values()):
-                context.user_data['current_mode'] = "search_books"
-                await query.edit_message_text("✏️ Which book do you want to review?\nWrite the name")
-            else:
-                # Если хоть одна опция выбрана, показываем кнопку "Далее"
-                context.user_data['current_mode'] = "search_books"
-                await query.edit_message_text("✏️ Which book do you want to review?\nWrite the name")
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-    elif query.data == "select_all_options":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    context.user_data['options'] = {key: True for key in context.user_data['options']}
+    if context.user_data.get('book_language') == 'russian':
+        await query.edit_message_text(
+            "✅ Все опции выбраны. Вы можете убрать все:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+    else:
+        await query.edit_message_text(
+            "✅ All options are selected. You can remove everything:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        context.user_data['options'] = {key: True for key in context.user_data['options']}
-        if context.user_data.get('book_language') == 'russian':
-            await query.edit_message_text(
-                "✅ Все опции выбраны. Вы можете убрать все:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-        else:
-            await query.edit_message_text(
-                "✅ All options are selected. You can remove everything:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+@callback_router.route("remove_all_options")
+async def callback_remove_all_options(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя
+    user = await get_user(user_id)
 
-    elif query.data == "remove_all_options":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+    if not user:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
-        
-        context.user_data['options'] = {key: False for key in context.user_data['options']}
-        if context.user_data.get('book_language') == 'russian':
-            await query.edit_message_text(
-                "✅ Все опции убраны. Выберите снова:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
-        else:
-            await query.edit_message_text(
-                "✅ All options have been removed. Select again:",
-                reply_markup=await generate_options_menu(context.user_data['options'], context)
-            )
+    context.user_data['options'] = {key: False for key in context.user_data['options']}
+    if context.user_data.get('book_language') == 'russian':
+        await query.edit_message_text(
+            "✅ Все опции убраны. Выберите снова:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
+    else:
+        await query.edit_message_text(
+            "✅ All options have been removed. Select again:",
+            reply_markup=await generate_options_menu(context.user_data['options'], context)
+        )
 
-    elif query.data == "chat_with_ai":
-        user_id = update.callback_query.from_user.id
-        # Ищем пользователя
-        user = await get_user(user_id)
+@callback_router.route("chat_with_ai")
+async def callback_chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.callback_query.from_user.id
+    # Ищем пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
 
-        if not user:
-            await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-            return
+    if not user_context:
+        await query.edit_message_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+        return
 
-        # Проверяем наличие подписки у пользователя
-        user_subscriptions = await get_user_subscriptions(user_id)
-        active_subscription = next(
-            (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-            None
-        )
-        # Инициализируем поле count_words, если его еще нет
-        if 'count_words' not in user:
-            user['count_words'] = 0
-
-        if subscription_chat_with_ai_is_true:
-            if not active_subscription:
-                # Для пользователей без подписки
-                sms_limit = user['count_words']  # Количество использованных сообщений
-                reply_markup = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-                ])
-                message = (
-                    f"📉 **У вас нет активной подписки**, и доступ к чату с ИИ ограничен.\n\n"
-                    f"📱 Ваш текущий лимит на отправку сообщений: {sms_limit}/{count_limit_chat_with_ai}.\n\n"
-                    f"💬 Вы можете продолжать использовать чат, пока не превысите лимит сообщений.\n"
-                    f"Как только лимит будет исчерпан, доступ к Чату с ИИ будет ограничен, и начнётся отсчёт времени до снятия лимита.\n\n"
-                    f"💡 Чтобы получить полный доступ и не ограничиваться лимитом, оформите подписку!\n💬 Задавайте ваши вопросы! Я всегда готов помочь вам. 😊"
-                )
-                await update.callback_query.message.reply_text(message, reply_markup=reply_markup)
-                context.user_data['current_mode'] = "chat_with_ai"
-            else:
-                reply_markup = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
-                ])
+    # Проверяем наличие подписки у пользователя
+    user = user_context.user
+    active_subscription = user_context.active_subscription
+    # Инициализируем поле count_words, если его еще нет
+    if 'count_words' not in user:
+        user['count_words'] = 0
 
-                await update.callback_query.message.reply_text(
-                    "💬 Задавайте ваши вопросы! Я всегда готов вам помочь. 😊",
-                    reply_markup=reply_markup
-                )
-                context.user_data['current_mode'] = "chat_with_ai"
+    if subscription_chat_with_ai_is_true:
+        if not active_subscription:
+            # Для пользователей без подписки
+            sms_limit = user['count_words']  # Количество использованных сообщений
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+            ])
+            message = (
+                f"📉 **У вас нет активной подписки**, и доступ к чату с ИИ ограничен.\n\n"
+                f"📱 Ваш текущий лимит на отправку сообщений: {sms_limit}/{count_limit_chat_with_ai}.\n\n"
+                f"💬 Вы можете продолжать использовать чат, пока не превысите лимит сообщений.\n"
+                f"Как только лимит будет исчерпан, доступ к Чату с ИИ будет ограничен, и начнётся отсчёт времени до снятия лимита.\n\n"
+                f"💡 Чтобы получить полный доступ и не ограничиваться лимитом, оформите подписку!\n💬 Задавайте ваши вопросы! Я всегда готов помочь вам. 😊"
+            )
+            await update.callback_query.message.reply_text(message, reply_markup=reply_markup)
+            context.user_data['current_mode'] = "chat_with_ai"
         else:
             reply_markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
@@ -2120,18 +3651,21 @@ async def handle_menu_selection(update: Update, context: ContextTypes.DEFAULT_TY
                 reply_markup=reply_markup
             )
             context.user_data['current_mode'] = "chat_with_ai"
+    else:
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 Назад в меню", callback_data="menu")]
+        ])
+
+        await update.callback_query.message.reply_text(
+            "💬 Задавайте ваши вопросы! Я всегда готов вам помочь. 😊",
+            reply_markup=reply_markup
+        )
+        context.user_data['current_mode'] = "chat_with_ai"
 
 # Функция добавления подписки
+@text_modes.mode("add_subscription", admin_only=True)
 async def add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-
     # Если имя подписки ещё не задано
     if not context.user_data.get('subscription_name'):
         context.user_data['subscription_name'] = text
@@ -2174,25 +3708,10 @@ async def add_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Введите корректную цену подписки (число больше 0).")
 
 # Функция для обработки ввода ID и подарка подписки
+@text_modes.mode("gift_subscription", admin_only=True)
 async def gift_subscription(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
     entered_id = update.message.text.strip()  # Ввод пользователя, предполагается ID пользователя
 
-    if context.user_data.get('current_mode') != 'gift_subscription':
-        return  # Выход из функции, если не в режиме подарка подписки
-
     try:
         # Преобразуем ID в целое число
         recipient_id = int(entered_id)
@@ -2215,26 +3734,10 @@ async def gift_subscription(update, context):
         await update.message.reply_text("Введите корректный ID пользователя.")
 
 # Функция для обработки ввода количества дней подписки
+@text_modes.mode("set_subscription_days", admin_only=True)
 async def set_subscription_days(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['recipient_id'] = None
-        context.user_data['selected_subscription'] = None
-        return
     entered_days = update.message.text.strip()
 
-    if context.user_data.get('current_mode') != 'set_subscription_days':
-        return  # Выход из функции, если не в режиме установки дней подписки
-
     try:
         # Проверяем, что введенное количество дней — это целое число
         days = int(entered_days)
@@ -2247,12 +3750,8 @@ async def set_subscription_days(update, context):
         selected_subscription = context.user_data['selected_subscription']
 
         # Проверяем, есть ли активная подписка
-        user_subscriptions = await get_user_subscriptions(recipient_id)
-        # Проверяем активные и истекшие подписки
-        active_subscription = next(
-            (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-            None
-        )
+        recipient_context = await load_user_context(recipient_id)
+        active_subscription = recipient_context.active_subscription if recipient_context else None
         if active_subscription:
             await update.message.reply_text(
                 f"⚠️ У Пользователя уже есть активная подписка: {active_subscription['subscription_name']}.\n"
@@ -2284,25 +3783,9 @@ async def set_subscription_days(update, context):
         await update.message.reply_text("Введите корректное количество дней для подписки.")
 
 # Функция для изменения кол-во часов для лимита
+@text_modes.mode("edit_hour_in_chat_with_ai", admin_only=True)
 async def edit_hour_in_chat_with_ai(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
     text = update.message.text.strip()
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
-
-    if context.user_data.get('current_mode') != 'edit_hour_in_chat_with_ai':
-        return  # Выход из функции, если не в режиме изменения кол-во часов для лимита
-
     if not text:
         await update.message.reply_text(f"Число не найдено")
         return
@@ -2322,25 +3805,9 @@ async def edit_hour_in_chat_with_ai(update, context):
         await update.message.reply_text("Введите коректное число больше 0")
 
 # Функция для лимита сообщений (без подписки)
+@text_modes.mode("edit_count_in_chat_with_ai", admin_only=True)
 async def edit_count_in_chat_with_ai(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
     text = update.message.text.strip()
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
-
-    if context.user_data.get('current_mode') != 'edit_count_in_chat_with_ai':
-        return  # Выход из функции, если не в режиме изменения кол-во часов для лимита
-
     if not text:
         await update.message.reply_text(f"Число не найдено")
         return
@@ -2361,25 +3828,9 @@ async def edit_count_in_chat_with_ai(update, context):
         await update.message.reply_text("Введите коректное число больше 0")
 
 # Функция для лимита книг в день
+@text_modes.mode("Limit_books_day", admin_only=True)
 async def Limit_books_day(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
     text = update.message.text.strip()
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
-
-    if context.user_data.get('current_mode') != 'Limit_books_day':
-        return  # Выход из функции, если не в режиме изменения кол-во книг для лимита
-
     if not text:
         await update.message.reply_text(f"Число не найдено")
         return
@@ -2400,25 +3851,9 @@ async def Limit_books_day(update, context):
         await update.message.reply_text("Введите коректное число больше 0")
 
 # Функция для лимита книг в день
+@text_modes.mode("Limit_books_day_subscribe", admin_only=True)
 async def Limit_books_day_subscribe(update, context):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
     text = update.message.text.strip()
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
-
-    if context.user_data.get('current_mode') != 'Limit_books_day_subscribe':
-        return  # Выход из функции, если не в режиме изменения кол-во книг для лимита
-
     if not text:
         await update.message.reply_text(f"Число не найдено")
         return
@@ -2438,83 +3873,602 @@ async def Limit_books_day_subscribe(update, context):
     except ValueError:
         await update.message.reply_text("Введите коректное число больше 0")
 
-async def send_notification_to_users(update: Update, context: ContextTypes.DEFAULT_TYPE, notification_text, reply_markup, target_group):
-    user_id = update.message.from_user.id
+# Секунды из RetryAfter (в новых версиях библиотеки там timedelta)
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Через сколько секунд появится amount жетонов (0 — уже есть)
+    def delay(self, now, amount=1) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount=1):
+        self.tokens -= amount
+
+    def refund(self, amount):
+        self.tokens = min(self.burst, self.tokens + amount)
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+class OutboundScheduler(BaseRateLimiter):
+    """
+    Единая очередь исходящих запросов к Bot API. Отправка и редактирование
+    сообщений ждут жетон из общего ведра и из ведра своего чата; свободный
+    жетон достаётся запросу с наивысшим приоритетом (ответы пользователю,
+    затем прогресс, затем рассылки). Приоритет передаётся в rate_limit_args,
+    по умолчанию — OUTBOUND_INTERACTIVE. Остальные методы (getUpdates,
+    answerCallbackQuery и т.п.) идут без очереди.
+    """
+
+    LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, global_burst=OUTBOUND_GLOBAL_BURST,
+                 chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        # (приоритет, порядковый номер, chat_id, future)
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.paused_until = 0.0
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+
+    async def initialize(self):
+        if self.dispatcher is None:
+            self.dispatcher = asyncio.create_task(self.dispatch())
+
+    async def shutdown(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            await asyncio.gather(self.dispatcher, return_exceptions=True)
+            self.dispatcher = None
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10_000:
+                # Забываем чаты, которые давно ничего не получали
+                now = time.monotonic()
+                for key, old in list(self.chat_buckets.items()):
+                    old.refill(now)
+                    if old.full:
+                        del self.chat_buckets[key]
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def dispatch(self):
+        while True:
+            self.waiters = [entry for entry in self.waiters if not entry[3].done()]
+            if not self.waiters:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.global_bucket.delay(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            # Самый приоритетный запрос из тех, чей чат может принять сообщение
+            best = None
+            chat_wait = None
+            for entry in self.waiters:
+                chat_id = entry[2]
+                delay = self.chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                if delay > 0:
+                    chat_wait = delay if chat_wait is None else min(chat_wait, delay)
+                elif best is None or entry < best:
+                    best = entry
+
+            if best is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), chat_wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.waiters.remove(best)
+            self.global_bucket.take()
+            if best[2] is not None:
+                self.chat_bucket(best[2]).take()
+            best[3].set_result(None)
+
+    async def acquire(self, priority, chat_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((priority, next(self.sequence), chat_id, future))
+        self.wakeup.set()
+        await future
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(self.LIMITED_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        priority = OUTBOUND_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id") if data else None
+        attempt = 0
+        while True:
+            await self.acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.pause(retry_after_seconds(e))
+                attempt += 1
+                # Рассылка сама решает, повторять ли отправку
+                if priority == OUTBOUND_BULK or attempt > self.max_retries:
+                    raise
+
+outbound_scheduler = OutboundScheduler()
+
+# Обновление сообщения с ходом долгой операции (ниже приоритетом, чем ответы пользователям)
+async def edit_progress(bot, message, text, **kwargs):
+    return await bot.edit_message_text(
+        chat_id=message.chat_id,
+        message_id=message.message_id,
+        text=text,
+        rate_limit_args=OUTBOUND_PROGRESS,
+        **kwargs,
+    )
 
-    # Получаем данные о пользователе
-    user = await get_user(user_id)
-    if not user:
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+# Пометка пользователей, заблокировавших бота
+async def mark_users_blocked(user_ids):
+    if not user_ids:
         return
+    async with acquire_db() as conn:
+        await conn.execute("""
+            UPDATE users SET blocked_at = now()
+            WHERE user_id = ANY($1::bigint[]) AND blocked_at IS NULL
+        """, list(user_ids))
 
-    # Проверка, что пользователь администратор
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для отправки уведомлений.")
-        return
-
-    # Фильтруем пользователей по указанной аудитории
-    if target_group == "all":
-        # Получаем всех пользователей из базы данных
-        users = await get_all_users()
-        target_users = users
-    elif target_group == "subscribed":
-        # Получаем пользователей с активными подписками
-        target_users = await get_users_with_active_subscriptions()
-    elif target_group == "unsubscribed":
-        # Получаем пользователей без подписок
-        target_users = await get_users_without_subscriptions()
-    else:
-        await update.message.reply_text("Некорректная группа целевых пользователей.")
-        return
+db_queries.register("unblock_user", """
+    UPDATE users SET blocked_at = NULL WHERE user_id = $1 AND blocked_at IS NOT NULL
+""")
+
+class SendRateLimiter:
+    """
+    Общий темп отправки: не больше rate сообщений в секунду на весь бот,
+    слоты раздаются равномерно. После RetryAfter все отправки ждут, пока
+    Telegram не снимет ограничение.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            slot = max(time.monotonic(), self.next_slot, self.paused_until)
+            self.next_slot = slot + self.interval
+        await asyncio.sleep(max(0.0, slot - time.monotonic()))
+        # Слот мог быть выдан до паузы
+        while time.monotonic() < self.paused_until:
+            await asyncio.sleep(self.paused_until - time.monotonic())
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.next_slot = max(self.next_slot, self.paused_until)
+
+# Показатели одного запуска рассылки (в памяти процесса)
+@dataclass
+class BroadcastStats:
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+class BroadcastEngine:
+    """
+    Рассылка одного сообщения списку получателей. Получатели приходят пачками,
+    concurrency воркеров отправляют параллельно в общем темпе SendRateLimiter.
+    Каждому чату уходит одно сообщение, поэтому лимит Telegram на один чат
+    не превышается. RetryAfter приостанавливает всю рассылку на указанное
+    время и повторяет отправку. Результат по каждому получателю
+    ("sent", "failed", "blocked") передаётся в on_result; ошибка в on_result
+    только печатается и не останавливает воркер. Если воркеры всё же
+    завершились раньше времени, run падает с ошибкой, а не ждёт очередь вечно.
+    """
+
+    def __init__(self, bot, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY, max_retries=BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.limiter = SendRateLimiter(rate)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.stats = BroadcastStats()
+        self.stopped = False
+
+    # Остановка: новые получатели больше не берутся, уже взятые дорабатываются
+    def stop(self):
+        self.stopped = True
+
+    async def deliver(self, chat_id, text, reply_markup) -> str:
+        stats = self.stats
+        for _ in range(self.max_retries + 1):
+            await self.limiter.wait()
+            try:
+                await self.bot.send_message(
+                    chat_id=chat_id, text=text, reply_markup=reply_markup, rate_limit_args=OUTBOUND_BULK
+                )
+                stats.sent += 1
+                return "sent"
+            except RetryAfter as e:
+                stats.retries += 1
+                self.limiter.pause(retry_after_seconds(e))
+            except Forbidden:
+                # Бот заблокирован или аккаунт удалён
+                stats.blocked += 1
+                return "blocked"
+            except (BadRequest, TimedOut):
+                # Чат не найден и т.п.; при таймауте сообщение могло дойти — не дублируем
+                stats.failed += 1
+                return "failed"
+            except NetworkError:
+                stats.retries += 1
+                await asyncio.sleep(1)
+            except Exception as e:
+                print(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
+                stats.failed += 1
+                return "failed"
+        stats.failed += 1
+        return "failed"
+
+    async def run(self, recipients, text, reply_markup, on_result):
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                if chat_id is None:
+                    return
+                try:
+                    status = await self.deliver(chat_id, text, reply_markup)
+                    await on_result(chat_id, status)
+                except Exception as e:
+                    print(f"Ошибка рассылки пользователю {chat_id}: {e}")
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+
+        # Кладём в очередь, пока жив хоть один воркер; иначе полная очередь ждала бы вечно
+        async def put(item):
+            putter = asyncio.ensure_future(queue.put(item))
+            while not putter.done():
+                alive = [task for task in workers if not task.done()]
+                if not alive:
+                    putter.cancel()
+                    raise RuntimeError("Все воркеры рассылки остановились")
+                await asyncio.wait([putter, *alive], return_when=asyncio.FIRST_COMPLETED)
+
+        try:
+            async for chunk in recipients:
+                for chat_id in chunk:
+                    if self.stopped:
+                        break
+                    await put(chat_id)
+                if self.stopped:
+                    break
+            for _ in workers:
+                await put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            # Освобождаем курсор и соединение, если перебор прерван
+            await recipients.aclose()
+            self.stats.finished_at = time.monotonic()
+        return self.stats
+
+BROADCAST_STATUS_LABELS = {
+    "running": "📣 Идёт рассылка",
+    "paused": "⏸ Рассылка на паузе",
+    "cancelled": "⛔ Рассылка отменена",
+    "done": "✅ Рассылка завершена",
+    "failed": "❗️ Рассылка прервана ошибкой",
+}
+
+db_queries.register("broadcast_progress", """
+    SELECT j.id, j.target_group, j.status, j.created_at, j.finished_at,
+           j.status_chat_id, j.status_message_id,
+           COUNT(r.user_id) AS total,
+           COUNT(r.user_id) FILTER (WHERE r.status = 'sent') AS sent,
+           COUNT(r.user_id) FILTER (WHERE r.status = 'failed') AS failed,
+           COUNT(r.user_id) FILTER (WHERE r.status = 'blocked') AS blocked,
+           COUNT(r.user_id) FILTER (WHERE r.status = 'pending') AS pending
+    FROM broadcast_jobs j
+    LEFT JOIN broadcast_recipients r ON r.job_id = j.id
+    WHERE j.id = $1
+    GROUP BY j.id
+""")
+
+class BroadcastJobs:
+    """
+    Задания рассылки хранятся в broadcast_jobs, получатели — в broadcast_recipients
+    со статусом каждого. Аудитория фиксируется при создании задания одним
+    INSERT ... SELECT на стороне базы. Результаты отправки записываются пачками;
+    после перезапуска бота задания в статусе running продолжаются с оставшихся
+    получателей. Задание, упавшее с ошибкой, получает статус failed, и его можно
+    продолжить вручную. Рассчитан на один процесс бота.
+    """
 
-    # Отправляем уведомления
-    for user in target_users:
+    def __init__(self, flush_size=BROADCAST_FLUSH_SIZE):
+        self.flush_size = flush_size
+        # job_id -> BroadcastEngine выполняющихся в этом процессе заданий
+        self.running = {}
+        # Задания, продолженные до того, как остановилась прошлая отправка
+        self.restart = set()
+
+    async def create(self, admin_id, target_group, text, reply_markup, status_message) -> int:
+        sql, args = audience_query(target_group, skip_blocked=True)
+        markup_json = json.dumps(reply_markup.to_dict()) if reply_markup else None
+        async with acquire_db() as conn:
+            async with conn.transaction():
+                job_id = await conn.fetchval("""
+                    INSERT INTO broadcast_jobs (admin_id, target_group, text, reply_markup, status_chat_id, status_message_id)
+                    VALUES ($1, $2, $3, $4::jsonb, $5, $6)
+                    RETURNING id
+                """, admin_id, target_group, text, markup_json, status_message.chat_id, status_message.message_id)
+                job_param = f"${len(args) + 1}"
+                await conn.execute(f"""
+                    INSERT INTO broadcast_recipients (job_id, user_id)
+                    SELECT {job_param}::int, audience.user_id FROM ({sql}) AS audience
+                """, *args, job_id)
+        return job_id
+
+    def start(self, bot, job_id):
+        if job_id in self.running:
+            if self.running[job_id].stopped:
+                self.restart.add(job_id)
+            return
+        engine = BroadcastEngine(bot)
+        self.running[job_id] = engine
+        start_background_task(self.run(engine, job_id))
+
+    async def resume_all(self, bot):
+        async with acquire_db() as conn:
+            rows = await conn.fetch("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        for row in rows:
+            print(f"возобновляем рассылку #{row['id']}")
+            self.start(bot, row['id'])
+
+    async def run(self, engine, job_id):
+        results = []
+        flush_lock = asyncio.Lock()
+
+        # Пачка убирается из results только после записи; при ошибке останется до следующей попытки
+        async def flush():
+            async with flush_lock:
+                batch = results[:]
+                if not batch:
+                    return
+                async with acquire_db() as conn:
+                    await conn.execute("""
+                        UPDATE broadcast_recipients r
+                        SET status = v.status
+                        FROM unnest($2::bigint[], $3::text[]) AS v(user_id, status)
+                        WHERE r.job_id = $1 AND r.user_id = v.user_id
+                    """, job_id, [user_id for user_id, _ in batch], [status for _, status in batch])
+                await mark_users_blocked([user_id for user_id, status in batch if status == "blocked"])
+                del results[:len(batch)]
+
+        async def on_result(user_id, status):
+            results.append((user_id, status))
+            if len(results) >= self.flush_size:
+                await flush()
+
+        async def report():
+            while True:
+                await asyncio.sleep(BROADCAST_REPORT_INTERVAL)
+                try:
+                    await flush()
+                    await self.update_status_message(engine.bot, job_id)
+                except Exception as e:
+                    print(f"Ошибка обновления хода рассылки #{job_id}: {e}")
+
+        async with acquire_db() as conn:
+            job = await conn.fetchrow("SELECT text, reply_markup FROM broadcast_jobs WHERE id = $1", job_id)
+        reply_markup = None
+        if job['reply_markup']:
+            reply_markup = InlineKeyboardMarkup.de_json(json.loads(job['reply_markup']), engine.bot)
+
+        reporter = asyncio.create_task(report())
         try:
-            await context.bot.send_message(
-                chat_id=user['user_id'],
-                text=notification_text,
+            await engine.run(self.iter_pending(job_id), job['text'], reply_markup, on_result)
+            if not engine.stopped:
+                async with acquire_db() as conn:
+                    await conn.execute("""
+                        UPDATE broadcast_jobs SET status = 'done', finished_at = now()
+                        WHERE id = $1 AND status = 'running'
+                    """, job_id)
+        except Exception as e:
+            print(f"Рассылка #{job_id} прервана ошибкой: {e}")
+            try:
+                async with acquire_db() as conn:
+                    await conn.execute("""
+                        UPDATE broadcast_jobs SET status = 'failed', finished_at = now()
+                        WHERE id = $1 AND status = 'running'
+                    """, job_id)
+            except Exception as e:
+                print(f"Не удалось отметить рассылку #{job_id} как прерванную: {e}")
+        finally:
+            reporter.cancel()
+            self.running.pop(job_id, None)
+            try:
+                await flush()
+            except Exception as e:
+                print(f"Ошибка записи результатов рассылки #{job_id}: {e}")
+            stats = engine.stats
+            print(f"рассылка #{job_id}: доставлено {stats.sent}, заблокировали {stats.blocked}, "
+                  f"ошибок {stats.failed}, {stats.rate:.1f} сообщ./сек")
+            try:
+                await self.update_status_message(engine.bot, job_id)
+            except Exception:
+                pass
+            if job_id in self.restart:
+                self.restart.discard(job_id)
+                self.start(engine.bot, job_id)
+
+    # Получатели, которым ещё не отправляли
+    def iter_pending(self, job_id):
+        return stream_user_ids("""
+            SELECT user_id FROM broadcast_recipients
+            WHERE job_id = $1 AND status = 'pending'
+        """, job_id)
+
+    # Смена статуса: pause/cancel останавливают отправку, resume запускает снова
+    async def set_status(self, bot, job_id, status) -> bool:
+        allowed_from = {
+            "paused": ("running",),
+            "running": ("paused", "failed"),
+            "cancelled": ("running", "paused", "failed"),
+        }[status]
+        async with acquire_db() as conn:
+            updated = await conn.fetchval("""
+                UPDATE broadcast_jobs
+                SET status = $2,
+                    finished_at = CASE WHEN $2 = 'cancelled' THEN now() WHEN $2 = 'running' THEN NULL ELSE finished_at END
+                WHERE id = $1 AND status = ANY($3::text[])
+                RETURNING id
+            """, job_id, status, list(allowed_from))
+        if updated is None:
+            return False
+        if status == "running":
+            self.start(bot, job_id)
+        elif job_id in self.running:
+            self.running[job_id].stop()
+        return True
+
+    async def recent(self, limit=10):
+        async with acquire_db() as conn:
+            return await conn.fetch("""
+                SELECT id, target_group, status, created_at
+                FROM broadcast_jobs ORDER BY id DESC LIMIT $1
+            """, limit)
+
+    # Текст и кнопки экрана хода рассылки
+    async def render(self, job_id, progress=None):
+        progress = progress or await db_queries.fetchrow("broadcast_progress", job_id)
+        if progress is None:
+            return None, None
+        engine = self.running.get(job_id)
+        rate = engine.stats.rate if engine else 0.0
+        if progress['status'] == "running" and rate > 0:
+            eta = str(timedelta(seconds=int(progress['pending'] / rate)))
+        else:
+            eta = "—"
+        text = (
+            f"{BROADCAST_STATUS_LABELS.get(progress['status'], progress['status'])} "
+            f"#{job_id} (аудитория: {progress['target_group']})\n\n"
+            f"Всего получателей: {progress['total']}\n"
+            f"Доставлено: {progress['sent']}\n"
+            f"Заблокировали бота: {progress['blocked']}\n"
+            f"Ошибки: {progress['failed']}\n"
+            f"Осталось: {progress['pending']}\n"
+            f"Скорость: {rate:.1f} сообщ./сек\n"
+            f"Осталось времени: {eta}"
+        )
+        keyboard = []
+        if progress['status'] == "running":
+            keyboard.append([InlineKeyboardButton("⏸ Пауза", callback_data=f"broadcast_pause_{job_id}"),
+                             InlineKeyboardButton("⛔ Отменить", callback_data=f"broadcast_cancel_{job_id}")])
+        elif progress['status'] in ("paused", "failed"):
+            keyboard.append([InlineKeyboardButton("▶️ Продолжить", callback_data=f"broadcast_resume_{job_id}"),
+                             InlineKeyboardButton("⛔ Отменить", callback_data=f"broadcast_cancel_{job_id}")])
+        keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data=f"broadcast_job_{job_id}")])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="broadcast_jobs")])
+        return text, InlineKeyboardMarkup(keyboard)
+
+    async def update_status_message(self, bot, job_id):
+        progress = await db_queries.fetchrow("broadcast_progress", job_id)
+        if progress is None or progress['status_message_id'] is None:
+            return
+        text, reply_markup = await self.render(job_id, progress)
+        try:
+            await bot.edit_message_text(
+                chat_id=progress['status_chat_id'],
+                message_id=progress['status_message_id'],
+                text=text,
                 reply_markup=reply_markup,
+                rate_limit_args=OUTBOUND_PROGRESS,
             )
-        except Exception as e:
-            #print(f"Не удалось отправить сообщение пользователю {user['user_id']}: {e}")
+        except BadRequest:
+            # Текст не изменился или сообщение удалено
             pass
 
-async def search_user(update, context):
-    user_id = update.message.from_user.id
+broadcast_jobs = BroadcastJobs()
 
-    user = await get_user(user_id)
+async def send_notification_to_users(update: Update, context: ContextTypes.DEFAULT_TYPE, notification_text, reply_markup, target_group):
+    user_id = update.message.from_user.id
 
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+    # Проверяем указанную аудиторию
+    if target_group not in AUDIENCE_SQL:
+        await update.message.reply_text("Некорректная группа целевых пользователей.")
         return
 
-    # Проверка, что пользователь администратор
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для отправки уведомлений.")
-        return
+    # Рассылка идёт в фоне, ход обновляется в отдельном сообщении
+    status_message = await update.message.reply_text(f"📣 Рассылка запущена (аудитория: {target_group})")
+    job_id = await broadcast_jobs.create(user_id, target_group, notification_text, reply_markup, status_message)
+    broadcast_jobs.start(context.bot, job_id)
+    return job_id
 
+@text_modes.mode("search_user", admin_only=True)
+async def search_user(update, context):
     # Получаем данные от пользователя: user_id или username
     user_input = update.message.text.strip()  # Получаем текст, который ввел пользователь (например, user_id или username)
     print(user_input)
     # Ищем пользователя по user_id или username
-    user = None
+    found_context = None
     if user_input.isdigit():  # Если это user_id (цифры), ищем по ID
-        user = await get_user(int(user_input))
+        found_context = await load_user_context(int(user_input))
     else:  # Если это username, ищем по username
-        user = await get_user_for_username(user_input)
+        found_user = await get_user_for_username(user_input)
+        if found_user:
+            found_context = await load_user_context(found_user['user_id'])
 
     # Если пользователь не найден
-    if not user:
+    if not found_context:
         await update.message.reply_text("⚠️ Пользователь которого ищите не найден, укажите верные данные")
         return
 
-    # Проверяем, есть ли активная подписка
-    user_subscriptions = await get_user_subscriptions(user_id)
+    user = found_context.user
     # Проверяем активные и истекшие подписки
-    active_subscription = next(
-        (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-        None
-    )
+    active_subscription = found_context.active_subscription
 
     if active_subscription:
         subscription_name = active_subscription["subscription_name"]
@@ -2523,11 +4477,11 @@ async def search_user(update, context):
         subscription_status = (
             f"Активна до {end_date.strftime('%d.%m.%Y')}"
         )
-    elif not user_subscriptions:
+    elif not found_context.subscription:
         subscription_name = "Нет"
         subscription_status = "Нет активной подписки"
         
-    elif not active_subscription or active_subscription['end_date'].date() <= datetime.now().date():
+    else:
         subscription_name = "Нет"
         subscription_status = "Истекла"
 
@@ -2553,20 +4507,8 @@ async def search_user(update, context):
     context.user_data['current_mode'] = None
     await update.message.reply_text(user_info, reply_markup=reply_markup)
 
+@text_modes.mode("process_notification", admin_only=True)
 async def process_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-
-    # Проверка, что пользователь администратор
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для отправки уведомлений.")
-        return
-
     # Получаем текст уведомления
     notification_text = update.message.text.strip()
     if not notification_text:
@@ -2608,30 +4550,11 @@ async def process_notification(update: Update, context: ContextTypes.DEFAULT_TYP
     target_group = context.user_data.get("target_group", "all")
     await send_notification_to_users(update, context, notification_text, reply_markup, target_group)
 
-    await update.message.reply_text("✅ Уведомления отправлены!")
-
     # Сброс режима
     context.user_data['current_mode'] = None
 
+@text_modes.mode("notify_single_user", admin_only=True)
 async def process_single_user_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-
-    # Проверка на админа
-    if user_id not in ADMINS:
-        await update.message.reply_text("⚠️ У вас нет прав для отправки уведомлений.")
-        return
-
-    # Проверяем, что режим переключен на 'notify_single_user'
-    if context.user_data.get('current_mode') != 'notify_single_user':
-        await update.message.reply_text("⚠️ Ошибка: Неверный режим. Попробуйте снова.")
-        return
-
     # Получаем ID пользователя
     target_user_id = update.message.text.strip()
 
@@ -2678,25 +4601,9 @@ async def process_single_user_notification(update: Update, context: ContextTypes
     # Переход в режим написания уведомления
     context.user_data['current_mode'] = 'process_single_notification'
 
+@text_modes.mode("limit_page_book", admin_only=True)
 async def limit_page_in_book(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    # Ищем пользователя
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
     text = update.message.text.strip()
-    # Проверка на администратора
-    if user_id not in ADMINS:
-        await update.message.reply_text("У вас нет прав для доступа к админ панели.")
-        context.user_data['current_mode'] = None
-        context.user_data['selected_subscription'] = None
-        return
-
-    if context.user_data.get('current_mode') != 'limit_page_book':
-        return  # Выход из функции, если не в режиме изменения кол-во книг для лимита
-
     if not text:
         await update.message.reply_text(f"Число не найдено")
         return
@@ -2716,25 +4623,23 @@ async def limit_page_in_book(update: Update, context: ContextTypes.DEFAULT_TYPE)
     except ValueError:
         await update.message.reply_text("Введите коректное число больше 4")
 
-async def process_single_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-
-    user = await get_user(user_id)
-
-    if not user:####################################################################################################################################
-        await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
-        return
-
-    # Проверка на админа
-    if user_id not in ADMINS:
-        await update.message.reply_text("⚠️ У вас нет прав для отправки уведомлений.")
+@text_modes.mode("outline_cache_invalidate", admin_only=True)
+async def outline_cache_invalidate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    title = update.message.text.strip()
+    if not title:
+        await update.message.reply_text("Название не найдено")
         return
 
-    # Проверяем, что режим переключен на 'process_single_notification'
-    if context.user_data.get('current_mode') != 'process_single_notification':
-        await update.message.reply_text("⚠️ Ошибка: Неверный режим. Попробуйте снова.")
-        return
+    removed = await outline_cache.invalidate(title)
+    context.user_data['current_mode'] = None
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="outline_cache")]])
+    if removed:
+        await update.message.reply_text(f"🗑 Книга «{title}» удалена из кэша (записей: {removed})", reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(f"Книги «{title}» нет в кэше", reply_markup=reply_markup)
 
+@text_modes.mode("process_single_notification", admin_only=True)
+async def process_single_notification(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Получаем текст уведомления
     notification_text = update.message.text.strip()
 
@@ -2787,54 +4692,10 @@ async def process_single_notification(update: Update, context: ContextTypes.DEFA
 
 # Обработка сообщений пользователя
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Проверяем текущий режим
-    current_mode = context.user_data.get('current_mode')
-
-    if current_mode == "search_books":
-        await search_books(update, context)
-
-    elif current_mode == "chat_with_ai":
-        await chat_with_ai(update, context)
-
-    elif current_mode == "gift_subscription":
-        await gift_subscription(update, context)
-    
-    elif current_mode == "set_subscription_days":
-        await set_subscription_days(update, context)
-
-    elif current_mode == "limit_page_book":
-        await limit_page_in_book(update, context)
-
-    elif current_mode == "edit_hour_in_chat_with_ai":
-        await edit_hour_in_chat_with_ai(update, context)
-
-    elif current_mode == "edit_count_in_chat_with_ai":
-        await edit_count_in_chat_with_ai(update, context)
-    
-    elif current_mode == "process_single_notification":
-        await process_single_notification(update, context)
-    
-    elif current_mode == "notify_single_user":
-        await process_single_user_notification(update, context)
-    
-    elif current_mode == "Limit_books_day":
-        await Limit_books_day(update, context)
-
-    elif current_mode == 'add_subscription':
-        await add_subscription(update, context)
-    
-    elif current_mode == 'Limit_books_day_subscribe':
-        await Limit_books_day_subscribe(update, context)
-
-    elif current_mode == 'search_user':
-        await search_user(update, context)
-
-    elif current_mode == 'process_notification':
-        await process_notification(update, context)
-
-    else:
-        await update.message.reply_text("Используйте /start для выбора режима.")
+    # Обработчик выбирается по текущему режиму
+    await text_modes.dispatch(update, context)
 
+@text_modes.mode("chat_with_ai")
 async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_message = update.message.text
 
@@ -2852,70 +4713,45 @@ async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.user_data['chat_context']) > 10:
         context.user_data['chat_context'] = context.user_data['chat_context'][-10:]
 
-    # Ищем пользователя
-    user = await get_user(user_id)
+    # Ищем пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
 
-    if not user:
+    if not user_context:
         await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
         return
 
     # Ищем активную подписку пользователя
-    user_subscriptions = await get_user_subscriptions(user_id)
-    active_subscription = next(
-        (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-        None
-    )
+    user = user_context.user
+    active_subscription = user_context.active_subscription
 
     # Если админ выключил проверку подписки
     if subscription_chat_with_ai_is_true:
         # Если подписка не активна
         if active_subscription is None:
-            current_time = datetime.now(MOSCOW_TZ)
-
-            await increment_count_words(user_id)
-
-            # Проверяем, нужно ли сбросить лимит
-            user = await get_user(user_id)
-            if user['reset_time'] and current_time >= user['reset_time']:
-                await update_count_words(user_id, 0)
-                await update_reset_time(user_id, None)
-
-            # Проверка, превышен ли лимит
-            user = await get_user(user_id)
-            if user['count_words'] > count_limit_chat_with_ai:
-                # Устанавливаем время сброса лимита
-                user = await get_user(user_id)
-                print('reset_time -', user.get('reset_time'))
-                
-                if not user['reset_time']:
-                    date = current_time + timedelta(hours=wait_hour)
-                    date_naive = date.replace(tzinfo=None)  # Убираем временную зону
-                    await update_reset_time(user_id, date_naive)  # Обновляем reset_time в базе данных
-
-                    # Дожидаемся завершения записи времени сброса
-                    user = await get_user(user_id)  # Получаем актуальные данные из базы данных
-                    reset_time = user['reset_time']
-
-                    if reset_time is not None:
-                        time_left = reset_time - current_time
-                        # Рассчитываем оставшееся время
-                        hours_left, remainder = divmod(time_left.seconds, 3600)
-                        minutes_left, _ = divmod(remainder, 60)
-
-                        # Сообщение о блокировке
-                        await update.message.reply_text(
-                            f"⏳ Вы достигли лимита в {count_limit_chat_with_ai} сообщений! 📩\n\n"
-                            f"🔒 Ваш лимит будет автоматически сброшен через "
-                            f"{hours_left} часов и {minutes_left} минут.\n\n"
-                            f"💎 Хотите больше возможностей? Оформите подписку, чтобы отключить лимит и пользоваться ботом без ограничений!"
-                        )
-                        return
-                else:
-                    await update.message.reply_text("Ошибка: время сброса лимита не установлено. Пожалуйста, попробуйте снова.")
-                    return
+            # Проверяем и списываем лимит (в памяти или одним атомарным запросом)
+            if quota_engine is not None:
+                verdict = quota_engine.consume_chat(user_id, user, count_limit_chat_with_ai, wait_hour)
+            else:
+                verdict = await consume_chat_quota(user_id, count_limit_chat_with_ai, wait_hour)
+            if verdict is None:
+                await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
+                return
+
+            if not verdict.allowed:
+                # Рассчитываем оставшееся время
+                hours_left, minutes_left = verdict.time_left()
+
+                # Сообщение о блокировке
+                await update.message.reply_text(
+                    f"⏳ Вы достигли лимита в {verdict.limit} сообщений! 📩\n\n"
+                    f"🔒 Ваш лимит будет автоматически сброшен через "
+                    f"{hours_left} часов и {minutes_left} минут.\n\n"
+                    f"💎 Хотите больше возможностей? Оформите подписку, чтобы отключить лимит и пользоваться ботом без ограничений!"
+                )
+                return
 
     # Запрос к ChatGPT
-    response = await openai.ChatCompletion.acreate(
+    response = await openai_scheduler.create(
         model="gpt-3.5-turbo",
         messages=context.user_data['chat_context'],
         max_tokens=500
@@ -2923,8 +4759,7 @@ async def chat_with_ai(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Ответ ИИ
     ai_reply = response['choices'][0]['message']['content']
-    global count_chat_ai
-    count_chat_ai += 1
+    usage_counters.increment("chat_ai")
     # Добавляем ответ ИИ в историю
     context.user_data['chat_context'].append({"role": "assistant", "content": ai_reply})
     
@@ -2953,43 +4788,28 @@ async def generate_pdf_and_send(update, context, full_text, exact_title):
         await update.message.reply_text(error_message)
         return
 
-    # Проверяем уникальность названия книги в таблице books
-    conn = await connect_db()
-    suffix = 0
-    unique_title = exact_title
-    while True:
-        query = """
-            SELECT COUNT(*) FROM books WHERE user_id = $1 AND title = $2
-        """
-        count = await conn.fetchval(query, user_id, unique_title)
-        if count == 0:
-            break
-        suffix += 1
-        unique_title = f"{exact_title}_{suffix}"
-
-    # Уникальное имя файла
-    file_name = f"{user_id}_{unique_title}.pdf"
-   # Путь к Volume
+    # Путь к Volume
     volume_path = "/app/storage/library"
-    file_path = os.path.join(volume_path, file_name)
 
     # Проверяем, существует ли каталог, если нет — создаем
     if not os.path.exists(volume_path):
         os.makedirs(volume_path)
 
+    # Добавляем запись о книге в базу данных, уникальное название подбирается одним запросом
+    book = await add_book_with_unique_title(user_id, exact_title, volume_path)
+    unique_title = book['title']
+    file_path = book['path']
+
     # Сохраняем PDF
-    pdf.output(file_path)
+    try:
+        pdf.output(file_path)
+    except Exception:
+        # Без файла запись о книге не нужна
+        await delete_book_from_db(book['id'])
+        raise
 
     print(f"Файл сохранен в: {file_path}")
 
-    # Добавляем запись о книге в базу данных
-    query = """
-        INSERT INTO books (user_id, title, path)
-        VALUES ($1, $2, $3)
-    """
-    await conn.execute(query, user_id, unique_title, file_path)
-    await close_db(conn)
-
     # Сохраняем PDF в буфер
     pdf_output = io.BytesIO()
     pdf_output.write(pdf.output(dest='S').encode('latin1'))  # Сохраняем PDF как строку в буфер
@@ -3014,6 +4834,316 @@ async def generate_pdf_and_send(update, context, full_text, exact_title):
         ])
     )
 
+# Модели, для которых кодировка tiktoken загружается при запуске
+OPENAI_MODELS = ("gpt-3.5-turbo", "gpt-4")
+# Модель -> кодировка tiktoken (None — загрузить не удалось, считаем по длине текста)
+tiktoken_encodings = {}
+
+# Кодировка для модели (для незнакомых моделей — cl100k_base); может скачивать файл, поэтому вызывается в пуле потоков
+def load_tiktoken_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+# Загружает кодировки один раз при запуске, не блокируя цикл событий
+async def load_tiktoken_encodings(models=OPENAI_MODELS):
+    loop = asyncio.get_running_loop()
+    for model in models:
+        try:
+            tiktoken_encodings[model] = await loop.run_in_executor(None, load_tiktoken_encoding, model)
+        except Exception as e:
+            print(f"Не удалось загрузить кодировку tiktoken для {model}, токены считаются по длине текста: {e}")
+            tiktoken_encodings[model] = None
+
+# Оценка токенов запроса, как их считает лимит TPM: сообщения плюс max_tokens ответа
+def estimate_openai_tokens(model, messages, max_tokens):
+    # Кодировка не загружена — грубая оценка по длине текста
+    encoding = tiktoken_encodings.get(model)
+    total = 3
+    for message in messages:
+        total += 4
+        for value in message.values():
+            total += len(encoding.encode(value)) if encoding else len(value) // 2 + 1
+    return total + (max_tokens or 0)
+
+class OpenAIScheduler:
+    """
+    Общая очередь запросов к OpenAI. Перед отправкой запрос ждёт бюджет запросов
+    в минуту (OPENAI_RPM), токенов в минуту (OPENAI_TPM; оценка tiktoken —
+    промпт плюс max_tokens) и свободное место в окне одновременных запросов.
+    Бюджет достаётся по приоритету: сначала интерактивные запросы (чат, поиск
+    книги, игры), затем генерация книг. Неиспользованная часть оценки
+    возвращается в бюджет по usage из ответа.
+
+    Окно подстраивается по схеме AIMD: каждый успешный ответ с нормальным
+    временем на токен добавляет 1/окно (около +1 за полное окно), а 429,
+    таймаут или перегрузка сервера делят окно пополам — не чаще одного раза
+    на запросы, начатые до предыдущего снижения.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM, concurrency=OPENAI_CONCURRENCY,
+                 min_window=OPENAI_CONCURRENCY_MIN, max_window=OPENAI_CONCURRENCY_MAX):
+        self.requests = TokenBucket(rpm / 60, rpm)
+        self.tokens = TokenBucket(tpm / 60, tpm)
+        self.min_window = min_window
+        self.max_window = max(max_window, min_window)
+        self.window = float(min(max(concurrency, self.min_window), self.max_window))
+        self.peak_window = self.window
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.overloads = 0
+        # Сглаженное и лучшее наблюдаемое время на токен ответа
+        self.per_token = None
+        self.best_per_token = None
+        self.in_flight = 0
+        # (приоритет, порядковый номер, оценка токенов, future)
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.dispatcher = None
+        self.peak_queue = 0
+        self.wait_stats = {OPENAI_INTERACTIVE: QueryStats(), OPENAI_BACKGROUND: QueryStats()}
+        self.tokens_estimated = 0
+        self.tokens_used = 0
+
+    def start(self):
+        if self.dispatcher is None:
+            self.dispatcher = start_background_task(self.dispatch())
+
+    async def dispatch(self):
+        while True:
+            self.waiters = [entry for entry in self.waiters if not entry[3].done()]
+            if not self.waiters or self.in_flight >= self.limit:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            entry = min(self.waiters)
+            cost = min(entry[2], self.tokens.burst)
+            now = time.monotonic()
+            wait = max(self.requests.delay(now), self.tokens.delay(now, cost))
+            if wait > 0:
+                # Пока ждём бюджет, может прийти более срочный запрос
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.waiters.remove(entry)
+            self.requests.take()
+            self.tokens.take(cost)
+            self.in_flight += 1
+            # Запрос получает, сколько токенов реально списано (оценка, урезанная до burst)
+            entry[3].set_result(cost)
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wakeup.set()
+
+    # Время на токен в норме: не больше OPENAI_SLOW_FACTOR от лучшего наблюдаемого
+    def latency_healthy(self, elapsed, completion_tokens):
+        sample = elapsed / max(completion_tokens, 1)
+        self.per_token = sample if self.per_token is None else self.per_token * 0.8 + sample * 0.2
+        # Лучшее значение понемногу «забывается», чтобы пережить смену модели или нагрузки
+        self.best_per_token = self.per_token if self.best_per_token is None else min(self.best_per_token * 1.01, self.per_token)
+        return self.per_token <= self.best_per_token * OPENAI_SLOW_FACTOR
+
+    def on_success(self, elapsed, completion_tokens):
+        if self.latency_healthy(elapsed, completion_tokens) and self.in_flight >= self.limit:
+            # Растём, только когда окно заполнено (in_flight ещё включает этот запрос)
+            self.window = min(self.max_window, self.window + 1 / self.window)
+            self.peak_window = max(self.peak_window, self.window)
+
+    def on_overload(self, started):
+        self.overloads += 1
+        # Одно снижение на «поколение» запросов: ответы, начатые до прошлого снижения, его не повторяют
+        if started < self.last_decrease:
+            return
+        self.window = max(self.min_window, self.window / 2)
+        self.last_decrease = time.monotonic()
+        self.decreases += 1
+
+    async def create(self, priority=OPENAI_INTERACTIVE, **kwargs):
+        cost = estimate_openai_tokens(kwargs.get("model"), kwargs.get("messages", []), kwargs.get("max_tokens"))
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((priority, next(self.sequence), cost, future))
+        self.peak_queue = max(self.peak_queue, len(self.waiters))
+        self.wakeup.set()
+
+        started = time.perf_counter()
+        try:
+            taken = await future
+        except asyncio.CancelledError:
+            # Место могло быть выдано в момент отмены
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        self.wait_stats[priority].record(time.perf_counter() - started)
+
+        sent = time.monotonic()
+        try:
+            response = await openai.ChatCompletion.acreate(**kwargs)
+        except (openai.error.RateLimitError, openai.error.Timeout, openai.error.ServiceUnavailableError):
+            self.on_overload(sent)
+            raise
+        else:
+            usage = response.get('usage', {})
+            self.on_success(time.monotonic() - sent, usage.get('completion_tokens', 0))
+        finally:
+            self.release()
+
+        used = usage.get('total_tokens', cost)
+        self.tokens_estimated += cost
+        self.tokens_used += used
+        # Возвращаем не больше, чем списали, иначе бюджет вырос бы сверх настоящего
+        if used < taken:
+            self.tokens.refund(taken - used)
+        return response
+
+    def queue_depth(self, priority):
+        return sum(1 for entry in self.waiters if entry[0] == priority and not entry[3].done())
+
+    # Текстовый отчёт для админ панели
+    def report(self):
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        lines = [
+            f"Выполняется: {self.in_flight} из {self.limit}",
+            f"Окно: {self.window:.2f} (границы {self.min_window}–{self.max_window}, пик {self.peak_window:.2f})",
+            f"Перегрузки (429/таймауты): {self.overloads}, снижений окна: {self.decreases}",
+            f"Время на токен: {self.per_token * 1000 if self.per_token else 0:.1f} мс (лучшее {self.best_per_token * 1000 if self.best_per_token else 0:.1f} мс)",
+            f"В очереди: чат {self.queue_depth(OPENAI_INTERACTIVE)}, книги {self.queue_depth(OPENAI_BACKGROUND)} (пик {self.peak_queue})",
+            f"Запас запросов: {self.requests.tokens:.0f} из {self.requests.burst}",
+            f"Запас токенов: {self.tokens.tokens:.0f} из {self.tokens.burst}",
+            f"Токенов: оценено {self.tokens_estimated}, потрачено {self.tokens_used}",
+        ]
+        for priority, label in ((OPENAI_INTERACTIVE, "чат"), (OPENAI_BACKGROUND, "книги")):
+            stats = self.wait_stats[priority]
+            average = stats.total_time / stats.calls * 1000 if stats.calls else 0
+            lines.append(f"Ожидание ({label}): {stats.calls} запр., ср. {average:.0f} мс, макс. {stats.max_time * 1000:.0f} мс")
+        return "\n".join(lines)
+
+openai_scheduler = OpenAIScheduler()
+
+# Запрос к ChatGPT за фрагментом книги (фоновый приоритет)
+async def generate_book_text(prompt, max_tokens=3000):
+    response = await openai_scheduler.create(
+        priority=OPENAI_BACKGROUND,
+        model="gpt-3.5-turbo",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=max_tokens
+    )
+    return response['choices'][0]['message']['content']
+
+# Запуск корутин (factories — функции без аргументов) не более limit одновременно,
+# результаты возвращаются в исходном порядке; при ошибке остальные отменяются
+async def gather_limited(factories, limit):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(factory):
+        async with semaphore:
+            return await factory()
+
+    tasks = [asyncio.create_task(run(factory)) for factory in factories]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+# Дополнительный раздел книги
+@dataclass
+class BookSection:
+    # Доля от общего объёма книги
+    share: float
+    # "front" — перед основным текстом, "appendix" — после него
+    placement: str
+    # Начало промпта и требование к объёму ({words}) по языкам
+    intro: dict
+    length: dict
+
+BOOK_OPTION_SECTIONS = {
+    # Анализ и разбор ключевых идей
+    'option_1': BookSection(0.10, "appendix", {
+        'russian': "Напиши мне подробный анализ этой книги {title} и разбор ключевых идей",
+        'english': "Write me a detailed analysis of this book {title} and an analysis of key ideas",
+    }, {
+        'russian': "В этом подробном анализе и разборе ключевых идей должно быть {words} слов.",
+        'english': "This detailed analysis and analysis of key ideas should contain {words} words.",
+    }),
+    # Цитаты
+    'option_2': BookSection(0.05, "appendix", {
+        'russian': "напиши мне обширный подбор цитат из книги {title}",
+        'english': "write me an extensive selection of quotes from the book {title}",
+    }, {
+        'russian': "В этом обширном подборе цитат из книги должно быть {words} слов.",
+        'english': "This extensive selection of book quotes should contain {words} words.",
+    }),
+    # Биография автора
+    'option_3': BookSection(0.05, "front", {
+        'russian': "напиши мне небольшую биографию автора из книги {title}",
+        'english': "write me a short biography of the author from the book {title}",
+    }, {
+        'russian': "В этой небольшой биографии автора должно быть {words} слов.",
+        'english': "This short author bio should be {words} words.",
+    }),
+    # Критика
+    'option_4': BookSection(0.10, "appendix", {
+        'russian': "напиши о критике данной книги {title}",
+        'english': "write about criticism of this book {title}",
+    }, {
+        'russian': "В этой критике должно быть {words} слов.",
+        'english': "This critique should be {words} words.",
+    }),
+}
+
+BOOK_SECTION_PAGE = {
+    'russian': "Мы сейчас рассматриваем часть {page}/{count_pages}.",
+    'english': "We are now looking at the {page}/{count_pages} part.",
+}
+
+BOOK_APPENDIX_SEPARATOR = '--------------------------------------------------------------------------------------------'
+
+# Промпты дополнительного раздела: один запрос для короткого раздела, иначе по запросу на страницу
+def option_section_prompts(option, exact_title, full_total_words, book_language):
+    section = BOOK_OPTION_SECTIONS[option]
+    language = 'russian' if book_language == 'russian' else 'english'
+    intro = section.intro[language].format(title=exact_title)
+    remainder = full_total_words * section.share
+    if remainder <= 140:
+        return [intro + section.length[language].format(words=remainder + 50)]
+    count_pages = int(remainder // 140)
+    return [
+        intro
+        + BOOK_SECTION_PAGE[language].format(page=page, count_pages=count_pages)
+        + section.length[language].format(words=190)
+        for page in range(1, count_pages + 1)
+    ]
+
+# Сборка текста книги: разделы "front", основной текст, разделитель и разделы "appendix" в порядке выбора
+def assemble_book_sections(section_texts, selected_options_keys):
+    front = [option for option in selected_options_keys if BOOK_OPTION_SECTIONS[option].placement == "front"]
+    appendix = [option for option in selected_options_keys if BOOK_OPTION_SECTIONS[option].placement == "appendix"]
+
+    parts = []
+    for option in front:
+        parts.extend(section_texts[option])
+    parts.extend(section_texts["main"])
+    if appendix:
+        parts.append(BOOK_APPENDIX_SEPARATOR)
+        for option in appendix:
+            parts.extend(section_texts[option])
+    return parts
+
 async def process_book(update: Update, context: ContextTypes.DEFAULT_TYPE, num_pages: int):
     """Асинхронная обработка создания книги."""
     user_id = update.message.from_user.id
@@ -3022,354 +5152,140 @@ async def process_book(update: Update, context: ContextTypes.DEFAULT_TYPE, num_p
     # Обновляем поле is_process_book в базе данных
     await update_user_process_book(user_id, True)
 
-    list_parts = context.user_data.get('list_parts')
-    exact_title = context.user_data.get('exact_title')
-    
-    total_words = num_pages * 140  # общее количество слов
-    total_words_in_dop = 0
-    # Получаем список ключей, где значение True
-    print('process_book')
-    selected_options_keys = [key for key, value in context.user_data.get('options', {}).items() if value]
-    print('selected_options_keys -', selected_options_keys)
-
-    full_total_words = total_words
-    if selected_options_keys:
-        for option in selected_options_keys:
-            if option == 'option_1':
-                procent = 0.10
-                total_words_in_dop += total_words * procent
-            elif option == 'option_2':
-                procent = 0.05
-                total_words_in_dop += total_words * procent
-            elif option == 'option_3':
-                procent = 0.05
-                total_words_in_dop += total_words * procent
-            elif option == 'option_4':
-                procent = 0.10
-                total_words_in_dop += total_words * procent
-        total_words = total_words - total_words_in_dop
+    try:
+        list_parts = context.user_data.get('list_parts')
+        exact_title = context.user_data.get('exact_title')
     
-    words_per_part = total_words / 7
-    subparts_per_part_float = words_per_part / 100
-    if subparts_per_part_float < 1:
-        subparts_per_part_float = 1.0
-    subparts_per_part_base = math.floor(subparts_per_part_float)
-    fractional_part = round((subparts_per_part_float - subparts_per_part_base) * 10)
-
-    subparts = [subparts_per_part_base] * 7
-    if fractional_part in {2, 4, 6, 8}:
-        extra_subparts = fractional_part // 2
-        for i in range(extra_subparts):
-            subparts[i] += 1
-
-    last_text_in_pdf = []
+        total_words = num_pages * 140  # общее количество слов
+        total_words_in_dop = 0
+        # Получаем список ключей, где значение True
+        print('process_book')
+        selected_options_keys = [key for key, value in context.user_data.get('options', {}).items() if value]
+        print('selected_options_keys -', selected_options_keys)
+
+        full_total_words = total_words
+        if selected_options_keys:
+            for option in selected_options_keys:
+                total_words_in_dop += total_words * BOOK_OPTION_SECTIONS[option].share
+            total_words = total_words - total_words_in_dop
     
-    if context.user_data.get('book_language') == 'russian':
-        progress_message = await update.message.reply_text("⏳ Начинаем обработку...")
-    else:
-        progress_message = await update.message.reply_text("⏳ Let's start processing...")
+        words_per_part = total_words / 7
+        subparts_per_part_float = words_per_part / 100
+        if subparts_per_part_float < 1:
+            subparts_per_part_float = 1.0
+        subparts_per_part_base = math.floor(subparts_per_part_float)
+        fractional_part = round((subparts_per_part_float - subparts_per_part_base) * 10)
+
+        subparts = [subparts_per_part_base] * 7
+        if fractional_part in {2, 4, 6, 8}:
+            extra_subparts = fractional_part // 2
+            for i in range(extra_subparts):
+                subparts[i] += 1
+
+        if context.user_data.get('book_language') == 'russian':
+            progress_message = await update.message.reply_text("⏳ Начинаем обработку...")
+        else:
+            progress_message = await update.message.reply_text("⏳ Let's start processing...")
 
-    for index, part_number in enumerate(list_parts, start=1):
-        for subpart_index in range(1, subparts[index - 1] + 1):
+        # План книги: раздел -> промпты его фрагментов. Все фрагменты генерируются параллельно
+        def main_prompt(index, part_number, subpart_index):
             if context.user_data.get('book_language') == 'russian':
-                prompt = (
+                return (
                     f"Книга '{exact_title}' содержит {num_pages} страниц."
                     f"Мы сейчас рассматриваем часть {part_number}, подчасть {subpart_index}/{subparts[index - 1]}."
                     f"В этой подчасти должно быть 190 слов."
                     "Учитывая это, напишите о содержании данной главы книги."
                 )
-            else:
-                prompt = (
-                    f"Book '{exact_title}' contains {num_pages} pages."
-                    f"We are now considering part {part_number}, subpart {subpart_index}/{subparts[index - 1]}."
-                    f"This subpart should be 190 words long."
-                    "With this in mind, write about the contents of this chapter of the book."
-                )
-
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=3000
+            return (
+                f"Book '{exact_title}' contains {num_pages} pages."
+                f"We are now considering part {part_number}, subpart {subpart_index}/{subparts[index - 1]}."
+                f"This subpart should be 190 words long."
+                "With this in mind, write about the contents of this chapter of the book."
             )
-            chat_gpt_reply = response['choices'][0]['message']['content']
-            last_text_in_pdf.append(chat_gpt_reply)
-
-            if progress_message:
-                if context.user_data.get('book_language') == 'russian':
-                    await progress_message.edit_text(
-                        f"⏳ Обрабатываем часть {index}/7, подчасть {subpart_index}/{subparts[index - 1]}"
-                    )
-                else:
-                    await progress_message.edit_text(
-                        f"⏳ Processing part {index}/7, subpart {subpart_index}/{subparts[index - 1]}"
-                    )
-
-    if selected_options_keys:
-        apend_ture = False
-        for option in selected_options_keys:
-            if option == 'option_3':
-                pass
-            else:
-                if apend_ture: 
-                    pass
-                else:
-                    apend_ture = True
-                    last_text_in_pdf.append('--------------------------------------------------------------------------------------------')
-        count_pages = 0
-        count = 0
 
-        if context.user_data.get('book_language') == 'russian':
-            progress_message = await update.message.reply_text("⏳ Начинаем обработку...")
-        else:
-            progress_message = await update.message.reply_text("⏳ Let's start processing...")
-        # Итерируемся по ним
+        section_prompts = {
+            "main": [
+                (main_prompt(index, part_number, subpart_index), 3000)
+                for index, part_number in enumerate(list_parts, start=1)
+                for subpart_index in range(1, subparts[index - 1] + 1)
+            ]
+        }
         for option in selected_options_keys:
-            count += 1
-
-            if progress_message:
-                if context.user_data.get('book_language') == 'russian':
-                    await progress_message.edit_text(
-                        f"⏳ Обрабатываем часть {count}/{len(selected_options_keys)}"
-                    )
-                else:
-                    await progress_message.edit_text(
-                        f"⏳ Processing part {count}/{len(selected_options_keys)}"
-                    )
-            if option == 'option_1':
-                procent = 0.1
-                remainder = full_total_words * procent
-                if remainder <= 140:
-                    if context.user_data.get('book_language') == 'russian':
-                        prompt = (
-                            f"Напиши мне подробный анализ этой книги {exact_title} и разбор ключевых идей"
-                            f"В этом подробном анализе и разборе ключевых идей должно быть {remainder + 50} слов."
-                        )
-                    else:
-                        prompt = (
-                            f"Write me a detailed analysis of this book {exact_title} and an analysis of key ideas"
-                            f"This detailed analysis and analysis of key ideas should contain {remainder + 50} words."
-                        )
-
-                    response = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=500
-                    )
+            section_prompts[option] = [
+                (prompt, 500)
+                for prompt in option_section_prompts(option, exact_title, full_total_words, context.user_data.get('book_language'))
+            ]
 
-                    chat_gpt_reply = response['choices'][0]['message']['content']
-                    last_text_in_pdf.append(chat_gpt_reply)
-                else:
-                    count_pages = int(remainder // 140)
-                    for page in range(1, count_pages + 1):
-                        if context.user_data.get('book_language') == 'russian':
-                            prompt = (
-                                f"Напиши мне подробный анализ этой книги {exact_title} и разбор ключевых идей"
-                                f"Мы сейчас рассматриваем часть {page}/{count_pages}."
-                                f"В этом подробном анализе и разборе ключевых идей должно быть 190 слов."
-                            )
-                        else:
-                            prompt = (
-                                f"Write me a detailed analysis of this book {exact_title} and an analysis of key ideas"
-                                f"We are now looking at the {page}/{count_pages} part."
-                                f"This detailed analysis and analysis of key ideas should contain 190 words."
-                            )
-                        response = await openai.ChatCompletion.acreate(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=500
-                        )
+        jobs = [(section, prompt, max_tokens) for section, prompts in section_prompts.items() for prompt, max_tokens in prompts]
+        fragments_done = 0
+        last_progress_at = 0.0
 
-                        chat_gpt_reply = response['choices'][0]['message']['content']
-                        last_text_in_pdf.append(chat_gpt_reply)
+        async def generate_fragment(prompt, max_tokens):
+            nonlocal fragments_done, last_progress_at
+            chat_gpt_reply = await generate_book_text(prompt, max_tokens)
 
-            elif option == 'option_2':
-                procent = 0.05
-                remainder = full_total_words * procent
-                if remainder <= 140:
-                    if context.user_data.get('book_language') == 'russian':
-                        prompt = (
-                            f"напиши мне обширный подбор цитат из книги {exact_title}"
-                            f"В этом обширном подборе цитат из книги должно быть {remainder + 50} слов."
-                        )
-                    else:
-                        prompt = (
-                            f"write me an extensive selection of quotes from the book {exact_title}"
-                            f"This extensive selection of book quotes should contain {remainder + 50} words."
-                        )
-                    response = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=500
-                        )
-                    chat_gpt_reply = response['choices'][0]['message']['content']
-                    last_text_in_pdf.append(chat_gpt_reply)
-                else:
-                    count_pages = int(remainder // 140)
-                    for page in range(1, count_pages + 1):
-                        if context.user_data.get('book_language') == 'russian':
-                            prompt = (
-                                f"напиши мне обширный подбор цитат из книги {exact_title}"
-                                f"Мы сейчас рассматриваем часть {page}/{count_pages}."
-                                f"В этом подробном анализе и разборе ключевых идей должно быть 190 слов."
-                            )
-                        else:
-                            prompt = (
-                                f"write me an extensive selection of quotes from the book {exact_title}"
-                                f"We are now looking at the {page}/{count_pages} part."
-                                f"This detailed analysis and analysis of key ideas should contain 190 words."
-                            )
-                        response = await openai.ChatCompletion.acreate(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=500
-                            )
-                        chat_gpt_reply = response['choices'][0]['message']['content']
-                        last_text_in_pdf.append(chat_gpt_reply)
-
-            elif option == 'option_3':
-                procent = 0.05
-                remainder = full_total_words * procent
-                if remainder <= 140:
+            # Прогресс считается по готовым фрагментам, обновляется не чаще раза в BOOK_PROGRESS_INTERVAL секунд
+            fragments_done += 1
+            now = time.monotonic()
+            if progress_message and (fragments_done == len(jobs) or now - last_progress_at >= BOOK_PROGRESS_INTERVAL):
+                last_progress_at = now
+                # Ошибка обновления прогресса не должна прерывать генерацию книги
+                try:
                     if context.user_data.get('book_language') == 'russian':
-                        prompt = (
-                            f"напиши мне небольшую биографию автора из книги {exact_title}"
-                            f"В этой небольшой биографии автора должно быть {remainder + 50} слов."
+                        await edit_progress(context.bot, progress_message,
+                            f"⏳ Обрабатываем книгу: готово {fragments_done}/{len(jobs)} фрагментов"
                         )
                     else:
-                        prompt = (
-                            f"write me a short biography of the author from the book {exact_title}"
-                            f"This short author bio should be {remainder + 50} words."
+                        await edit_progress(context.bot, progress_message,
+                            f"⏳ Processing the book: {fragments_done}/{len(jobs)} fragments done"
                         )
+                except TelegramError as e:
+                    print(f"Не удалось обновить прогресс книги пользователя {user_id}: {e}")
+            return chat_gpt_reply
 
-                    response = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=500
-                    )
+        replies = await gather_limited(
+            [functools.partial(generate_fragment, prompt, max_tokens) for _, prompt, max_tokens in jobs],
+            BOOK_SUBPART_CONCURRENCY,
+        )
+        section_texts = {section: [] for section in section_prompts}
+        for (section, _, _), reply in zip(jobs, replies):
+            section_texts[section].append(reply)
 
-                    chat_gpt_reply = response['choices'][0]['message']['content']
-                    last_text_in_pdf.insert(0, chat_gpt_reply)
-                else:
-                    count_pages = int(remainder // 140)
-                    first_iteration_done = False
-                    first_iteration_done_count = 0
-                    for page in range(1, count_pages + 1):
-                        if context.user_data.get('book_language') == 'russian':
-                            prompt = (
-                                f"напиши мне небольшую биографию автора из книги {exact_title}"
-                                f"Мы сейчас рассматриваем часть {page}/{count_pages}."
-                                f"В этой небольшой биографии автора должно быть 190 слов."
-                            )
-                        else:
-                            prompt = (
-                                f"write me a short biography of the author from the book {exact_title}"
-                                f"We are now looking at the {page}/{count_pages} part."
-                                f"This short author bio should be 190 words."
-                            )
-                        response = await openai.ChatCompletion.acreate(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=500
-                        )
+        last_text_in_pdf = assemble_book_sections(section_texts, selected_options_keys)
 
-                        chat_gpt_reply = response['choices'][0]['message']['content']
-
-                        if not first_iteration_done:
-                            # Если это первая итерация, добавляем в начало
-                            last_text_in_pdf.insert(0, chat_gpt_reply)
-                            first_iteration_done = True
-                            first_iteration_done_count = 1
-                        elif first_iteration_done_count == 1:
-                            # Вторая итерация, добавляем под первой записью
-                            last_text_in_pdf.insert(1, chat_gpt_reply)
-                            first_iteration_done_count = 2
-                        elif first_iteration_done_count == 2:
-                            # Третья итерация, добавляем на третью позицию
-                            last_text_in_pdf.insert(2, chat_gpt_reply)
-                            first_iteration_done_count = 3
-                        elif first_iteration_done_count == 3:
-                            # Четвертая итерация, добавляем на четвертую позицию
-                            last_text_in_pdf.insert(3, chat_gpt_reply)
-                            first_iteration_done_count = 4
-                        elif first_iteration_done_count == 4:
-                            # Пятая итерация, добавляем на пятую позицию
-                            last_text_in_pdf.insert(4, chat_gpt_reply)
-                            first_iteration_done_count = 5
-                        elif first_iteration_done_count == 5:
-                            # Если больше 5 итераций, добавляем в конец
-                            last_text_in_pdf.insert(5, chat_gpt_reply)
-
-            elif option == 'option_4':
-                procent = 0.1
-                remainder = full_total_words * procent
-                if remainder <= 140:
-                    if context.user_data.get('book_language') == 'russian':
-                        prompt = (
-                            f"напиши о критике данной книги {exact_title}"
-                            f"В этой критике должно быть {remainder + 50} слов."
-                        )
-                    else:
-                        prompt = (
-                            f"write about criticism of this book {exact_title}"
-                            f"This critique should be {remainder + 50} words."
-                        )
-                    response = await openai.ChatCompletion.acreate(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=500
-                        )
-                    chat_gpt_reply = response['choices'][0]['message']['content']
-                    last_text_in_pdf.append(chat_gpt_reply)
+        full_text = "\n\n".join(last_text_in_pdf)
 
-                else:
-                    count_pages = int(remainder // 140)
-                    for page in range(1, count_pages + 1):
-                        if context.user_data.get('book_language') == 'russian':
-                            prompt = (
-                                f"напиши о критике данной книги {exact_title}"
-                                f"Мы сейчас рассматриваем часть {page}/{count_pages}."
-                                f"В этой критике должно быть 190 слов."
-                            )
-                        else:
-                            prompt = (
-                                f"write about criticism of this book {exact_title}"
-                                f"We are now looking at the {page}/{count_pages} part."
-                                f"This critique should be 190 words."
-                            )
-                        response = await openai.ChatCompletion.acreate(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "user", "content": prompt}],
-                            max_tokens=500
-                            )
-                        chat_gpt_reply = response['choices'][0]['message']['content']
-                        last_text_in_pdf.append(chat_gpt_reply)
-
-    full_text = "\n\n".join(last_text_in_pdf)
-
-    current_book_count = user['daily_book_count']
-    new_book_count = current_book_count + 1
-    print('daily_book_count -', current_book_count)
-    print('new_book_count -', new_book_count)
-    # Обновляем значение в базе данных
-    await update_user_daily_book_count(user_id, new_book_count)
-    await update_user_process_book(user_id, False)
-
-    await generate_pdf_and_send(update, context, full_text, exact_title)
-    context.user_data.clear()
+        if quota_engine is not None:
+            new_book_count = quota_engine.record_book(user_id, user)
+            print('new_book_count -', new_book_count)
+        else:
+            current_book_count = user['daily_book_count']
+            new_book_count = current_book_count + 1
+            print('daily_book_count -', current_book_count)
+            print('new_book_count -', new_book_count)
+            # Обновляем значение в базе данных
+            await update_user_daily_book_count(user_id, new_book_count)
+        await generate_pdf_and_send(update, context, full_text, exact_title)
+        context.user_data.clear()
+    finally:
+        # Флаг снимается и при ошибке, иначе пользователь не сможет создать новую книгу
+        await update_user_process_book(user_id, False)
 
+@text_modes.mode("search_books")
 async def search_books(update, context):
     user_id = update.message.from_user.id
 
-    # Проверка пользователя
-    user = await get_user(user_id)
+    # Проверка пользователя вместе с подпиской
+    user_context = await load_user_context(user_id)
 
-    if not user:
+    if not user_context:
         if context.user_data.get('book_language') == 'russian':
             await update.message.reply_text("⚠️ Пользователь не найден. Обратитесь к администратору.")
         else:
             await update.message.reply_text("⚠️ User not found. Contact your administrator.")
         return
 
+    user = user_context.user
     if user['is_process_book'] == True:
         keyboard = [
         [InlineKeyboardButton("🔙 Назад в меню", callback_data='menu')]
@@ -3387,29 +5303,29 @@ async def search_books(update, context):
                 reply_markup=reply_markup
             )
         return
-    user_subscriptions = await get_user_subscriptions(user_id)
-    active_subscription = next(
-        (sub for sub in user_subscriptions if sub["end_date"] >= datetime.now().date()), 
-        None
-    )
+    active_subscription = user_context.active_subscription
 
-    today_date = datetime.now().date()
-    print('today_date -', today_date)
+    if quota_engine is not None:
+        # Счётчик книг за день ведётся в памяти
+        daily_book_count = quota_engine.books_today(user_id, user)
+    else:
+        today_date = datetime.now().date()
+        print('today_date -', today_date)
 
-    # Преобразуем last_book_date в дату без времени, если он существует
-    last_book_date = user.get('last_book_date')
-    if last_book_date:
-        last_book_date = last_book_date.date()  # Убираем время, оставляем только дату
+        # Преобразуем last_book_date в дату без времени, если он существует
+        last_book_date = user.get('last_book_date')
+        if last_book_date:
+            last_book_date = last_book_date.date()  # Убираем время, оставляем только дату
 
-    print('last_book_date -', last_book_date)
+        print('last_book_date -', last_book_date)
 
-    # Сравниваем даты без времени
-    if last_book_date != today_date:
-        await update_user_last_book_date(user_id, today_date)
-        await update_user_daily_book_count(user_id, 0)
+        # Сравниваем даты без времени
+        if last_book_date != today_date:
+            await update_user_last_book_date(user_id, today_date)
+            await update_user_daily_book_count(user_id, 0)
 
-    # Проверка лимита на книги за день
-    daily_book_count = user.get('daily_book_count', 0)
+        # Проверка лимита на книги за день
+        daily_book_count = user.get('daily_book_count', 0)
     if subscription_search_book_is_true:
         if active_subscription is None:
             if daily_book_count >= count_limit_book_day:
@@ -3484,8 +5400,7 @@ async def search_books(update, context):
                 return
 
         # Запускаем обработку книги в фоне
-        global count_search_book
-        count_search_book += 1
+        usage_counters.increment("search_book")
         asyncio.create_task(process_book(update, context, num_pages))
         if context.user_data.get('book_language') == 'russian':
             await update.message.reply_text(
@@ -3514,7 +5429,7 @@ async def search_books(update, context):
         return
 
     context.user_data['book_title'] = book_title
-    exact_title, book_exists, list_parts = await get_chatgpt_response(update, book_title)
+    exact_title, book_exists, list_parts = await get_chatgpt_response(update, book_title, context.user_data.get('book_language'))
 
     if book_exists == "да":
         context.user_data['exact_title'] = exact_title
@@ -3605,14 +5520,157 @@ async def search_books(update, context):
                 ]])
             )
 
-async def get_chatgpt_response(update: Update, message):
+db_queries.register("outline_cache_get", """
+    SELECT exact_title, list_parts, EXTRACT(EPOCH FROM now() - created_at)::float8 AS age
+    FROM book_outlines
+    WHERE title_key = $1 AND language = $2 AND created_at > now() - make_interval(secs => $3::float8)
+""")
+
+db_queries.register("outline_cache_put", """
+    INSERT INTO book_outlines (title_key, language, exact_title, list_parts)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (title_key, language) DO UPDATE
+    SET exact_title = EXCLUDED.exact_title, list_parts = EXCLUDED.list_parts, created_at = now()
+""")
+
+db_queries.register("outline_cache_delete", """
+    DELETE FROM book_outlines WHERE title_key = $1
+""")
+
+db_queries.register("outline_cache_clear", """
+    DELETE FROM book_outlines
+""")
+
+db_queries.register("outline_cache_prune", """
+    DELETE FROM book_outlines WHERE created_at <= now() - make_interval(secs => $1::float8)
+""")
+
+db_queries.register("outline_cache_count", """
+    SELECT count(*) FROM book_outlines
+""")
+
+# Нормализованное название для ключа кэша: регистр, «ё», кавычки, пунктуация и лишние пробелы не важны
+def normalize_book_title(title):
+    title = title.casefold().replace("ё", "е")
+    title = re.sub(r"[«»\"'“”„`.,!?:;()\[\]-]+", " ", title)
+    return " ".join(title.split())
+
+class OutlineCache:
+    """
+    Кэш разбиения книги на 7 частей (exact_title и list_parts), чтобы повторный
+    поиск той же книги не тратил запрос к ChatGPT. Два уровня: LRU в памяти
+    процесса (OUTLINE_CACHE_SIZE записей) и таблица book_outlines, общая для
+    всех процессов. Ключ — нормализованное название и язык книги, записи
+    живут OUTLINE_CACHE_TTL секунд. Кэшируются только найденные книги.
+    Одновременные запросы одной и той же книги ждут один общий запрос к API.
+    """
+
+    def __init__(self, size=OUTLINE_CACHE_SIZE, ttl=OUTLINE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        # (название, язык) -> (exact_title, list_parts, когда истекает по time.monotonic)
+        self.entries = OrderedDict()
+        self.pending = KeyedLocks()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def key(self, title, language):
+        return normalize_book_title(title), language or 'russian'
+
+    def remember(self, key, exact_title, list_parts, expires_at):
+        self.entries[key] = (exact_title, list_parts, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[2] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0], entry[1]
+            del self.entries[key]
+
+        try:
+            row = await db_queries.fetchrow("outline_cache_get", key[0], key[1], self.ttl)
+        except Exception as e:
+            # База недоступна — считаем промахом, поиск работает и без кэша
+            print(f"Ошибка чтения кэша оглавлений: {e}")
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.db_hits += 1
+        self.remember(key, row['exact_title'], list(row['list_parts']), time.monotonic() + self.ttl - row['age'])
+        return row['exact_title'], list(row['list_parts'])
+
+    async def put(self, key, exact_title, list_parts):
+        self.remember(key, exact_title, list_parts, time.monotonic() + self.ttl)
+        try:
+            await db_queries.execute("outline_cache_put", key[0], key[1], exact_title, list_parts)
+        except Exception as e:
+            print(f"Ошибка записи кэша оглавлений: {e}")
+
+    # Удаляет книгу из кэша для всех языков; возвращает, сколько записей удалено в базе
+    async def invalidate(self, title):
+        title_key = normalize_book_title(title)
+        for key in [key for key in self.entries if key[0] == title_key]:
+            del self.entries[key]
+        status = await db_queries.execute("outline_cache_delete", title_key)
+        return int(status.split()[-1])
+
+    async def clear(self):
+        self.entries.clear()
+        status = await db_queries.execute("outline_cache_clear")
+        return int(status.split()[-1])
+
+    async def prune(self):
+        await db_queries.execute("outline_cache_prune", self.ttl)
+
+    # Текстовый отчёт для админ панели
+    async def report(self):
+        lookups = self.memory_hits + self.db_hits + self.misses
+        hit_rate = (self.memory_hits + self.db_hits) / lookups * 100 if lookups else 0
+        stored = await db_queries.fetchval("outline_cache_count")
+        return "\n".join([
+            f"В памяти: {len(self.entries)} из {self.size}",
+            f"В базе: {stored}",
+            f"Срок хранения: {self.ttl / 3600:.0f} ч",
+            f"Попадания: память {self.memory_hits}, база {self.db_hits}",
+            f"Промахи (запрос к ChatGPT): {self.misses}",
+            f"Доля попаданий: {hit_rate:.1f}%",
+        ])
+
+outline_cache = OutlineCache()
+
+# Разбиение книги на 7 частей: сначала кэш, при промахе — запрос к ChatGPT
+async def get_chatgpt_response(update: Update, message, language=None):
+    key = outline_cache.key(message, language)
+    cached = await outline_cache.get(key)
+    if cached is not None:
+        return cached[0], "да", cached[1]
+
+    async with outline_cache.pending.hold(key):
+        # Пока ждали, ту же книгу мог разобрать другой запрос
+        cached = await outline_cache.get(key)
+        if cached is not None:
+            return cached[0], "да", cached[1]
+
+        exact_title, book_exists, list_parts = await request_book_outline(update, message)
+        if book_exists == "да" and exact_title and list_parts:
+            await outline_cache.put(key, exact_title, list_parts)
+        return exact_title, book_exists, list_parts
+
+async def request_book_outline(update: Update, message):
     prompt = (
         f"Раздели книгу под названием \"{message}\" обязательно ровно на 7 частей."
         "Если книга существует, раздели на 7 подробных частей, и укажи правильное название (в кавычках)"
         "Если книга не существует, напиши, что книга не существует."
     )
     try:
-        response = await openai.ChatCompletion.acreate(
+        response = await openai_scheduler.create(
             model="gpt-3.5-turbo",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1000
@@ -3662,16 +5720,62 @@ async def get_chatgpt_response(update: Update, message):
         print("Ошибка openai.error.Timeout таймаута при запросе к OpenAI. Повторная попытка через 5 секунд.")
         await update.message.reply_text("Ошибка соединения с API. Повторная попытка через 5 секунд.")
         await asyncio.sleep(5)
-        return await get_chatgpt_response(prompt)
+        return await request_book_outline(update, message)
+
+# Действия при запуске приложения
+async def on_startup(application: Application):
+    await init_db_pool()
+    await run_migrations()
+    start_background_task(run_stats_refresh())
+    await load_tiktoken_encodings()
+    openai_scheduler.start()
+    # Устаревшие записи кэша оглавлений больше не читаются — удаляем их
+    await outline_cache.prune()
+    # Рассылки, прерванные перезапуском, продолжаются с оставшихся получателей
+    await broadcast_jobs.resume_all(application.bot)
+    start_background_task(usage_counters.run())
+    if quota_engine is not None:
+        start_background_task(quota_engine.run())
+
+# Действия при остановке приложения
+async def on_shutdown(application: Application):
+    await stop_background_tasks()
+    await usage_counters.flush()
+    if quota_engine is not None:
+        await quota_engine.flush()
+    if user_write_buffer is not None:
+        await user_write_buffer.close()
+    await close_db_pool()
 
 # Главная функция
 def main():
-    application = Application.builder().token(telegram_bot_token).build()
+    application = (
+        Application.builder()
+        .token(telegram_bot_token)
+        .rate_limiter(outbound_scheduler)
+        .concurrent_updates(UPDATE_CONCURRENCY)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(CallbackQueryHandler(handle_menu_selection))
-    application.run_polling()
+    application.add_handler(CommandHandler("start", per_user_ordering(with_user_cache(start))))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user_ordering(with_user_cache(handle_message))))
+    application.add_handler(CallbackQueryHandler(per_user_ordering(with_user_cache(handle_menu_selection))))
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("Переменная окружения WEBHOOK_URL не найдена")
+        # Telegram сам присылает обновления на WEBHOOK_URL/WEBHOOK_PATH
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file